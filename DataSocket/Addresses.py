@@ -0,0 +1,52 @@
+"""
+Addresses of the stream sockets. Besides host names and ip addresses, the TCP sockets accept 'unix:///path/to/file' as
+address to communicate through a unix domain socket instead, which avoids the TCP/IP stack for peers on the same host.
+The port is ignored for unix domain sockets.
+"""
+import os
+import stat
+import socket
+
+UNIX_PREFIX = 'unix://'
+AF_UNIX = getattr(socket, 'AF_UNIX', None)  # not available on older windows versions
+
+
+def unix_path(address):
+    """
+    :param address: the tcp_ip argument of a socket.
+    :return: the socket file path of a 'unix://' address or None for network addresses.
+    """
+    if not isinstance(address, str) or not address.startswith(UNIX_PREFIX):
+        return None
+    if AF_UNIX is None:
+        raise ValueError('unix domain sockets are not supported on this platform.')
+    return address[len(UNIX_PREFIX):]
+
+
+def remove_stale_socket_file(path):
+    """
+    Remove a socket file left behind by a server that did not shut down cleanly, so the path can be bound again.
+    Files that are not sockets or that a server is still listening on are left alone.
+    :param path: path of the socket file.
+    """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+    probe = socket.socket(AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:  # nobody is listening anymore
+        remove_socket_file(path)
+    except OSError:
+        pass
+    finally:
+        probe.close()
+
+
+def remove_socket_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,324 @@
+"""
+Uncompressed binary array message format used by the ARRAY send type.
+
+A message consists of a small json header followed by the raw array buffers:
+
+    [4 byte little-endian header length][json header][padding][buffer 0][padding][buffer 1]...
+
+The header describes every array (key, dtype, shape, memory order and offset into the data section) so the receiving
+side can rebuild the arrays with np.frombuffer directly over the receive buffer without copying. Dtypes are described
+the way .npy files do, so structured dtypes keep their fields. Every buffer starts on an ALIGNMENT byte boundary
+relative to the start of the message.
+
+Because the header comes first, a receiver can also allocate the destination arrays up front and read the buffers
+straight into them in chunks (see receive_arrays), so very large arrays never need a second full size receive buffer.
+
+Streams that send the same keys, dtypes and shapes over and over can cache the header (the schema) instead. Every
+message then starts with a 4 byte little-endian schema id. The first message of a schema sets the highest bit of the
+id and carries the header right after it:
+
+    [schema id | 0x80000000][4 byte header length][json header][padding][buffers]
+
+and later messages of the same schema only carry the id and the buffers at the offsets given by the schema:
+
+    [schema id][padding][buffers]
+
+See SchemaEncoder and SchemaDecoder.
+"""
+import json
+import struct
+from collections import OrderedDict
+import numpy as np
+from numpy.lib.format import dtype_to_descr, descr_to_dtype
+
+ALIGNMENT = 64
+MAX_SCHEMAS = 256
+SCHEMA_ID = struct.Struct('<I')
+_HEADER_LENGTH = struct.Struct('<I')
+_PADDING = bytes(ALIGNMENT)
+_WITH_SCHEMA = 0x80000000
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _describe_dtype(dtype):
+    """
+    :return: json compatible description of dtype. Unlike dtype.str it keeps the fields of structured dtypes.
+    """
+    if dtype.fields is None:
+        return dtype.str
+    return dtype_to_descr(dtype)
+
+
+def _parse_dtype(description):
+    """
+    :return: the dtype described by _describe_dtype(), also after a round trip through json.
+    """
+    if isinstance(description, str):
+        return np.dtype(description)
+    return descr_to_dtype(description)
+
+
+def _as_sendable(array):
+    """
+    Get the array in a form whose memory can be sent directly.
+    :param array: numpy array
+    :return: (flat uint8 view of the array memory, memory order of the original array as 'C' or 'F')
+    """
+    if array.dtype.hasobject:
+        raise TypeError('arrays of python objects can not be sent with the ARRAY send type.')
+    if array.flags.c_contiguous:
+        order = 'C'
+    elif array.flags.f_contiguous:
+        # the transpose of a fortran ordered array is C contiguous and shares the same memory
+        order = 'F'
+        array = array.T
+    else:
+        order = 'C'
+        array = np.ascontiguousarray(array)
+    return array.reshape(-1).view(np.uint8), order
+
+
+def _sendable_arrays(data, extra):
+    """
+    :return: (whether a single value was sent, list of (key, array, flat uint8 view of its memory, memory order))
+    """
+    single = not isinstance(data, dict)
+    if single:
+        items = [('data', data)]
+    else:
+        items = list(data.items())
+    if extra:
+        items.extend(extra.items())
+        single = False
+    arrays = []
+    for key, value in items:
+        array = np.asarray(value)
+        raw, order = _as_sendable(array)
+        arrays.append((str(key), array, raw, order))
+    return single, arrays
+
+
+def _describe(single, arrays):
+    """
+    :return: the json header describing the arrays and where they are placed in the data section.
+    """
+    descriptions = []
+    offset = 0
+    for key, array, raw, order in arrays:
+        offset = _aligned(offset)
+        descriptions.append([key, _describe_dtype(array.dtype), list(array.shape), order, offset])
+        offset += raw.nbytes
+    return json.dumps({'single': single, 'arrays': descriptions}).encode(), [d[4] for d in descriptions]
+
+
+def _data_section(offsets, arrays):
+    """
+    :return: (size of the data section in bytes, list of padding and array buffers making it up)
+    """
+    buffers = []
+    position = 0
+    for offset, (_, _, raw, _) in zip(offsets, arrays):
+        if offset > position:
+            buffers.append(_PADDING[:offset - position])
+        buffers.append(raw)
+        position = offset + raw.nbytes
+    return position, buffers
+
+
+def pack_arrays(data, extra=None):
+    """
+    Convert data into an ARRAY message without copying the array memory.
+    :param data: anything np.asarray() can convert or a dict of the same.
+    :param extra: optional dict of additional values (i.e. {'_time': time.time()}) to add to the message.
+    :return: (size of the message in bytes, list of buffers making up the message in order)
+    """
+    single, arrays = _sendable_arrays(data, extra)
+    header, offsets = _describe(single, arrays)
+    data_start = _aligned(_HEADER_LENGTH.size + len(header))
+    buffers = [_HEADER_LENGTH.pack(len(header)), header, _PADDING[:data_start - _HEADER_LENGTH.size - len(header)]]
+    size, data_buffers = _data_section(offsets, arrays)
+    return data_start + size, buffers + data_buffers
+
+
+def _skip(receive_into, count):
+    scratch = bytearray(min(count, 65536))
+    while count > 0:
+        step = min(count, len(scratch))
+        if not receive_into(memoryview(scratch)[:step]):
+            return False
+        count -= step
+    return True
+
+
+def receive_arrays(receive_into, size, chunk_size, chunk_handler=None):
+    """
+    Receive an ARRAY message straight into freshly allocated arrays, reading at most chunk_size bytes at a time.
+    :param receive_into: callable filling a writable memoryview from the stream. Returns False if the stream ended.
+    :param size: size of the message in bytes as given by the frame header.
+    :param chunk_size: maximum number of bytes read per call of receive_into.
+    :param chunk_handler: optional callable invoked after every chunk as chunk_handler(key, array, received, total),
+           where array is the partially filled destination and received/total count its bytes.
+    :return: the same as unpack_arrays() or None if the stream ended before the message was complete.
+    """
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be at least 1')
+    length = bytearray(_HEADER_LENGTH.size)
+    if not receive_into(memoryview(length)):
+        return None
+    header = bytearray(_HEADER_LENGTH.unpack(length)[0])
+    if not receive_into(memoryview(header)):
+        return None
+    position = _HEADER_LENGTH.size + len(header)
+    header = json.loads(header.decode())
+    data_start = _aligned(position)
+
+    arrays = {}
+    for key, dtype, shape, order, offset in header['arrays']:
+        if not _skip(receive_into, data_start + offset - position):
+            return None
+        if order == 'F':
+            # filled as the C ordered transpose, which shares the memory of the fortran ordered array
+            target = np.empty(shape[::-1], dtype=_parse_dtype(dtype))
+            arrays[key] = target.T
+        else:
+            target = np.empty(shape, dtype=_parse_dtype(dtype))
+            arrays[key] = target
+        raw = target.reshape(-1).view(np.uint8)
+        for start in range(0, raw.nbytes, chunk_size):
+            end = min(start + chunk_size, raw.nbytes)
+            if not receive_into(memoryview(raw[start:end])):
+                return None
+            if chunk_handler is not None:
+                chunk_handler(key, arrays[key], end, raw.nbytes)
+        position = data_start + offset + raw.nbytes
+
+    if not _skip(receive_into, size - position):
+        return None
+    if header['single']:
+        return arrays['data']
+    return arrays
+
+
+class _Layout(object):
+    def __init__(self, header):
+        """
+        Everything needed to rebuild the arrays of a message, worked out once per header.
+        :param header: the decoded json header.
+        """
+        self.single = header['single']
+        self.arrays = []
+        for key, dtype, shape, order, offset in header['arrays']:
+            count = int(np.prod(shape, dtype=np.int64))
+            # fortran ordered arrays are rebuilt as the transpose of their C ordered transpose
+            fortran = order == 'F'
+            self.arrays.append((key, _parse_dtype(dtype), count, tuple(shape[::-1] if fortran else shape), fortran,
+                                offset))
+
+    def unpack(self, buffer, data_start):
+        arrays = {}
+        for key, dtype, count, shape, fortran, offset in self.arrays:
+            array = np.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + offset).reshape(shape)
+            arrays[key] = array.T if fortran else array
+        if self.single:
+            return arrays['data']
+        return arrays
+
+
+def _read_header(buffer, start):
+    """
+    :return: (decoded json header starting at start, end of the header)
+    """
+    header_end = start + _HEADER_LENGTH.size + _HEADER_LENGTH.unpack_from(buffer, start)[0]
+    return json.loads(bytes(buffer[start + _HEADER_LENGTH.size:header_end]).decode()), header_end
+
+
+def unpack_arrays(buffer):
+    """
+    Rebuild the data from an ARRAY message. The returned arrays are views into buffer, so buffer must not be reused
+    while the arrays are still in use.
+    :param buffer: bytes-like object holding one complete message.
+    :return: a numpy array if a single value was sent, otherwise a dict of numpy arrays.
+    """
+    header, header_end = _read_header(buffer, 0)
+    return _Layout(header).unpack(buffer, _aligned(header_end))
+
+
+class SchemaEncoder(object):
+    def __init__(self, max_schemas=MAX_SCHEMAS):
+        """
+        Builds ARRAY messages that refer to a cached schema instead of repeating the header. Used by the sending side
+        of one stream.
+        :param max_schemas: maximum number of schemas remembered. All schemas are forgotten and sent again once more
+               than this many different ones were used, which keeps streams with ever changing shapes bounded.
+        """
+        self.max_schemas = max_schemas
+        self._schemas = {}  # type: dict[tuple, tuple[int, bytes, list[int]]]
+        self._next_id = 0
+
+    def pack(self, data, extra=None):
+        """
+        Convert data into a message without copying the array memory.
+        :param data: anything np.asarray() can convert or a dict of the same.
+        :param extra: optional dict of additional values (i.e. {'_time': time.time()}) to add to the message.
+        :return: (schema id, (size, buffers) of the message, (size, buffers) of the same message including its
+                 schema). Receivers that did not get the schema yet need the latter. The two are the same message
+                 when the schema is new.
+        """
+        single, arrays = _sendable_arrays(data, extra)
+        # dtypes compare by their fields as well, dtype.str would not tell structured dtypes of the same size apart
+        key = (single,) + tuple((name, array.dtype, array.shape, order) for name, array, _, order in arrays)
+        schema = self._schemas.get(key)
+        new = schema is None
+        if new:
+            if len(self._schemas) >= self.max_schemas:
+                self._schemas.clear()
+            header, offsets = _describe(single, arrays)
+            schema = (self._next_id, header, offsets)
+            self._next_id = (self._next_id + 1) % _WITH_SCHEMA
+            self._schemas[key] = schema
+        schema_id, header, offsets = schema
+
+        size, data_buffers = _data_section(offsets, arrays)
+        header_end = SCHEMA_ID.size + _HEADER_LENGTH.size + len(header)
+        data_start = _aligned(header_end)
+        full = (data_start + size, [SCHEMA_ID.pack(schema_id | _WITH_SCHEMA), _HEADER_LENGTH.pack(len(header)),
+                                    header, _PADDING[:data_start - header_end]] + data_buffers)
+        if new:
+            return schema_id, full, full
+        short = (ALIGNMENT + size, [SCHEMA_ID.pack(schema_id), _PADDING[SCHEMA_ID.size:]] + data_buffers)
+        return schema_id, short, full
+
+
+class SchemaDecoder(object):
+    def __init__(self, max_schemas=MAX_SCHEMAS):
+        """
+        Rebuilds the data from the messages of a SchemaEncoder. Used by the receiving side of one stream.
+        :param max_schemas: maximum number of schemas kept. The least recently used one is dropped beyond this.
+        """
+        self.max_schemas = max_schemas
+        self._layouts = OrderedDict()  # type: OrderedDict[int, _Layout]
+
+    def unpack(self, buffer):
+        """
+        Rebuild the data from a message. The returned arrays are views into buffer.
+        :param buffer: bytes-like object holding one complete message.
+        :return: a numpy array if a single value was sent, otherwise a dict of numpy arrays.
+        """
+        schema_id = SCHEMA_ID.unpack_from(buffer)[0]
+        if schema_id & _WITH_SCHEMA:
+            schema_id &= ~_WITH_SCHEMA
+            header, header_end = _read_header(buffer, SCHEMA_ID.size)
+            layout = _Layout(header)
+            self._layouts[schema_id] = layout
+            self._layouts.move_to_end(schema_id)
+            if len(self._layouts) > self.max_schemas:
+                self._layouts.popitem(last=False)
+            return layout.unpack(buffer, _aligned(header_end))
+        layout = self._layouts.get(schema_id)
+        if layout is None:
+            raise ValueError('ARRAY message refers to schema ' + str(schema_id) + ', which was never received')
+        self._layouts.move_to_end(schema_id)
+        return layout.unpack(buffer, ALIGNMENT)
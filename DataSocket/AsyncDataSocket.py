@@ -0,0 +1,441 @@
+"""
+asyncio versions of TCPSendSocket and TCPReceiveSocket. They speak the same wire protocol (the 4 byte send type
+handshake followed by framed messages, see DataSocket.Framing) and interoperate with the threaded sockets and the
+matlab sockets.
+"""
+import asyncio
+import time
+from .Serialization import NUMPY, RAW, SEND_TYPE_NAMES, encode, decode, decode_batch
+from .Codecs import get_compressor, decompress
+from .Framing import FrameWriter, LEGACY_FRAMES, FRAME_V2, HEADER, LEGACY_HEADER, NAME_LENGTH, handshake, \
+    parse_handshake, parse_header
+from .Addresses import unix_path, remove_stale_socket_file, remove_socket_file
+from .SharedMemoryRing import SharedMemoryReader, DESCRIPTOR, INLINE_MESSAGE
+from .ArrayFormat import SchemaDecoder
+from .DeltaEncoding import DeltaDecoder
+from .Metrics import Metrics
+
+# reconnect attempts back off from the first to the maximum delay (seconds) while the peer is not available
+_FIRST_RETRY_DELAY = 0.001
+_MAX_RETRY_DELAY = 0.05
+
+_STOPPED = object()
+
+
+async def _connect(ip, port, stopped):
+    """
+    Connect to a server, retrying until it is available.
+    :return: (reader, writer) or None if stopped was set first.
+    """
+    path = unix_path(ip)
+    retry_delay = _FIRST_RETRY_DELAY
+    while not stopped.is_set():
+        try:
+            if path is not None:
+                return await asyncio.open_unix_connection(path)
+            return await asyncio.open_connection(ip, port)
+        except OSError:
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(2 * retry_delay, _MAX_RETRY_DELAY)
+    return None
+
+
+async def _start_server(callback, ip, port, verbose):
+    path = unix_path(ip)
+    if path is None:
+        server = await asyncio.start_server(callback, ip, port, reuse_address=True)
+        if verbose:
+            print('listening on port ', port)
+    else:
+        remove_stale_socket_file(path)
+        server = await asyncio.start_unix_server(callback, path)
+        if verbose:
+            print('listening on ', path)
+    return server
+
+
+async def _stop_server(server, ip):
+    server.close()
+    await server.wait_closed()
+    path = unix_path(ip)
+    if path is not None:
+        remove_socket_file(path)
+
+
+async def _close(writer):
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except (ConnectionError, OSError):
+        pass
+
+
+class AsyncTCPSendSocket(object):
+    def __init__(self,
+                 tcp_port,
+                 tcp_ip='localhost',
+                 send_type=NUMPY,
+                 verbose=True,
+                 as_server=True,
+                 include_time=False,
+                 compression=None,
+                 compression_level=None,
+                 executor=None,
+                 frame_version=LEGACY_FRAMES):
+        """
+        asyncio counterpart of TCPSendSocket.
+            example:
+                    async with AsyncTCPSendSocket(4001, send_type=JSON) as send_socket:
+                        await send_socket.send({'a': 1})
+        :param tcp_port: TCP port to use. Ignored for unix domain sockets.
+        :param tcp_ip: ip address to connect to. 'unix:///path/to/file' uses a unix domain socket at that path instead,
+               which is faster for peers on the same host.
+        :param send_type: This is the data type used to send the data (see TCPSendSocket).
+        :param verbose: Whether or not to print errors and status messages.
+        :param as_server: Whether to run this socket as a server (default: True) or client. When run as a server, the
+               socket supports multiple clients and sends each message to every connected client.
+        :param include_time: Appends time.time() value when sending the data message.
+        :param compression: Compression used for NUMPY and HDF payloads (see TCPSendSocket).
+        :param compression_level: compression level used by the chosen codec.
+        :param executor: concurrent.futures.Executor to encode messages in. Messages are encoded in the event loop
+               thread if None, which is fine for small messages.
+        :param frame_version: DataSocket.LEGACY_FRAMES or DataSocket.FRAME_V2 (see TCPSendSocket).
+        """
+        self.send_type = send_type
+        self._frame_writer = FrameWriter(frame_version)
+        self.compressor = get_compressor(compression, compression_level)
+        self.port = int(tcp_port)
+        self.ip = tcp_ip
+        self.verbose = verbose
+        self.as_server = as_server
+        self.include_time = include_time
+        self.executor = executor
+        self.connected_clients = []  # type: list[asyncio.StreamWriter]
+        self.metrics = Metrics(('encode', 'write'))
+        self._server = None
+        self._connected = None
+        self._stopped = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+
+    async def start(self, blocking=False):
+        """
+        Start the socket service.
+        :param blocking: wait until a connection is established to at least one receiver.
+        """
+        self._connected = asyncio.Event()
+        self._stopped = asyncio.Event()
+        if self.as_server:
+            self._server = await _start_server(self._on_connection, self.ip, self.port, self.verbose)
+        else:
+            await self._connect()
+        if blocking:
+            await self._connected.wait()
+
+    async def stop(self):
+        """
+        Stop the socket and close all connections.
+        """
+        self._stopped.set()
+        if self._server is not None:
+            await _stop_server(self._server, self.ip)
+            self._server = None
+        clients, self.connected_clients = self.connected_clients, []
+        await asyncio.gather(*[_close(writer) for writer in clients])
+
+    async def send(self, data):
+        """
+        Send the data to every connected receiver. Returns once the data was handed to the transports of all
+        receivers that are not applying backpressure.
+        :param data: the data to send (see TCPSendSocket.send_data).
+        """
+        if not self.as_server and not self.connected_clients:
+            await self._connect()
+        if not self.connected_clients:
+            return
+        start = time.perf_counter()
+        if self.executor is None:
+            size, f = encode(self.send_type, data, self.include_time, self.compressor)
+        else:
+            loop = asyncio.get_running_loop()
+            size, f = await loop.run_in_executor(self.executor, encode, self.send_type, data, self.include_time,
+                                                 self.compressor)
+        self.metrics.record('encode', time.perf_counter() - start)
+        start = time.perf_counter()
+        if size is None:
+            buffers = f if isinstance(f, list) else [f]
+        else:
+            buffers = self._frame_writer.frame(size, f)
+        writers = list(self.connected_clients)
+        for writer in writers:
+            writer.writelines(buffers)
+        await asyncio.gather(*[self._drain(writer) for writer in writers])
+        self.metrics.record('write', time.perf_counter() - start)
+        self.metrics.count(sum(len(buffer) for buffer in buffers) if size is None else size)
+
+    def stats(self):
+        """
+        Snapshot of what the socket did so far (see TCPSendSocket.stats). write_seconds includes waiting for
+        receivers applying backpressure.
+        :return: dict
+        """
+        stats = self.metrics.snapshot()
+        stats['clients'] = len(self.connected_clients)
+        return stats
+
+    async def _drain(self, writer):
+        try:
+            await writer.drain()
+        except (ConnectionError, OSError) as e:
+            if self.verbose:
+                print(e)
+            if writer in self.connected_clients:
+                self.connected_clients.remove(writer)
+                self.metrics.disconnects += 1
+            await _close(writer)
+
+    def _add_client(self, writer):
+        if not self.send_type == RAW:
+            writer.write(handshake(self.send_type, frame_version=self._frame_writer.frame_version))
+        self.connected_clients.append(writer)
+        self.metrics.connections += 1
+        self._connected.set()
+
+    async def _on_connection(self, reader, writer):
+        self._add_client(writer)
+
+    async def _connect(self):
+        connection = await _connect(self.ip, self.port, self._stopped)
+        if connection is not None:
+            self._add_client(connection[1])
+
+
+class AsyncTCPReceiveSocket(object):
+    def __init__(self,
+                 tcp_port,
+                 tcp_ip='localhost',
+                 verbose=True,
+                 as_server=False,
+                 receive_as_raw=False,
+                 receive_buffer_size=4095,
+                 queue_size=32,
+                 executor=None):
+        """
+        asyncio counterpart of TCPReceiveSocket. Received messages are retrieved with receive() or by iterating over
+        the socket until it is stopped.
+            example:
+                    async with AsyncTCPReceiveSocket(4001) as receive_socket:
+                        async for message in receive_socket:
+                            print(message)
+        :param tcp_port: TCP port to use. Ignored for unix domain sockets.
+        :param tcp_ip: ip address to connect to. 'unix:///path/to/file' uses a unix domain socket at that path instead,
+               which is faster for peers on the same host.
+        :param verbose: Whether or not to print errors and status messages.
+        :param as_server: Whether to run this socket as a server (default: False) or client. This needs to be opposite
+                          whatever the SendSocket is configured to be.
+        :param receive_as_raw: Whether or not the incoming data is just raw bytes or is a predefined format.
+        :param receive_buffer_size: maximum number of bytes returned per message when receiving raw data.
+        :param queue_size: number of decoded messages buffered before the socket stops reading from the network.
+        :param executor: concurrent.futures.Executor to decode messages in. Messages are decoded in the event loop
+               thread if None. ARRAY messages decoded from the stream are read-only.
+        """
+        self.port = int(tcp_port)
+        self.ip = tcp_ip
+        self.verbose = verbose
+        self.as_server = as_server
+        self.receive_as_raw = receive_as_raw
+        self.receive_buffer_size = receive_buffer_size
+        self.queue_size = queue_size
+        self.executor = executor
+        self.data_mode = None
+        self.is_connected = False
+        self.metrics = Metrics(('read', 'decode'))
+        self._messages = None
+        self._connections = None
+        self._connected = None
+        self._stopped = None
+        self._server = None
+        self._task = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self._messages.get()
+        if message is _STOPPED:
+            self._messages.put_nowait(_STOPPED)  # keep other consumers from waiting forever
+            raise StopAsyncIteration
+        return message
+
+    async def receive(self):
+        """
+        Wait for the next message.
+        :return: the decoded message.
+        """
+        try:
+            return await self.__anext__()
+        except StopAsyncIteration:
+            raise ConnectionError('the socket was stopped')
+
+    def stats(self):
+        """
+        Snapshot of what the socket did so far (see TCPReceiveSocket.stats). read_seconds is the time between the
+        frame header and the end of the payload, including waiting for the rest of the payload to arrive.
+        :return: dict
+        """
+        stats = self.metrics.snapshot()
+        stats['queued_messages'] = self._messages.qsize() if self._messages is not None else 0
+        return stats
+
+    async def start(self, blocking=False):
+        """
+        Start the socket service.
+        :param blocking: wait until a connection is established.
+        """
+        self._messages = asyncio.Queue(self.queue_size)
+        self._connections = asyncio.Queue()
+        self._connected = asyncio.Event()
+        self._stopped = asyncio.Event()
+        if self.as_server:
+            self._server = await _start_server(self._on_connection, self.ip, self.port, self.verbose)
+        self._task = asyncio.ensure_future(self._run())
+        if blocking:
+            await self._connected.wait()
+
+    async def stop(self):
+        """
+        Stop the socket. Iterations over the socket end once the queued messages were consumed.
+        """
+        self._stopped.set()
+        if self._server is not None:
+            await _stop_server(self._server, self.ip)
+            self._server = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while not self._connections.empty():
+            await _close(self._connections.get_nowait()[1])
+        try:
+            self._messages.put_nowait(_STOPPED)
+        except asyncio.QueueFull:
+            self._messages.get_nowait()
+            self._messages.put_nowait(_STOPPED)
+
+    async def _on_connection(self, reader, writer):
+        await self._connections.put((reader, writer))
+
+    async def _run(self):
+        while not self._stopped.is_set():
+            if self.as_server:
+                connection = await self._connections.get()
+            else:
+                connection = await _connect(self.ip, self.port, self._stopped)
+                if connection is None:
+                    return
+            reader, writer = connection
+            self.metrics.connections += 1
+            self.is_connected = True
+            self._connected.set()
+            try:
+                await self._receive(reader)
+            except (asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+                if self.verbose:
+                    print(e)
+            finally:
+                self.metrics.disconnects += 1
+                self.is_connected = False
+                self._connected.clear()
+                await _close(writer)
+
+    async def _receive(self, reader):
+        batched = False
+        frame_version = LEGACY_FRAMES
+        shared_memory = None
+        array_decoder = None
+        if self.receive_as_raw:
+            self.data_mode = RAW
+        else:
+            handshake = parse_handshake(await reader.readexactly(4))
+            self.data_mode, batched, frame_version = handshake[:3]
+            if handshake.schemas:
+                array_decoder = SchemaDecoder()
+            elif handshake.deltas:
+                array_decoder = DeltaDecoder()
+            if handshake.shared_memory:
+                name_length = NAME_LENGTH.unpack(await reader.readexactly(NAME_LENGTH.size))[0]
+                shared_memory = SharedMemoryReader((await reader.readexactly(name_length)).decode())
+            if self.verbose and self.data_mode in SEND_TYPE_NAMES:
+                print('Expecting ' + SEND_TYPE_NAMES[self.data_mode] + ' on receive.')
+        try:
+            await self._receive_messages(reader, batched, frame_version, shared_memory, array_decoder)
+        finally:
+            if shared_memory is not None:
+                shared_memory.close()
+
+    async def _receive_messages(self, reader, batched, frame_version, shared_memory, array_decoder):
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.data_mode == RAW:
+                buf = await reader.read(self.receive_buffer_size)
+                if not buf:
+                    return
+                self.metrics.count(len(buf))
+                await self._messages.put(buf)
+                continue
+
+            if frame_version == FRAME_V2:
+                header = parse_header(await reader.readexactly(HEADER.size))
+                start = time.perf_counter()
+                await reader.readexactly(header.metadata_size)
+                buf = await reader.readexactly(header.size)
+                self.metrics.bytes += HEADER.size + header.metadata_size + len(buf)
+                buf = decompress(buf, header.codec)
+            else:
+                size = LEGACY_HEADER.unpack(await reader.readexactly(LEGACY_HEADER.size))[0]
+                start = time.perf_counter()
+                buf = await reader.readexactly(size)
+                self.metrics.bytes += LEGACY_HEADER.size + size
+            if shared_memory is not None:
+                if buf[:1] == INLINE_MESSAGE:
+                    buf = memoryview(buf)[1:]
+                else:
+                    sequence = DESCRIPTOR.unpack(buf)[1]
+                    size = shared_memory.message_size(sequence)
+                    if size is None:
+                        continue
+                    buf = bytearray(size)
+                    if not shared_memory.read_into(sequence, memoryview(buf)):
+                        continue
+            self.metrics.record('read', time.perf_counter() - start)
+            decoder = decode_batch if batched else decode
+            start = time.perf_counter()
+            try:
+                if self.executor is None:
+                    message = decoder(self.data_mode, buf, array_decoder)
+                else:
+                    message = await loop.run_in_executor(self.executor, decoder, self.data_mode, buf, array_decoder)
+            except (OSError, ValueError) as e:
+                self.metrics.errors += 1
+                if self.verbose:
+                    print(e)
+                continue
+            self.metrics.record('decode', time.perf_counter() - start)
+            self.metrics.messages += len(message) if batched else 1
+            for message in (message if batched else [message]):
+                await self._messages.put(message)
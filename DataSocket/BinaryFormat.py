@@ -0,0 +1,274 @@
+"""
+Compact self-describing binary message format used by the BINARY send type, for nested dicts and lists of numbers,
+strings, bytes and numpy arrays.
+
+A message consists of the encoded structure followed by a data section holding the array memory and large bytes
+values as they are:
+
+    [4 byte little-endian structure length][structure][padding][buffer 0][padding][buffer 1]...
+
+The structure is a tree of tagged values (all integers little-endian):
+
+    b'N' None, b'T' True, b'F' False
+    b'i' int64, b'I' uint32 length + signed integer of that many bytes (ints beyond 64 bits)
+    b'd' float64, b'c' two float64 (complex)
+    b's' uint32 length + utf-8 string
+    b'b' uint32 length + bytes, b'B' uint64 offset + uint64 length of bytes in the data section
+    b'l' uint32 count + values (lists and tuples)
+    b'm' uint32 count + key and value of every item (dicts)
+    b'g' uint16 length + dtype + value (numpy scalars)
+    b'a' uint16 length + dtype, memory order (b'C' or b'F'), uint8 ndim, uint64 per dimension and uint64 offset of
+         the array memory in the data section
+
+Dtypes are written as dtype.str, or for structured dtypes as the json encoded description .npy files use, which keeps
+their fields.
+
+The data section starts on an ALIGNMENT byte boundary relative to the start of the message. Arrays of at least
+ALIGNMENT bytes start on an ALIGNMENT byte boundary, smaller arrays on a 16 byte boundary, so the receiving side
+rebuilds them with np.frombuffer directly over the receive buffer without copying.
+"""
+import json
+import struct
+from functools import lru_cache
+import numpy as np
+from .ArrayFormat import ALIGNMENT, _as_sendable, _describe_dtype, _parse_dtype
+
+INLINE_BYTES = 1024  # bytes values at least this large are sent in the data section without copying them
+_SMALL_ALIGNMENT = 16
+_PADDING = bytes(ALIGNMENT)
+
+_NONE, _TRUE, _FALSE, _INT, _BIG_INT, _FLOAT, _COMPLEX, _STRING, _BYTES, _BUFFER, _LIST, _MAP, _SCALAR, _ARRAY = \
+    b'NTFiIdcsbBlmga'
+
+_LENGTH = struct.Struct('<I')
+_TAGGED_LENGTH = struct.Struct('<BI')
+_TAGGED_INT = struct.Struct('<Bq')
+_TAGGED_FLOAT = struct.Struct('<Bd')
+_TAGGED_COMPLEX = struct.Struct('<Bdd')
+_TAGGED_BUFFER = struct.Struct('<BQQ')
+_TAGGED_DTYPE = struct.Struct('<BH')
+_DTYPE_LENGTH = struct.Struct('<H')
+_LAYOUT = struct.Struct('<cB')
+_OFFSET = struct.Struct('<Q')
+_INT64 = struct.Struct('<q')
+_FLOAT64 = struct.Struct('<d')
+_PAIR = struct.Struct('<dd')
+_PLACE = struct.Struct('<QQ')
+_INT_RANGE = (-1 << 63, 1 << 63)
+_CONSTANTS = {_NONE: None, _TRUE: True, _FALSE: False}
+
+
+def _aligned(offset, alignment):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+@lru_cache(maxsize=256)
+def _dtype(text):
+    text = text.decode()
+    return _parse_dtype(json.loads(text) if text.startswith('[') else text)
+
+
+@lru_cache(maxsize=256)
+def _dtype_text(dtype):
+    description = _describe_dtype(dtype)
+    text = (description if isinstance(description, str) else json.dumps(description)).encode()
+    if len(text) > 0xFFFF:
+        raise TypeError('the dtype ' + str(dtype) + ' has too many fields to be sent with the BINARY send type.')
+    return text
+
+
+class _DataSection(object):
+    def __init__(self):
+        """
+        The buffers following the structure of a message, in order and with the padding between them.
+        """
+        self.buffers = []
+        self.size = 0
+
+    def add(self, buffer, nbytes, alignment):
+        """
+        :return: offset of buffer in the data section.
+        """
+        offset = _aligned(self.size, alignment)
+        if offset > self.size:
+            self.buffers.append(_PADDING[:offset - self.size])
+        self.buffers.append(buffer)
+        self.size = offset + nbytes
+        return offset
+
+
+def _pack_array(array, out, data):
+    if array.dtype.hasobject:
+        raise TypeError('arrays of python objects can not be sent with the BINARY send type.')
+    raw, order = _as_sendable(array)
+    shape = array.shape if order == 'C' else array.shape[::-1]
+    offset = data.add(raw, raw.nbytes, ALIGNMENT if raw.nbytes >= ALIGNMENT else _SMALL_ALIGNMENT)
+    dtype = _dtype_text(array.dtype)
+    out += _TAGGED_DTYPE.pack(_ARRAY, len(dtype))
+    out += dtype
+    out += _LAYOUT.pack(order.encode(), len(shape))
+    out += struct.pack('<{}Q'.format(len(shape)), *shape)
+    out += _OFFSET.pack(offset)
+
+
+def _pack(value, out, data):
+    """
+    Append the encoded value to out, adding arrays and large bytes values to data.
+    """
+    # the most common scalars first, by exact type, before working through the isinstance checks
+    cls = type(value)
+    if cls is float:
+        out += _TAGGED_FLOAT.pack(_FLOAT, value)
+    elif cls is str:
+        encoded = value.encode()
+        out += _TAGGED_LENGTH.pack(_STRING, len(encoded))
+        out += encoded
+    elif cls is int and _INT_RANGE[0] <= value < _INT_RANGE[1]:
+        out += _TAGGED_INT.pack(_INT, value)
+    elif value is None:
+        out.append(_NONE)
+    elif value is True:
+        out.append(_TRUE)
+    elif value is False:
+        out.append(_FALSE)
+    elif isinstance(value, dict):
+        out += _TAGGED_LENGTH.pack(_MAP, len(value))
+        for key, item in value.items():
+            if isinstance(key, (tuple, np.ndarray)):
+                raise TypeError('dict keys must be numbers, strings or bytes to be sent with the BINARY send type.')
+            _pack(key, out, data)
+            _pack(item, out, data)
+    elif isinstance(value, (list, tuple)):
+        out += _TAGGED_LENGTH.pack(_LIST, len(value))
+        for item in value:
+            _pack(item, out, data)
+    elif isinstance(value, np.ndarray):
+        _pack_array(value, out, data)
+    elif isinstance(value, np.generic):  # before int and float, np.float64 is a float
+        dtype = _dtype_text(value.dtype)
+        out += _TAGGED_DTYPE.pack(_SCALAR, len(dtype))
+        out += dtype
+        out += value.tobytes()
+    elif isinstance(value, int):
+        if _INT_RANGE[0] <= value < _INT_RANGE[1]:
+            out += _TAGGED_INT.pack(_INT, value)
+        else:
+            big = value.to_bytes(value.bit_length() // 8 + 1, 'little', signed=True)
+            out += _TAGGED_LENGTH.pack(_BIG_INT, len(big))
+            out += big
+    elif isinstance(value, float):
+        out += _TAGGED_FLOAT.pack(_FLOAT, value)
+    elif isinstance(value, str):
+        encoded = value.encode()
+        out += _TAGGED_LENGTH.pack(_STRING, len(encoded))
+        out += encoded
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        nbytes = memoryview(value).nbytes
+        if nbytes >= INLINE_BYTES:
+            out += _TAGGED_BUFFER.pack(_BUFFER, data.add(value, nbytes, 1), nbytes)
+        else:
+            out += _TAGGED_LENGTH.pack(_BYTES, nbytes)
+            out += value
+    elif isinstance(value, complex):
+        out += _TAGGED_COMPLEX.pack(_COMPLEX, value.real, value.imag)
+    else:
+        raise TypeError('values of type ' + type(value).__name__ + ' can not be sent with the BINARY send type.')
+
+
+def pack_values(data, extra=None):
+    """
+    Convert data into a BINARY message without copying the array memory.
+    :param data: None, bool, int, float, complex, str, bytes, numpy array or scalar or any nesting of lists, tuples
+           and dicts of those. Tuples are received as lists.
+    :param extra: optional dict of additional values (i.e. {'_time': time.time()}) to add to the message. A value
+           that is not a dict is then sent as {'data': data} together with them.
+    :return: (size of the message in bytes, list of buffers making up the message in order)
+    """
+    if extra:
+        data = dict(data, **extra) if isinstance(data, dict) else dict({'data': data}, **extra)
+    structure = bytearray(_LENGTH.size)
+    section = _DataSection()
+    _pack(data, structure, section)
+    _LENGTH.pack_into(structure, 0, len(structure) - _LENGTH.size)
+    data_start = _aligned(len(structure), ALIGNMENT)
+    buffers = [structure]
+    if data_start > len(structure):
+        buffers.append(_PADDING[:data_start - len(structure)])
+    return data_start + section.size, buffers + section.buffers
+
+
+def _unpack(structure, position, buffer, data_start):
+    """
+    :return: (value starting at position of structure, position after the value)
+    """
+    tag = structure[position]
+    position += 1
+    if tag == _MAP:
+        count = _LENGTH.unpack_from(structure, position)[0]
+        position += _LENGTH.size
+        value = {}
+        for _ in range(count):
+            key, position = _unpack(structure, position, buffer, data_start)
+            value[key], position = _unpack(structure, position, buffer, data_start)
+        return value, position
+    if tag == _LIST:
+        count = _LENGTH.unpack_from(structure, position)[0]
+        position += _LENGTH.size
+        value = [None] * count
+        for i in range(count):
+            value[i], position = _unpack(structure, position, buffer, data_start)
+        return value, position
+    if tag == _INT:
+        return _INT64.unpack_from(structure, position)[0], position + _INT64.size
+    if tag == _FLOAT:
+        return _FLOAT64.unpack_from(structure, position)[0], position + _FLOAT64.size
+    if tag == _STRING:
+        end = position + _LENGTH.size + _LENGTH.unpack_from(structure, position)[0]
+        return structure[position + _LENGTH.size:end].decode(), end
+    if tag == _ARRAY:
+        end = position + _DTYPE_LENGTH.size + _DTYPE_LENGTH.unpack_from(structure, position)[0]
+        dtype = _dtype(structure[position + _DTYPE_LENGTH.size:end])
+        order, ndim = _LAYOUT.unpack_from(structure, end)
+        position = end + _LAYOUT.size
+        shape = struct.unpack_from('<{}Q'.format(ndim), structure, position)
+        position += 8 * ndim
+        offset = _OFFSET.unpack_from(structure, position)[0]
+        count = 1
+        for length in shape:
+            count *= length
+        array = np.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + offset).reshape(shape)
+        # fortran ordered arrays are rebuilt as the transpose of their C ordered transpose
+        return array.T if order == b'F' else array, position + _OFFSET.size
+    if tag in _CONSTANTS:
+        return _CONSTANTS[tag], position
+    if tag == _SCALAR:
+        end = position + _DTYPE_LENGTH.size + _DTYPE_LENGTH.unpack_from(structure, position)[0]
+        dtype = _dtype(structure[position + _DTYPE_LENGTH.size:end])
+        return np.frombuffer(structure, dtype=dtype, count=1, offset=end)[0], end + dtype.itemsize
+    if tag == _BYTES:
+        end = position + _LENGTH.size + _LENGTH.unpack_from(structure, position)[0]
+        return structure[position + _LENGTH.size:end], end
+    if tag == _BUFFER:
+        offset, nbytes = _PLACE.unpack_from(structure, position)
+        start = data_start + offset
+        return bytes(buffer[start:start + nbytes]), position + _PLACE.size
+    if tag == _BIG_INT:
+        end = position + _LENGTH.size + _LENGTH.unpack_from(structure, position)[0]
+        return int.from_bytes(structure[position + _LENGTH.size:end], 'little', signed=True), end
+    if tag == _COMPLEX:
+        return complex(*_PAIR.unpack_from(structure, position)), position + _PAIR.size
+    raise ValueError('malformed BINARY message, unknown tag ' + repr(bytes([tag])))
+
+
+def unpack_values(buffer):
+    """
+    Rebuild the data from a BINARY message. The returned arrays are views into buffer, so buffer must not be reused
+    while the arrays are still in use.
+    :param buffer: bytes-like object holding one complete message.
+    :return: the data as passed to pack_values().
+    """
+    view = memoryview(buffer)
+    end = _LENGTH.size + _LENGTH.unpack_from(view, 0)[0]
+    # the structure is small, a copy of it is faster to take apart than the view
+    value, _ = _unpack(bytes(view[_LENGTH.size:end]), 0, buffer, _aligned(end, ALIGNMENT))
+    return value
@@ -0,0 +1,137 @@
+"""
+Reusable receive buffers for TCPReceiveSocket.
+
+Allocating a new receive buffer for every message means the allocator and the page fault handler see the full data
+rate of the stream. A BufferPool keeps released buffers in size classes and hands them out again, so a steady stream
+of similarly sized messages keeps reusing the same memory.
+
+Lifetime rules: a buffer handed out by acquire() belongs to its PooledBuffer until release() was called as many times
+as the buffer was acquired or retained. Anything still pointing into the buffer after that (i.e. ARRAY data, which are
+views into the receive buffer) will see its memory overwritten by a later message.
+"""
+from threading import Lock
+
+MIN_BUFFER_SIZE = 4096
+_CLASS_SHIFT = 2  # 2 ** _CLASS_SHIFT size classes per power of two
+
+
+def _size_class(size):
+    """
+    Round size up to the next size class. Size classes are spaced a quarter of a power of two apart, so at most 25%
+    of a buffer is unused.
+    """
+    if size <= MIN_BUFFER_SIZE:
+        return MIN_BUFFER_SIZE
+    step = 1 << ((size - 1).bit_length() - 1 - _CLASS_SHIFT)
+    return (size + step - 1) // step * step
+
+
+class PooledBuffer(object):
+    def __init__(self, pool, buffer, size):
+        """
+        A buffer on loan from a BufferPool. Use release() or a with statement to give it back.
+        :param pool: the owning BufferPool or None if the buffer is not pooled.
+        :param buffer: bytearray of at least size bytes.
+        :param size: number of bytes in use.
+        """
+        self.pool = pool
+        self.buffer = buffer
+        self.size = size
+        self._references = 1
+        self._lock = Lock()
+
+    @property
+    def view(self):
+        """
+        memoryview of the size bytes in use.
+        """
+        return memoryview(self.buffer)[:self.size]
+
+    def retain(self):
+        """
+        Keep the buffer from being returned to the pool until release() was called once more.
+        :return: self
+        """
+        with self._lock:
+            if self._references == 0:
+                raise ValueError('the buffer was already released')
+            self._references += 1
+        return self
+
+    def release(self):
+        """
+        Give up one reference to the buffer. The buffer goes back to the pool once the last reference was released.
+        """
+        with self._lock:
+            if self._references == 0:
+                return
+            self._references -= 1
+            if self._references:
+                return
+        if self.pool is not None:
+            self.pool._put(self.buffer)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class BufferPool(object):
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        """
+        Pool of reusable bytearrays sorted into size classes.
+        :param max_bytes: maximum number of bytes kept in the pool while not in use. Buffers released beyond this are
+               left to the garbage collector, and messages larger than this are never pooled.
+        """
+        self.max_bytes = max_bytes
+        self.pooled_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._free = {}  # type: dict[int, list[bytearray]]
+        self._lock = Lock()
+
+    def acquire(self, size):
+        """
+        Get a buffer for size bytes, reusing a released one of the same size class if available.
+        :param size: number of bytes needed.
+        :return: PooledBuffer
+        """
+        size_class = _size_class(size)
+        if size_class > self.max_bytes:
+            self.misses += 1
+            return PooledBuffer(None, bytearray(size), size)
+        with self._lock:
+            free = self._free.get(size_class)
+            if free:
+                self.hits += 1
+                self.pooled_bytes -= size_class
+                return PooledBuffer(self, free.pop(), size)
+            self.misses += 1
+        return PooledBuffer(self, bytearray(size_class), size)
+
+    def _put(self, buffer):
+        with self._lock:
+            if self.pooled_bytes + len(buffer) > self.max_bytes:
+                return
+            self._free.setdefault(len(buffer), []).append(buffer)
+            self.pooled_bytes += len(buffer)
+
+    def clear(self):
+        """
+        Drop all buffers currently held by the pool.
+        """
+        with self._lock:
+            self._free.clear()
+            self.pooled_bytes = 0
+
+    def stats(self):
+        """
+        :return: dict with the number of bytes held by the pool and how often a buffer could be reused.
+        """
+        with self._lock:
+            return {'pooled_bytes': self.pooled_bytes,
+                    'pooled_buffers': sum(len(free) for free in self._free.values()),
+                    'hits': self.hits,
+                    'misses': self.misses}
@@ -0,0 +1,194 @@
+"""
+Compression codecs for NUMPY and HDF payloads.
+
+A compressed payload is wrapped in a small envelope so the receiving side can always tell how (and whether) a message
+was compressed:
+
+    [b'DSZ'][1 byte codec id][compressed payload]
+
+Neither numpy (zip) nor HDF5 files can start with the envelope magic, so uncompressed payloads are passed through
+untouched and receivers stay compatible with senders that do not compress.
+"""
+import bz2
+import lzma
+import time
+import zlib
+
+NONE = 0
+ZLIB = 1
+LZMA = 2
+BZ2 = 3
+
+CODECS = {'none': NONE, 'zlib': ZLIB, 'lzma': LZMA, 'bz2': BZ2}
+
+_MAGIC = b'DSZ'
+ENVELOPE_SIZE = len(_MAGIC) + 1
+_DEFAULT_LEVELS = {ZLIB: 6, LZMA: 6, BZ2: 9}
+
+
+def _compress(payload, codec, level):
+    if codec == ZLIB:
+        return zlib.compress(payload, level)
+    elif codec == LZMA:
+        return lzma.compress(payload, preset=level)
+    elif codec == BZ2:
+        return bz2.compress(payload, level)
+    raise ValueError('unknown codec id ' + str(codec))
+
+
+def _decompress(payload, codec):
+    if codec == ZLIB:
+        return zlib.decompress(payload)
+    elif codec == LZMA:
+        return lzma.decompress(payload)
+    elif codec == BZ2:
+        return bz2.decompress(payload)
+    raise ValueError('unknown codec id ' + str(codec))
+
+
+def compress(payload, codec, level=None):
+    """
+    Compress a payload and wrap it in the codec envelope.
+    :param payload: bytes-like object.
+    :param codec: one of NONE, ZLIB, LZMA, BZ2.
+    :param level: compression level for the codec. Uses the codec default if None.
+    :return: bytes
+    """
+    if codec == NONE:
+        return payload
+    if level is None:
+        level = _DEFAULT_LEVELS[codec]
+    return envelope(codec) + _compress(payload, codec, level)
+
+
+def envelope(codec):
+    """
+    :return: the envelope put in front of a payload compressed with codec.
+    """
+    return _MAGIC + bytes([codec])
+
+
+def is_compressed(payload):
+    return bytes(payload[:len(_MAGIC)]) == _MAGIC
+
+
+def decompress(payload, codec=None):
+    """
+    Undo compress(). Payloads without the codec envelope are returned unchanged.
+    :param payload: bytes-like object.
+    :param codec: codec id of a payload without envelope, i.e. from a frame header.
+    :return: bytes-like object
+    """
+    if codec is not None:
+        return payload if codec == NONE else _decompress(payload, codec)
+    if not is_compressed(payload):
+        return payload
+    codec = payload[len(_MAGIC)]
+    return _decompress(memoryview(payload)[ENVELOPE_SIZE:], codec)
+
+
+class Compressor(object):
+    def __init__(self, codec=ZLIB, level=None):
+        """
+        Compresses every payload with a fixed codec.
+        :param codec: one of NONE, ZLIB, LZMA, BZ2.
+        :param level: compression level for the codec. Uses the codec default if None.
+        """
+        self.codec = codec
+        self.level = level
+
+    def compress(self, payload):
+        return compress(payload, self.codec, self.level)
+
+    def observe_send(self, nbytes, seconds):
+        """
+        Called by the sockets after a payload was written out so adaptive compressors can track link throughput.
+        :param nbytes: number of bytes written.
+        :param seconds: time it took to write them.
+        """
+        pass
+
+
+class AdaptiveCompressor(Compressor):
+    def __init__(self, codec=ZLIB, level=1, sample_size=16384, smoothing=0.2, default_link_rate=None):
+        """
+        Decides per message whether compression pays off. A few slices of each payload are compressed to estimate the
+        compression ratio and speed, which are compared against the observed link throughput. The payload is only
+        compressed when compressing and sending the smaller payload is expected to be faster than sending it as is.
+        :param codec: codec used when compressing. One of ZLIB, LZMA, BZ2.
+        :param level: compression level for the codec.
+        :param sample_size: size in bytes of each of the three slices used to estimate the compression ratio.
+        :param smoothing: weight of the newest measurement in the moving averages.
+        :param default_link_rate: link throughput in bytes/s assumed before any send was measured. If None, payloads
+               are compressed whenever they shrink by more than 20% until a measurement is available.
+        """
+        super().__init__(codec, level)
+        self.sample_size = sample_size
+        self.smoothing = smoothing
+        self.link_rate = default_link_rate
+        self.ratio = None
+        self.compress_rate = None
+        self.compressed_count = 0
+        self.skipped_count = 0
+
+    def _average(self, old, new):
+        if old is None:
+            return new
+        return old + self.smoothing * (new - old)
+
+    def _sample(self, payload):
+        view = memoryview(payload).cast('B')
+        if len(view) <= 3 * self.sample_size:
+            return view
+        middle = (len(view) - self.sample_size) // 2
+        return b''.join([view[:self.sample_size],
+                         view[middle:middle + self.sample_size],
+                         view[-self.sample_size:]])
+
+    def should_compress(self, payload):
+        sample = self._sample(payload)
+        if len(sample) == 0:
+            return False
+        start = time.perf_counter()
+        compressed_size = len(_compress(sample, self.codec, self.level))
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        # the ratio is a property of this payload, so it is decided on as measured. Only the rates, which depend on
+        # the machine and the link, are smoothed. self.ratio keeps the average for reporting
+        ratio = compressed_size / len(sample)
+        self.ratio = self._average(self.ratio, ratio)
+        self.compress_rate = self._average(self.compress_rate, len(sample) / elapsed)
+
+        if self.link_rate is None:
+            return ratio < 0.8
+        size = len(payload)
+        time_raw = size / self.link_rate
+        time_compressed = size / self.compress_rate + size * ratio / self.link_rate
+        return time_compressed < time_raw
+
+    def compress(self, payload):
+        if self.should_compress(payload):
+            self.compressed_count += 1
+            return compress(payload, self.codec, self.level)
+        self.skipped_count += 1
+        return payload
+
+    def observe_send(self, nbytes, seconds):
+        if nbytes < self.sample_size or seconds <= 0:
+            return  # small writes only measure syscall overhead
+        self.link_rate = self._average(self.link_rate, nbytes / seconds)
+
+
+def get_compressor(compression, level=None):
+    """
+    Create a compressor from the compression argument of the send sockets.
+    :param compression: None, one of 'none', 'zlib', 'lzma', 'bz2' or 'auto', or a Compressor instance.
+    :param level: compression level used by the codec.
+    :return: Compressor or None if compression is None.
+    """
+    if compression is None or isinstance(compression, Compressor):
+        return compression
+    if compression == 'auto':
+        return AdaptiveCompressor(level=1 if level is None else level)
+    if compression not in CODECS:
+        raise ValueError("compression must be one of " + str(list(CODECS.keys()) + ['auto']))
+    return Compressor(CODECS[compression], level)
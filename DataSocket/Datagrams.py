@@ -0,0 +1,251 @@
+"""
+Datagram protocol used by the UDP sockets.
+
+Every message is split into fragments that fit into a single datagram. Each datagram starts with a 14 byte
+little-endian header:
+
+    version (uint8), flags (uint8), fragment index (uint16), fragment count (uint16), message id (uint32),
+    message size (uint32)
+
+followed by the fragment payload. All fragments of a message except the last carry the same number of bytes, so the
+receiver can place fragments arriving in any order. Message ids count up by one per message (modulo 2 ** 32), which
+lets the receiver account for lost and reordered messages.
+
+A message with FLAG_BATCH set in every fragment holds several messages packed by Serialization.encode_batch. Senders
+use this to fill a datagram with many small messages, and the batch counts as one message id.
+"""
+import struct
+import time
+from socket import socket, AF_INET, SOCK_DGRAM, IPPROTO_IP
+from collections import OrderedDict, deque
+
+VERSION = 1
+HEADER = struct.Struct('<BBHHII')
+FLAG_BATCH = 0x1
+MAX_FRAGMENTS = 0xFFFF
+MAX_DATAGRAM_SIZE = 65507  # largest UDP payload over IPv4
+ETHERNET_DATAGRAM_SIZE = 1472  # 1500 byte ethernet MTU minus IPv4 and UDP headers
+MAX_MESSAGE_SIZE = 1 << 28  # default limit of the receive buffer allocated for a fragmented message
+
+_IP_MTU = 14  # linux socket option reporting the path MTU of a connected socket
+_IP_UDP_HEADERS = 28
+_ID_MASK = 0xFFFFFFFF
+# message ids further apart than this are taken as a restarted sender rather than lost messages
+_RESYNC_DISTANCE = 1 << 16
+
+
+def path_datagram_size(destination):
+    """
+    Find the largest datagram that reaches destination without IP fragmentation.
+    :param destination: (ip, port) the datagrams are sent to.
+    :return: the datagram payload size in bytes. Falls back to ETHERNET_DATAGRAM_SIZE where the path MTU can not be
+             queried.
+    """
+    probe = socket(AF_INET, SOCK_DGRAM)
+    try:
+        probe.connect(destination)
+        mtu = probe.getsockopt(IPPROTO_IP, _IP_MTU)
+    except OSError:
+        return ETHERNET_DATAGRAM_SIZE
+    finally:
+        probe.close()
+    return max(HEADER.size + 1, min(mtu - _IP_UDP_HEADERS, MAX_DATAGRAM_SIZE))
+
+
+def fragment(message_id, size, payload, datagram_size, flags=0):
+    """
+    Split a message into datagrams.
+    :param message_id: id of the message.
+    :param size: size of the message in bytes.
+    :param payload: bytes-like object or list of buffers as returned by encode().
+    :param datagram_size: maximum size of a datagram including the header.
+    :param flags: flags sent with every fragment, i.e. FLAG_BATCH.
+    :return: list of datagrams, each a list of buffers (header and payload views).
+    """
+    fragment_size = datagram_size - HEADER.size
+    count = max(1, -(-size // fragment_size))
+    if count > MAX_FRAGMENTS:
+        raise ValueError('message of ' + str(size) + ' bytes is too large to be sent as datagrams of ' +
+                         str(datagram_size) + ' bytes')
+    buffers = payload if isinstance(payload, list) else [payload]
+    views = deque(memoryview(buffer).cast('B') for buffer in buffers if len(buffer))
+    datagrams = []
+    for index in range(count):
+        datagram = [HEADER.pack(VERSION, flags, index, count, message_id & _ID_MASK, size)]
+        remaining = fragment_size
+        while remaining and views:
+            view = views[0]
+            if len(view) > remaining:
+                datagram.append(view[:remaining])
+                views[0] = view[remaining:]
+                remaining = 0
+            else:
+                datagram.append(view)
+                views.popleft()
+                remaining -= len(view)
+        datagrams.append(datagram)
+    return datagrams
+
+
+class _PartialMessage(object):
+    def __init__(self, count, size, flags, now):
+        self.count = count
+        self.size = size
+        self.flags = flags
+        self.buffer = bytearray(size)
+        self.received = bytearray(count)  # 1 for every fragment index already placed
+        self.missing = count
+        self.fragment_size = None
+        self.started = now
+
+
+class Reassembler(object):
+    def __init__(self, timeout=1.0, max_pending=256, max_message_size=MAX_MESSAGE_SIZE):
+        """
+        Puts fragmented messages back together and keeps track of lost, late and reordered messages.
+        :param timeout: time in seconds after the first fragment of a message after which an incomplete message is
+               dropped.
+        :param max_pending: maximum number of incomplete messages kept at the same time. The oldest is dropped when a
+               new one would exceed this.
+        :param max_message_size: largest message in bytes accepted. The buffer of a fragmented message is allocated
+               with its first fragment, so datagrams announcing larger messages are counted as invalid_datagrams.
+        """
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.max_message_size = max_message_size
+        self.received_messages = 0
+        self.missed_messages = 0  # message ids that were never delivered
+        self.incomplete_messages = 0  # messages dropped because fragments did not arrive in time
+        self.late_fragments = 0  # fragments of messages that were already delivered or dropped
+        self.out_of_order_messages = 0  # messages completed after a newer message was delivered
+        self.invalid_datagrams = 0
+        self.last_id = None
+        self.flags = 0  # flags of the message last returned by add()
+        self.assembly_seconds = 0.0  # time between the first and the last fragment of that message
+        self._pending = OrderedDict()  # type: OrderedDict[int, _PartialMessage]
+        self._finished = set()
+        self._finished_order = deque()
+
+    @property
+    def pending(self):
+        """
+        Number of incomplete messages waiting for fragments.
+        """
+        return len(self._pending)
+
+    def add(self, datagram, now=None):
+        """
+        Add a received datagram.
+        :param datagram: bytes-like object holding one datagram.
+        :param now: receive time. Uses time.monotonic() if None.
+        :return: bytes-like object holding the complete message once its last fragment arrived, otherwise None.
+        """
+        if now is None:
+            now = time.monotonic()
+        self.expire(now)
+        if len(datagram) < HEADER.size:
+            self.invalid_datagrams += 1
+            return None
+        version, flags, index, count, message_id, size = HEADER.unpack_from(datagram)
+        if version != VERSION or index >= count:
+            self.invalid_datagrams += 1
+            return None
+        payload = datagram[HEADER.size:]
+        if size > self.max_message_size:
+            self.invalid_datagrams += 1
+            return None
+        if message_id in self._finished:
+            self.late_fragments += 1
+            return None
+
+        if count == 1:
+            if len(payload) != size:
+                self.invalid_datagrams += 1
+                return None
+            self._finish(message_id, delivered=True)
+            self.flags = flags
+            self.assembly_seconds = 0.0
+            return bytes(payload)
+
+        partial = self._pending.get(message_id)
+        if partial is None:
+            # the size has to match the fragment that arrived before its buffer is allocated. All fragments but the
+            # last carry the same number of bytes and the last one at least one
+            if index < count - 1:
+                plausible = (count - 1) * len(payload) < size <= count * len(payload)
+            else:
+                plausible = 0 < len(payload) and size - len(payload) <= (count - 1) * (MAX_DATAGRAM_SIZE - HEADER.size)
+            if not plausible:
+                self.invalid_datagrams += 1
+                return None
+            if len(self._pending) >= self.max_pending:
+                self._drop(next(iter(self._pending)))
+            partial = _PartialMessage(count, size, flags, now)
+            self._pending[message_id] = partial
+        elif partial.count != count or partial.size != size or partial.flags != flags:
+            self.invalid_datagrams += 1
+            return None
+        if partial.received[index]:
+            return None  # duplicate
+
+        if index < count - 1:
+            fragment_size = len(payload)
+        else:
+            fragment_size = (size - len(payload)) // (count - 1)
+        if partial.fragment_size is None:
+            partial.fragment_size = fragment_size
+        offset = index * partial.fragment_size
+        if fragment_size != partial.fragment_size or offset + len(payload) > size:
+            self.invalid_datagrams += 1
+            return None
+        partial.buffer[offset:offset + len(payload)] = payload
+        partial.received[index] = 1
+        partial.missing -= 1
+        if partial.missing:
+            return None
+        del self._pending[message_id]
+        self._finish(message_id, delivered=True)
+        self.flags = flags
+        self.assembly_seconds = now - partial.started
+        return partial.buffer
+
+    def expire(self, now=None):
+        """
+        Drop incomplete messages whose first fragment arrived more than timeout seconds ago.
+        """
+        if now is None:
+            now = time.monotonic()
+        while self._pending:
+            message_id, partial = next(iter(self._pending.items()))
+            if now - partial.started < self.timeout:
+                return
+            self._drop(message_id)
+
+    def _drop(self, message_id):
+        del self._pending[message_id]
+        self.incomplete_messages += 1
+        self._finish(message_id, delivered=False)
+
+    def _finish(self, message_id, delivered):
+        self._finished.add(message_id)
+        self._finished_order.append(message_id)
+        if len(self._finished_order) > 4 * self.max_pending:
+            self._finished.discard(self._finished_order.popleft())
+        if not delivered:
+            return
+        self.received_messages += 1
+        if self.last_id is None:
+            self.last_id = message_id
+            return
+        distance = (message_id - self.last_id) & _ID_MASK
+        if distance == 0:
+            return
+        if distance < _RESYNC_DISTANCE:
+            self.missed_messages += distance - 1
+            self.last_id = message_id
+        elif _ID_MASK + 1 - distance < _RESYNC_DISTANCE:
+            # an older message completed late. It was counted as missed when the newer one was delivered
+            self.out_of_order_messages += 1
+            self.missed_messages = max(0, self.missed_messages - 1)
+        else:
+            self.last_id = message_id  # the sender was restarted
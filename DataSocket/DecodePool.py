@@ -0,0 +1,262 @@
+"""
+Decoding of received NUMPY, JSON and HDF messages in worker processes, so inflating npz files and parsing HDF5 files
+scales with the number of cores instead of being limited by the GIL of the receiving process.
+
+The receiving thread copies every large message into a reusable shared memory segment and submits only the segment
+name to a worker process, which decompresses and decodes it there. Messages below a size threshold are decoded on
+the receiving thread, because for them the round trip to a worker takes longer than decoding. A collector thread
+passes the results on in the order the messages were received.
+"""
+from threading import Thread, Condition
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from .Serialization import NUMPY, decode, decode_batch
+from .Codecs import decompress
+from .SharedMemoryRing import attach_segment
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+_SEGMENT_GRANULARITY = 1 << 16
+_ATTACHED_SEGMENTS = 32  # shared memory segments a worker keeps mapped
+
+
+def _segment_size(size):
+    return max(_SEGMENT_GRANULARITY, 1 << (size - 1).bit_length())
+
+
+_attached = OrderedDict()  # segments mapped by this worker process, by name
+
+
+def _attach(name):
+    segment = _attached.pop(name, None)
+    if segment is None:
+        segment = attach_segment(name)  # the receiving process owns the segment and removes it
+        while len(_attached) >= _ATTACHED_SEGMENTS:
+            _attached.popitem(last=False)[1].close()
+    _attached[name] = segment
+    return segment
+
+
+def _portable(data_mode, data):
+    # numpy files decompress their arrays on access, so inflate them here and send the arrays themselves, which
+    # pickle as raw memory instead of a file the receiving process would have to parse again
+    if data_mode == NUMPY:
+        return {key: data[key] for key in data.files}
+    return data
+
+
+def _decode(data_mode, batched, codec, name, size, payload):
+    view = _attach(name).buf[:size] if name is not None else memoryview(payload)
+    try:
+        buf = decompress(view, codec)
+        if batched:
+            return [_portable(data_mode, data) for data in decode_batch(data_mode, buf)]
+        return _portable(data_mode, decode(data_mode, buf))
+    finally:
+        view.release()  # the segment can not be closed while views of it exist
+
+
+class _Pending(object):
+    __slots__ = ('future', 'segment', 'segment_size', 'trace')
+
+    def __init__(self, future, segment=None, segment_size=None, trace=None):
+        self.future = future
+        self.segment = segment  # shared memory segment holding the message while a worker decodes it
+        self.segment_size = segment_size
+        self.trace = trace
+
+
+class DecodePool(object):
+    def __init__(self, deliver, processes, inline_size=64 * 1024, max_pending=None, verbose=True, as_daemon=True):
+        """
+        Decodes messages in worker processes and passes them on in the order received.
+        :param deliver: function called from the collector thread with every decoded message (or list of messages of
+               a batch) and the trace passed to submit() as deliver(data, trace=trace). NUMPY messages are passed as
+               a dict of arrays.
+        :param processes: number of worker processes.
+        :param inline_size: messages smaller than this many bytes are decoded on the calling thread.
+        :param max_pending: maximum number of messages being decoded at the same time. submit() blocks while this
+               many are pending. Defaults to twice the number of processes.
+        :param verbose: Whether or not to print decoding errors.
+        :param as_daemon: runs the collector thread as daemon.
+        """
+        if processes < 1:
+            raise ValueError('the decode pool needs at least one process')
+        self.deliver = deliver
+        self.processes = processes
+        self.inline_size = inline_size
+        self.max_pending = max_pending or 2 * processes
+        self.verbose = verbose
+        self.offloaded_messages = 0
+        self.inline_messages = 0
+        self.errors = 0
+        self.closed = False
+        self._executor = ProcessPoolExecutor(processes)
+        self._pending = deque()  # type: deque[_Pending]
+        self._free_segments = {}  # unused shared memory segments by size
+        self._condition = Condition()
+        self._collector = Thread(target=self._collect, daemon=as_daemon)
+        self._collector.start()
+
+    def submit(self, data_mode, batched, codec, buf, trace=None):
+        """
+        Decode a message. The result is passed to deliver once all previously submitted messages were delivered.
+        :param data_mode: one of NUMPY, JSON, HDF.
+        :param batched: whether buf holds a batch.
+        :param codec: codec id from the frame header or None.
+        :param buf: bytes-like object holding the message. It is copied or decoded before submit() returns.
+        :param trace: DataSocket.Tracing.MessageTrace of the message or None. Released if the message can not be
+               decoded.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._pending) < self.max_pending or self.closed)
+            if self.closed:
+                return
+        size = len(buf)
+        if size < self.inline_size:
+            pending = self._decode_inline(data_mode, batched, codec, buf, trace)
+        else:
+            segment_size = _segment_size(size)
+            segment = self._segment(segment_size)
+            try:
+                if segment is not None:
+                    segment.buf[:size] = buf
+                    future = self._executor.submit(_decode, data_mode, batched, codec, segment.name, size,
+                                                   None)
+                else:
+                    future = self._executor.submit(_decode, data_mode, batched, codec, None, size,
+                                                   bytes(buf))
+            except BrokenProcessPool as e:  # a worker died, the pool takes no more messages
+                self.errors += 1
+                if self.verbose:
+                    print(e)
+                self._recycle(segment, segment_size)
+                self._replace_executor()
+                pending = self._decode_inline(data_mode, batched, codec, buf, trace)
+            except RuntimeError as e:  # the pool was shut down
+                if self.verbose:
+                    print(e)
+                self._recycle(segment, segment_size)
+                return
+            else:
+                self.offloaded_messages += 1
+                pending = _Pending(future, segment, segment_size, trace)
+        with self._condition:
+            self._pending.append(pending)
+            self._condition.notify_all()
+
+    def _decode_inline(self, data_mode, batched, codec, buf, trace):
+        future = Future()
+        try:
+            future.set_result(_decode(data_mode, batched, codec, None, len(buf), buf))
+        except (OSError, ValueError) as e:
+            future.set_exception(e)
+        self.inline_messages += 1
+        return _Pending(future, trace=trace)
+
+    def _replace_executor(self):
+        """
+        Start new worker processes in place of a pool that broke because one of its workers died. The messages the
+        broken pool was decoding fail and are counted as errors by the collector.
+        """
+        with self._condition:
+            if self.closed:
+                return
+            broken, self._executor = self._executor, ProcessPoolExecutor(self.processes)
+        broken.shutdown(wait=False)
+
+    def _segment(self, size):
+        if shared_memory is None:
+            return None
+        with self._condition:
+            free = self._free_segments.get(size)
+            if free:
+                return free.pop()
+        return shared_memory.SharedMemory(create=True, size=size)
+
+    def _recycle(self, segment, size):
+        if segment is None:
+            return
+        with self._condition:
+            if not self.closed:
+                free = self._free_segments.setdefault(size, [])
+                if len(free) < self.max_pending:
+                    free.append(segment)
+                    return
+        _remove_segment(segment)
+
+    def _collect(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self.closed)
+                if self.closed:
+                    return
+                pending = self._pending[0]
+            try:
+                data = pending.future.result()
+            except Exception as e:  # decoding errors and workers that died
+                self.errors += 1
+                if self.verbose:
+                    print(e)
+                data = None
+            with self._condition:
+                if self.closed:  # close() already cleaned up the pending messages
+                    return
+                self._pending.popleft()
+                self._condition.notify_all()
+            self._recycle(pending.segment, pending.segment_size)
+            if data is not None:
+                self.deliver(data, trace=pending.trace)
+            elif pending.trace is not None:
+                pending.trace.release()
+
+    def wait_idle(self, timeout=None):
+        """
+        Block until every submitted message was delivered.
+        :return: True if nothing is pending anymore.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending or self.closed, timeout)
+
+    def stats(self):
+        """
+        :return: dict with the number of messages decoded in worker processes and inline, pending messages and
+                 decoding errors.
+        """
+        with self._condition:
+            return {'offloaded_messages': self.offloaded_messages,
+                    'inline_messages': self.inline_messages,
+                    'pending': len(self._pending),
+                    'errors': self.errors}
+
+    def close(self):
+        """
+        Stop the worker processes and remove the shared memory segments. Pending messages are dropped.
+        """
+        with self._condition:
+            if self.closed:
+                return
+            self.closed = True
+            self._condition.notify_all()
+            segments = [segment for free in self._free_segments.values() for segment in free]
+            segments += [pending.segment for pending in self._pending if pending.segment is not None]
+            self._free_segments = {}
+            self._pending.clear()
+        self._collector.join(timeout=2)
+        try:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        except TypeError:  # python < 3.9
+            self._executor.shutdown(wait=True)
+        for segment in segments:
+            _remove_segment(segment)
+
+
+def _remove_segment(segment):
+    segment.close()
+    try:
+        segment.unlink()
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,180 @@
+"""
+Change-only encoding of ARRAY messages for streams that change little between messages (occupancy grids, calibration
+tables, status values).
+
+The sender keeps a copy of the last value sent for every key and sends only what changed since. Every message starts
+with a 9 byte little-endian header:
+
+    kind (1 byte), base state (uint32), state (uint32)
+
+followed by an ARRAY message (see DataSocket.ArrayFormat) for KEYFRAME and DELTA messages:
+
+    KEYFRAME    the complete data. Does not depend on anything the receiver got before.
+    DELTA       only the keys that changed since the message with the base state. A key changed in a few elements is
+                sent as '#key' (flat C order indices of the changed elements) and '+key' (their new values), a key
+                changed in many elements or in dtype or shape as '=key' (the new value).
+    UNCHANGED   nothing changed since the message with the base state. No payload.
+
+The state counts up by one per message, so a receiver can tell whether it holds the base state a delta applies to.
+"""
+import struct
+import numpy as np
+from .ArrayFormat import pack_arrays, unpack_arrays
+
+KEYFRAME = b'K'
+DELTA = b'D'
+UNCHANGED = b'U'
+HEADER = struct.Struct('<cII')
+
+_STATE_MASK = 0xFFFFFFFF
+_UNSIGNED = {1: np.uint8, 2: np.uint16, 4: np.uint32, 8: np.uint64}
+
+
+def _as_dict(data, extra):
+    """
+    :return: (whether a single value was sent, dict of C contiguous arrays)
+    """
+    single = not isinstance(data, dict)
+    items = {'data': data} if single else dict(data)
+    if extra:
+        items.update(extra)
+        single = False
+    return single, {str(key): np.asarray(value, order='C') for key, value in items.items()}
+
+
+def _changed_elements(previous, current):
+    """
+    :return: flat indices of the elements whose bytes differ. NaNs compare equal to themselves this way.
+    """
+    previous = previous.reshape(-1)
+    current = current.reshape(-1)
+    itemsize = current.dtype.itemsize
+    if itemsize in _UNSIGNED:
+        return np.flatnonzero(previous.view(_UNSIGNED[itemsize]) != current.view(_UNSIGNED[itemsize]))
+    previous = previous.view(np.uint8).reshape(-1, itemsize)
+    current = current.view(np.uint8).reshape(-1, itemsize)
+    return np.flatnonzero((previous != current).any(axis=1))
+
+
+class DeltaEncoder(object):
+    def __init__(self, keyframe_interval=100, delta_threshold=0.5):
+        """
+        Builds change-only messages for one stream.
+        :param keyframe_interval: a KEYFRAME is sent after this many messages even if deltas would be possible.
+        :param delta_threshold: a key whose changed elements make up more than this fraction of its size (counting
+               the bytes of indices and values) is sent in full instead of as changed elements.
+        """
+        if keyframe_interval < 1:
+            raise ValueError('keyframe_interval must be at least 1')
+        self.keyframe_interval = keyframe_interval
+        self.delta_threshold = delta_threshold
+        self.state = 0
+        self._previous = None  # type: dict[str, np.ndarray]
+        self._single = None
+        self._since_keyframe = 0
+
+    def pack(self, data, extra=None):
+        """
+        Convert data into the next message of the stream.
+        :param data: anything np.asarray() can convert or a dict of the same.
+        :param extra: optional dict of additional values (i.e. {'_time': time.time()}) to add to the message.
+        :return: (base state or None for a KEYFRAME, state, (size, buffers) of the message, (size, buffers) of a
+                 KEYFRAME of the same data for receivers that do not have the base state). The two are the same
+                 message for keyframes.
+        """
+        single, arrays = _as_dict(data, extra)
+        base = self.state
+        self.state = (self.state + 1) & _STATE_MASK
+        size, buffers = pack_arrays(arrays['data'] if single else arrays)
+        keyframe = (HEADER.size + size, [HEADER.pack(KEYFRAME, self.state, self.state)] + buffers)
+
+        changes = None
+        if self._previous is not None and single == self._single and arrays.keys() == self._previous.keys() and \
+                self._since_keyframe + 1 < self.keyframe_interval:
+            changes = self._changes(arrays)
+        # the arrays may be modified by the caller once they were sent
+        self._previous = {key: array.copy() for key, array in arrays.items()}
+        self._single = single
+        if changes is None:
+            self._since_keyframe = 0
+            return None, self.state, keyframe, keyframe
+        self._since_keyframe += 1
+        if not changes:
+            return base, self.state, (HEADER.size, [HEADER.pack(UNCHANGED, base, self.state)]), keyframe
+        size, buffers = pack_arrays(changes)
+        return base, self.state, (HEADER.size + size, [HEADER.pack(DELTA, base, self.state)] + buffers), keyframe
+
+    def _changes(self, arrays):
+        changes = {}
+        for key, array in arrays.items():
+            previous = self._previous[key]
+            if previous.dtype != array.dtype or previous.shape != array.shape:
+                changes['=' + key] = array
+                continue
+            changed = _changed_elements(previous, array)
+            if not len(changed):
+                continue
+            index_type = np.uint32 if array.size <= _STATE_MASK else np.int64
+            sparse_size = len(changed) * (np.dtype(index_type).itemsize + array.dtype.itemsize)
+            if sparse_size > self.delta_threshold * array.nbytes:
+                changes['=' + key] = array
+            else:
+                changes['#' + key] = changed.astype(index_type)
+                changes['+' + key] = array.reshape(-1)[changed]
+        return changes
+
+
+class DeltaDecoder(object):
+    def __init__(self):
+        """
+        Rebuilds the data from the messages of a DeltaEncoder. Used by the receiving side of one stream.
+        """
+        self.state = None
+        self._current = None  # type: dict[str, np.ndarray]
+        self._single = None
+
+    def unpack(self, buffer):
+        """
+        Rebuild the data from a message. The returned arrays are read only and C ordered, because unchanged arrays
+        are shared between consecutive messages.
+        :param buffer: bytes-like object holding one complete message.
+        :return: a numpy array if a single value was sent, otherwise a dict of numpy arrays.
+        """
+        kind, base, state = HEADER.unpack_from(buffer)
+        if kind == KEYFRAME:
+            data = unpack_arrays(memoryview(buffer)[HEADER.size:])
+            self._single = not isinstance(data, dict)
+            current = {'data': data} if self._single else data
+            current = {key: self._frozen(np.array(value, order='C')) for key, value in current.items()}
+        elif kind in (DELTA, UNCHANGED):
+            if self.state is None or base != self.state:
+                raise ValueError('delta message for state ' + str(base) + ' can not be applied to state ' +
+                                 str(self.state))
+            current = self._current
+            if kind == DELTA:
+                current = self._apply(unpack_arrays(memoryview(buffer)[HEADER.size:]))
+        else:
+            raise ValueError('unknown delta message kind ' + repr(kind))
+        self._current = current
+        self.state = state
+        if self._single:
+            return current['data']
+        return dict(current)
+
+    def _apply(self, changes):
+        # unchanged arrays are shared with the previous message, changed ones are copied before updating them
+        current = dict(self._current)
+        for name, value in changes.items():
+            kind, key = name[0], name[1:]
+            if kind == '=':
+                current[key] = self._frozen(np.array(value, order='C'))
+            elif kind == '#':
+                array = current[key].copy()
+                array.reshape(-1)[value] = changes['+' + key]
+                current[key] = self._frozen(array)
+        return current
+
+    @staticmethod
+    def _frozen(array):
+        array.setflags(write=False)
+        return array
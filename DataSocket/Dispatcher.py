@@ -0,0 +1,351 @@
+"""
+Delivery of received messages to any number of handlers. Every message is decoded once and handed to every
+subscription, and each subscription has its own execution policy, backlog and statistics, so a slow handler only
+affects its own messages.
+"""
+from threading import Thread, Condition, local
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import time
+from .SendQueue import BLOCK, DROP_NEWEST, LATEST, POLICIES
+from .Metrics import Histogram
+
+# execution policies
+INLINE = 1  # called on the receiving thread, which waits for the handler to return
+THREAD = 2  # called on a dedicated thread of the subscription
+POOL = 3  # called on the worker threads shared by all POOL subscriptions of a socket
+
+EXECUTION_POLICIES = (INLINE, THREAD, POOL)
+
+# ordering guarantees of POOL subscriptions (INLINE and THREAD subscriptions are always STRICT)
+STRICT = 1  # one message at a time in the order received
+PER_KEY = 2  # messages with the same order key one at a time in the order received, different keys in parallel
+UNORDERED = 3  # up to concurrency messages in parallel
+
+ORDERINGS = (STRICT, PER_KEY, UNORDERED)
+
+_handling = local()  # receive buffer of the message handled on the current thread
+
+
+def current_lease():
+    """
+    :return: the PooledBuffer holding the message currently handled on the calling thread or None.
+    """
+    return getattr(_handling, 'lease', None)
+
+
+class _Item(object):
+    __slots__ = ('messages', 'lease', 'as_list', 'lane', 'trace')
+
+    def __init__(self, messages, lease, as_list, lane=None, trace=None):
+        self.messages = messages
+        self.lease = lease
+        self.as_list = as_list
+        self.lane = lane
+        self.trace = trace
+
+
+class Subscription(object):
+    def __init__(self,
+                 handler,
+                 execution=THREAD,
+                 queue_size=1,
+                 queue_policy=LATEST,
+                 ordering=STRICT,
+                 order_key=None,
+                 concurrency=1,
+                 pool=None,
+                 verbose=True,
+                 as_daemon=True):
+        """
+        A handler registered with TCPReceiveSocket.subscribe().
+        :param handler: function called with every message.
+        :param execution: INLINE, THREAD or POOL.
+        :param queue_size: maximum number of messages waiting for the handler (THREAD and POOL).
+        :param queue_policy: what to do with a new message while queue_size messages are waiting. DataSocket.LATEST
+               only keeps the newest message, DROP_OLDEST and DROP_NEWEST discard the oldest waiting or the new
+               message, BLOCK holds up reception until there is room.
+        :param ordering: STRICT, PER_KEY or UNORDERED (POOL only).
+        :param order_key: with PER_KEY, the dict key whose value groups the messages, or a function returning the
+               group of a message.
+        :param concurrency: maximum number of messages handled at the same time (POOL only).
+        :param pool: concurrent.futures.Executor running POOL handlers.
+        :param verbose: Whether or not to print exceptions raised by the handler.
+        :param as_daemon: runs the THREAD of the subscription as daemon.
+        """
+        if not callable(handler):
+            raise ValueError("Handler function must be a callable function taking one input.")
+        if execution not in EXECUTION_POLICIES:
+            raise ValueError("execution must be one of INLINE, THREAD or POOL")
+        if queue_policy not in POLICIES:
+            raise ValueError("queue_policy must be one of BLOCK, DROP_OLDEST, DROP_NEWEST or LATEST")
+        if ordering not in ORDERINGS:
+            raise ValueError("ordering must be one of STRICT, PER_KEY or UNORDERED")
+        if ordering == PER_KEY and order_key is None:
+            raise ValueError("PER_KEY ordering needs an order_key")
+        if execution == POOL and pool is None:
+            raise ValueError("POOL execution needs a pool")
+        self.handler = handler
+        self.execution = execution
+        self.queue_size = 1 if queue_policy == LATEST else max(1, queue_size)
+        self.queue_policy = queue_policy
+        self.ordering = ordering if execution == POOL else STRICT
+        self.order_key = order_key
+        self.concurrency = max(1, concurrency) if self.ordering != STRICT else 1
+        self.verbose = verbose
+        self.closed = False
+        self.handled = 0
+        self.dropped = 0
+        self.errors = 0
+        self.high_water = 0
+        self.handler_time = Histogram()
+        self._pool = pool
+        self._backlog = deque()  # type: deque[_Item]
+        self._running = 0
+        self._busy_lanes = set()
+        self._condition = Condition()
+        self._thread = None
+        if execution == THREAD:
+            self._thread = Thread(target=self._run_thread, daemon=as_daemon)
+            self._thread.start()
+
+    @property
+    def name(self):
+        return getattr(self.handler, '__name__', repr(self.handler))
+
+    def deliver(self, messages, lease=None, as_list=False, trace=None):
+        """
+        Hand received messages to the subscription.
+        :param messages: list of decoded messages in the order received.
+        :param lease: PooledBuffer the messages point into or None. Retained until the messages were handled.
+        :param as_list: call the handler once with the list instead of once per message.
+        :param trace: DataSocket.Tracing.MessageTrace of the messages or None. Retained until the messages were
+               handled.
+        """
+        if self.closed:
+            return
+        if self.execution == INLINE:
+            self._handle(_Item(messages, lease, as_list, trace=trace))
+            return
+        if self.ordering == PER_KEY and not as_list:
+            # split into groups so messages of different keys can be handled in parallel
+            groups = {}
+            for message in messages:
+                groups.setdefault(self._key(message), []).append(message)
+            items = [_Item(group, lease, as_list, key, trace) for key, group in groups.items()]
+        else:
+            # UNORDERED items each get a lane of their own, STRICT ones all share the None lane
+            items = [_Item(messages, lease, as_list, None if self.ordering == STRICT else object(), trace)]
+        for item in items:
+            self._queue(item)
+
+    def _key(self, message):
+        if callable(self.order_key):
+            return self.order_key(message)
+        if isinstance(message, dict):
+            value = message.get(self.order_key)
+            try:
+                hash(value)
+            except TypeError:  # i.e. arrays
+                value = repr(value)
+            return value
+        return None
+
+    def _queue(self, item):
+        with self._condition:
+            if len(self._backlog) >= self.queue_size:
+                if self.queue_policy == DROP_NEWEST:
+                    self.dropped += len(item.messages)
+                    return
+                elif self.queue_policy == BLOCK:
+                    self._condition.wait_for(lambda: len(self._backlog) < self.queue_size or self.closed)
+                    if self.closed:
+                        return
+                else:
+                    self._drop(self._backlog.popleft())
+            if item.lease is not None:
+                item.lease.retain()
+            if item.trace is not None:
+                item.trace.retain()
+            self._backlog.append(item)
+            self.high_water = max(self.high_water, len(self._backlog))
+            self._condition.notify_all()
+            if self.execution == POOL:
+                self._schedule()
+
+    def _drop(self, item):
+        self.dropped += len(item.messages)
+        if item.lease is not None:
+            item.lease.release()
+        if item.trace is not None:
+            item.trace.release()
+
+    def _schedule(self):
+        # must be called holding _condition
+        while self._running < self.concurrency and not self.closed:
+            for index, item in enumerate(self._backlog):
+                if item.lane not in self._busy_lanes:
+                    break
+            else:
+                return  # everything waiting belongs to a busy lane
+            del self._backlog[index]
+            self._busy_lanes.add(item.lane)
+            self._running += 1
+            self._condition.notify_all()  # room in the backlog
+            self._pool.submit(self._run_pool_item, item)
+
+    def _run_pool_item(self, item):
+        try:
+            self._handle(item)
+        finally:
+            with self._condition:
+                self._busy_lanes.discard(item.lane)
+                self._running -= 1
+                self._condition.notify_all()
+                self._schedule()
+
+    def _run_thread(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._backlog or self.closed)
+                if self.closed:
+                    return
+                item = self._backlog.popleft()
+                self._running = 1
+                self._condition.notify_all()
+            try:
+                self._handle(item)
+            finally:
+                with self._condition:
+                    self._running = 0
+                    self._condition.notify_all()
+
+    def _handle(self, item):
+        _handling.lease = item.lease
+        try:
+            for message in ([item.messages] if item.as_list else item.messages):
+                start = time.perf_counter()
+                if item.trace is not None:
+                    started = time.time()
+                try:
+                    self.handler(message)
+                except Exception as e:
+                    self.errors += 1
+                    if self.verbose:
+                        print('handler', self.name, 'raised', repr(e))
+                self.handler_time.record(time.perf_counter() - start)
+                if item.trace is not None:
+                    item.trace.handled(started, time.time())
+                self.handled += 1
+        finally:
+            _handling.lease = None
+            if self.execution != INLINE:
+                if item.lease is not None:
+                    item.lease.release()
+                if item.trace is not None:
+                    item.trace.release()
+
+    def wait_idle(self, timeout=None):
+        """
+        Block until every delivered message was handled.
+        :param timeout: maximum time in seconds to wait. Waits indefinitely if None.
+        :return: True if the subscription is idle.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: (not self._backlog and not self._running) or self.closed,
+                                            timeout)
+
+    def stats(self):
+        """
+        :return: dict with the number of handled, dropped and waiting messages and a histogram of the time spent in
+                 the handler.
+        """
+        with self._condition:
+            return {'handler': self.name,
+                    'handled': self.handled,
+                    'dropped': self.dropped,
+                    'errors': self.errors,
+                    'backlog': len(self._backlog),
+                    'high_water': self.high_water,
+                    'running': self._running,
+                    'handler_seconds': self.handler_time.snapshot()}
+
+    def close(self, timeout=2):
+        """
+        Stop handling messages. Messages still waiting are dropped.
+        """
+        with self._condition:
+            self.closed = True
+            while self._backlog:
+                self._drop(self._backlog.popleft())
+            self._condition.notify_all()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout)
+
+
+class Dispatcher(object):
+    def __init__(self, worker_threads=4, verbose=True, as_daemon=True):
+        """
+        The subscriptions of a receiving socket.
+        :param worker_threads: number of threads shared by all POOL subscriptions. Started with the first one.
+        :param verbose: Whether or not to print exceptions raised by handlers.
+        :param as_daemon: runs the threads of THREAD subscriptions as daemon.
+        """
+        self.worker_threads = worker_threads
+        self.verbose = verbose
+        self.as_daemon = as_daemon
+        self.subscriptions = []  # type: list[Subscription]
+        self._pool = None
+
+    def subscribe(self, handler, execution=THREAD, queue_size=1, queue_policy=LATEST, ordering=STRICT,
+                  order_key=None, concurrency=1):
+        """
+        Register a handler. See Subscription for the parameters.
+        :return: Subscription
+        """
+        if execution == POOL and self._pool is None:
+            self._pool = ThreadPoolExecutor(self.worker_threads, thread_name_prefix='DataSocket-handler')
+        subscription = Subscription(handler, execution, queue_size, queue_policy, ordering, order_key, concurrency,
+                                    self._pool, self.verbose, self.as_daemon)
+        # replaced instead of appended so dispatch() can iterate without a lock
+        self.subscriptions = self.subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Remove a subscription. Messages still waiting for its handler are dropped.
+        """
+        self.subscriptions = [s for s in self.subscriptions if s is not subscription]
+        subscription.close()
+
+    def dispatch(self, messages, lease=None, as_list=False, trace=None):
+        """
+        Deliver messages to every subscription.
+        :param messages: list of decoded messages.
+        :param lease: PooledBuffer the messages point into or None.
+        :param as_list: call the handlers once with the list instead of once per message.
+        :param trace: DataSocket.Tracing.MessageTrace of the messages or None.
+        """
+        for subscription in self.subscriptions:
+            subscription.deliver(messages, lease, as_list, trace)
+
+    def stats(self):
+        """
+        :return: list with the stats() of every subscription.
+        """
+        return [subscription.stats() for subscription in self.subscriptions]
+
+    def handler_time(self):
+        """
+        :return: Histogram of the time spent in all handlers together.
+        """
+        total = Histogram()
+        for subscription in self.subscriptions:
+            total.merge(subscription.handler_time)
+        return total
+
+    def close(self):
+        for subscription in self.subscriptions:
+            subscription.close()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
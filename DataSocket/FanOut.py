@@ -0,0 +1,398 @@
+"""
+Selector driven event loop used by TCPSendSocket in server mode. A single thread accepts new receivers, detects
+disconnects and writes every message to all connected receivers with non-blocking sockets, so an idle server costs
+nothing and accepting many receivers does not need a thread each.
+"""
+from threading import Condition
+from collections import deque
+from socket import IPPROTO_TCP, TCP_NODELAY
+import selectors
+import time
+from .Waker import Waker
+from .Tracing import PingReader
+
+# maximum number of buffers handed to a single sendmsg call
+MAX_IOV = 512
+LISTEN_BACKLOG = 128
+_READ_SIZE = 65536
+# number of state entries remembered per receiver before starting over (see Client.select)
+_MAX_STATE = 1024
+
+# policies for receivers that can not keep up with the messages being sent
+BLOCK_ON_SLOW = 1  # the sender waits until every receiver got every message
+SKIP_TO_LATEST = 2  # messages not yet started for a lagging receiver are replaced by the newest message
+DISCONNECT_SLOW = 3  # receivers lagging more than max_lag_bytes or max_lag_seconds are disconnected
+
+SLOW_CONSUMER_POLICIES = (BLOCK_ON_SLOW, SKIP_TO_LATEST, DISCONNECT_SLOW)
+
+
+class Client(object):
+    def __init__(self, sock, address):
+        """
+        A connected receiver and everything still to be written to it.
+        :param sock: the connected socket.
+        :param address: address of the receiver.
+        """
+        self.socket = sock
+        self.address = address
+        self.connected = True
+        self.frames = deque()  # type: deque[deque[memoryview]]
+        self.pending_bytes = 0
+        self.sent_bytes = 0
+        self.sent_messages = 0
+        self.skipped_messages = 0
+        self.head_partial = False  # whether part of the first frame was already written
+        self._head_started = None  # time writing the first frame started
+        self._head_written = 0  # bytes of the first frame written so far
+        self.writing = False  # whether the socket is registered for write events
+        self.state = {}  # what the messages queued for this receiver left behind on its side (see select)
+        self.pings = PingReader()
+        self._lag_since = None
+
+    @property
+    def lag_seconds(self):
+        """
+        How long this receiver has had messages waiting to be written.
+        """
+        if self._lag_since is None:
+            return 0.0
+        return time.monotonic() - self._lag_since
+
+    def stats(self):
+        """
+        :return: dict describing how far behind this receiver is and how much was sent to it.
+        """
+        return {'address': self.address,
+                'connected': self.connected,
+                'pending_messages': len(self.frames),
+                'pending_bytes': self.pending_bytes,
+                'lag_seconds': self.lag_seconds,
+                'sent_messages': self.sent_messages,
+                'sent_bytes': self.sent_bytes,
+                'skipped_messages': self.skipped_messages}
+
+    def select(self, buffers, dependencies=None):
+        """
+        Choose which encoding of a message this receiver needs. Messages may depend on state that earlier messages
+        built up on the receiving side, i.e. cached ARRAY schemas or the previous value for delta encoding.
+        :param buffers: list of bytes-like objects making up the message.
+        :param dependencies: None or (state the message requires, state it leaves behind, buffers of the same message
+               that do not require anything). States are dicts compared and updated key by key.
+        :return: buffers if everything the message requires was sent to the receiver, otherwise the buffers of the
+                 message that does not require anything.
+        """
+        if dependencies is None:
+            return buffers
+        requires, provides, standalone_buffers = dependencies
+        if all(self.state.get(key) == value for key, value in requires.items()):
+            selected = buffers
+        else:
+            selected = standalone_buffers
+        if len(self.state) > _MAX_STATE:
+            self.state.clear()
+        self.state.update(provides)
+        return selected
+
+    def queue(self, buffers):
+        """
+        Queue a message for writing.
+        :param buffers: list of bytes-like objects making up the message.
+        """
+        frame = deque(memoryview(buffer).cast('B') for buffer in buffers if len(buffer))
+        if not frame:
+            return
+        if self._lag_since is None:
+            self._lag_since = time.monotonic()
+        self.frames.append(frame)
+        self.pending_bytes += sum(len(view) for view in frame)
+
+    def queue_next(self, buffers):
+        """
+        Queue a small message to be written right after the message currently being written, ahead of all others.
+        :param buffers: list of bytes-like objects making up the message.
+        """
+        frame = deque(memoryview(buffer).cast('B') for buffer in buffers if len(buffer))
+        if not frame:
+            return
+        if self._lag_since is None:
+            self._lag_since = time.monotonic()
+        self.frames.insert(1 if self.head_partial else 0, frame)
+        self.pending_bytes += sum(len(view) for view in frame)
+
+    def skip_queued(self):
+        """
+        Drop every queued message that was not started yet. A partially written message has to be completed to keep
+        the stream intact.
+        """
+        keep = 1 if self.head_partial else 0
+        if len(self.frames) > keep:
+            # later messages may depend on the skipped ones
+            self.state.clear()
+        while len(self.frames) > keep:
+            frame = self.frames.pop()
+            self.pending_bytes -= sum(len(view) for view in frame)
+            self.skipped_messages += 1
+
+    def write(self, observe_send=None):
+        """
+        Write as much of the queued messages as the socket accepts without blocking.
+        :param observe_send: optional function called as observe_send(nbytes, seconds) for every message that was
+               completely written, with the time since writing it started.
+        :return: number of bytes written.
+        """
+        written = 0
+        while self.frames:
+            iov = []
+            for frame in self.frames:
+                iov.extend(frame)
+                if len(iov) >= MAX_IOV:
+                    break
+            started = time.perf_counter()
+            try:
+                if hasattr(self.socket, 'sendmsg'):
+                    sent = self.socket.sendmsg(iov[:MAX_IOV])
+                else:  # i.e. windows
+                    sent = self.socket.send(iov[0])
+            except (BlockingIOError, InterruptedError):
+                break
+            written += sent
+            self._advance(sent, started, observe_send)
+        return written
+
+    def _advance(self, sent, started, observe_send):
+        self.pending_bytes -= sent
+        self.sent_bytes += sent
+        while sent:
+            if not self.head_partial:
+                self._head_started = started
+                self._head_written = 0
+            frame = self.frames[0]
+            view = frame[0]
+            if sent >= len(view):
+                sent -= len(view)
+                self._head_written += len(view)
+                frame.popleft()
+                if not frame:
+                    self.frames.popleft()
+                    self.sent_messages += 1
+                    self.head_partial = False
+                    if observe_send is not None:
+                        observe_send(self._head_written, time.perf_counter() - self._head_started)
+                    if not self.frames:
+                        self._lag_since = None
+                else:
+                    self.head_partial = True
+            else:
+                frame[0] = view[sent:]
+                self._head_written += sent
+                self.head_partial = True
+                sent = 0
+
+
+class FanOut(object):
+    def __init__(self,
+                 listening_socket,
+                 handshake=None,
+                 verbose=True,
+                 slow_consumer_policy=BLOCK_ON_SLOW,
+                 max_lag_bytes=None,
+                 max_lag_seconds=None,
+                 metrics=None,
+                 answer_ping=None,
+                 observe_send=None):
+        """
+        :param listening_socket: a bound socket to accept receivers on.
+        :param handshake: bytes sent to every receiver right after it connected.
+        :param verbose: Whether or not to print errors and status messages.
+        :param slow_consumer_policy: one of BLOCK_ON_SLOW, SKIP_TO_LATEST, DISCONNECT_SLOW.
+        :param max_lag_bytes: DISCONNECT_SLOW disconnects receivers with more bytes than this waiting to be written.
+        :param max_lag_seconds: DISCONNECT_SLOW disconnects receivers that had data waiting for longer than this.
+        :param metrics: DataSocket.Metrics.Metrics counting accepted and disconnected receivers.
+        :param answer_ping: function returning the buffers of the answer to a clock ping of a receiver as
+               answer_ping(ping time, arrival time), if receivers may send pings (see DataSocket.Tracing).
+        :param observe_send: optional function called from the event loop as observe_send(nbytes, seconds) for every
+               message completely written to a receiver, with the time since writing it started (i.e.
+               Compressor.observe_send).
+        """
+        if slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError("slow_consumer_policy must be one of BLOCK_ON_SLOW, SKIP_TO_LATEST or DISCONNECT_SLOW")
+        self.socket = listening_socket
+        self.handshake = handshake
+        self.verbose = verbose
+        self.slow_consumer_policy = slow_consumer_policy
+        self.max_lag_bytes = max_lag_bytes
+        self.max_lag_seconds = max_lag_seconds
+        self.metrics = metrics
+        self.answer_ping = answer_ping
+        self.observe_send = observe_send
+        self.clients = []  # type: list[Client]
+        self.closed = False
+        self._condition = Condition()
+        self._waker = Waker()
+        self._selector = selectors.DefaultSelector()
+
+    def publish(self, buffers, dependencies=None):
+        """
+        Queue a message for every connected receiver. The message is serialized once and shared between receivers.
+        :param buffers: list of bytes-like objects making up the message.
+        :param dependencies: None or what the message depends on (see Client.select).
+        """
+        with self._condition:
+            for client in self.clients:
+                if self.slow_consumer_policy == SKIP_TO_LATEST:
+                    client.skip_queued()
+                client.queue(client.select(buffers, dependencies))
+        self._waker.wake()
+
+    def wait_sent(self, timeout=None, skip_lagging=False):
+        """
+        Block until every queued message was written to all connected receivers.
+        :param timeout: maximum time in seconds to wait. Waits indefinitely if None.
+        :param skip_lagging: do not wait for receivers whose socket did not take all data the last time it was
+               written to, i.e. stalled receivers the slow consumer policy lets fall behind.
+        :return: True if everything was written.
+        """
+        with self._condition:
+            clients = [client for client in self.clients if not (skip_lagging and client.writing)]
+            return self._condition.wait_for(lambda: self.closed or not any(c.frames for c in clients), timeout)
+
+    def wake(self):
+        self._waker.wake()
+
+    def run(self, stop_event):
+        """
+        Run the event loop until stop_event is set and wake() was called.
+        """
+        self.socket.setblocking(False)
+        self.socket.listen(LISTEN_BACKLOG)
+        self._selector.register(self.socket, selectors.EVENT_READ)
+        self._selector.register(self._waker, selectors.EVENT_READ)
+        try:
+            while not stop_event.is_set():
+                for key, events in self._selector.select(self._select_timeout()):
+                    if key.fileobj is self.socket:
+                        self._accept()
+                    elif key.fileobj is self._waker:
+                        self._waker.clear()
+                    else:
+                        if events & selectors.EVENT_READ and not self._check_connected(key.data):
+                            continue
+                        if events & selectors.EVENT_WRITE:
+                            self._write(key.data)
+                self._start_writes()
+                if self.slow_consumer_policy == DISCONNECT_SLOW:
+                    self._disconnect_lagging()
+        finally:
+            self._close()
+
+    def _select_timeout(self):
+        # lagging receivers have to be checked even when nothing else happens
+        if self.slow_consumer_policy == DISCONNECT_SLOW and self.max_lag_seconds is not None:
+            if any(client.frames for client in self.clients):
+                return self.max_lag_seconds / 2
+        return None
+
+    def _disconnect_lagging(self):
+        for client in list(self.clients):
+            if (self.max_lag_bytes is not None and client.pending_bytes > self.max_lag_bytes) or \
+                    (self.max_lag_seconds is not None and client.lag_seconds > self.max_lag_seconds):
+                if self.verbose:
+                    print('disconnecting slow receiver', client.address)
+                self._disconnect(client)
+
+    def _accept(self):
+        while True:
+            try:
+                connection, address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                if self.verbose:
+                    print(e)
+                return
+            try:
+                connection.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            except OSError:
+                pass  # not a TCP socket
+            if self.handshake is not None:
+                # a few bytes always fit into the empty buffer of a new connection. Sending them right away keeps
+                # them from being skipped by the slow consumer policy
+                try:
+                    connection.sendall(self.handshake)
+                except OSError as e:
+                    if self.verbose:
+                        print(e)
+                    connection.close()
+                    continue
+            connection.setblocking(False)
+            client = Client(connection, address)
+            with self._condition:
+                self.clients.append(client)
+            self._selector.register(connection, selectors.EVENT_READ, client)
+            if self.metrics is not None:
+                self.metrics.connections += 1
+
+    def _check_connected(self, client):
+        # receivers only ever send clock pings, so a socket that is readable without data means the receiver went away
+        try:
+            data = client.socket.recv(_READ_SIZE)
+            if data:
+                if self.answer_ping is not None:
+                    arrived = time.time()
+                    with self._condition:
+                        for pinged in client.pings.feed(data):
+                            client.queue_next(self.answer_ping(pinged, arrived))
+                return True
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError as e:
+            if self.verbose:
+                print(e)
+        self._disconnect(client)
+        return False
+
+    def _write(self, client):
+        with self._condition:
+            try:
+                client.write(self.observe_send)
+            except OSError as e:
+                if self.verbose:
+                    print(e)
+                self._disconnect(client)
+                return
+            if not client.frames:
+                self._condition.notify_all()
+        if not client.frames and client.writing:
+            self._selector.modify(client.socket, selectors.EVENT_READ, client)
+            client.writing = False
+
+    def _start_writes(self):
+        for client in list(self.clients):
+            if client.frames and not client.writing and client.connected:
+                self._write(client)
+                if client.frames and client.connected:
+                    self._selector.modify(client.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+                    client.writing = True
+
+    def _disconnect(self, client):
+        with self._condition:
+            if client.connected:
+                client.connected = False
+                client.frames.clear()
+                client.pending_bytes = 0
+                client._lag_since = None
+                self.clients.remove(client)
+                self._selector.unregister(client.socket)
+                client.socket.close()
+                if self.metrics is not None:
+                    self.metrics.disconnects += 1
+            self._condition.notify_all()
+
+    def _close(self):
+        for client in list(self.clients):
+            self._disconnect(client)
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+        self._selector.close()
+        self._waker.close()
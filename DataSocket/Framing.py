@@ -0,0 +1,136 @@
+"""
+Message framing on the TCP stream.
+
+Right after connecting, the sending side writes a 4 byte little-endian handshake:
+
+    bits 0-7    send type (NUMPY, JSON, HDF, RAW, ARRAY, BINARY)
+    bit 8       BATCHED, every message is a batch of messages
+    bit 9       SHARED_MEMORY, messages are passed through a shared memory ring (see DataSocket.SharedMemoryRing). The
+                handshake is followed by the length of the segment name (uint16) and the name.
+    bit 10      SCHEMAS, ARRAY messages refer to cached schemas (see DataSocket.ArrayFormat.SchemaEncoder)
+    bit 11      DELTAS, ARRAY messages only carry changes (see DataSocket.DeltaEncoding)
+    bit 12      TRACE, frames carry trace stamps and the sender answers clock pings (see DataSocket.Tracing)
+    bits 16-23  frame version. 0 for the original format
+
+Frame version 0 (the original format, also used by the matlab sockets) puts the payload size as 4 byte little-endian
+unsigned integer in front of every message. Frame version 2 uses a 32 byte little-endian header instead:
+
+    version (uint8), codec id (uint8), flags (uint16), metadata size (uint32), payload size (uint64),
+    sequence number (uint64), send time (float64)
+
+followed by the metadata and the payload. The header is always written in the same system call as the payload.
+Frames with FLAG_TRACE carry the trace stamps of the message as metadata. FLAG_PONG frames have no payload and answer
+a clock ping of the receiver (see DataSocket.Tracing); they are not messages and have sequence number 0.
+"""
+import struct
+import time
+from collections import namedtuple
+from .Serialization import BATCHED, SEND_TYPE_MASK
+from .Codecs import NONE, is_compressed, ENVELOPE_SIZE
+
+LEGACY_FRAMES = 0
+FRAME_V2 = 2
+FRAME_VERSIONS = (LEGACY_FRAMES, FRAME_V2)
+
+# frame flags
+FLAG_BATCH = 0x1
+FLAG_TRACE = 0x2
+FLAG_PONG = 0x4
+
+# handshake flags
+SHARED_MEMORY = 0x200
+SCHEMAS = 0x400
+DELTAS = 0x800
+TRACE = 0x1000
+
+HANDSHAKE = struct.Struct('<I')
+NAME_LENGTH = struct.Struct('<H')
+LEGACY_HEADER = struct.Struct('<I')
+HEADER = struct.Struct('<BBHIQQd')
+_VERSION_SHIFT = 16
+
+FrameHeader = namedtuple('FrameHeader', ['version', 'codec', 'flags', 'metadata_size', 'size', 'sequence', 'time'])
+Handshake = namedtuple('Handshake', ['send_type', 'batched', 'frame_version', 'shared_memory', 'schemas', 'deltas',
+                                     'trace'])
+
+
+def handshake(send_type, batched=False, frame_version=LEGACY_FRAMES, shared_memory_name=None, schemas=False,
+              deltas=False, trace=False):
+    """
+    :return: the handshake bytes announcing the send type, batching, frame version, shared memory segment, schema
+             caching, delta encoding and tracing.
+    """
+    value = send_type
+    if batched:
+        value |= BATCHED
+    if schemas:
+        value |= SCHEMAS
+    if deltas:
+        value |= DELTAS
+    if trace:
+        value |= TRACE
+    value |= frame_version << _VERSION_SHIFT
+    if shared_memory_name is None:
+        return HANDSHAKE.pack(value)
+    name = shared_memory_name.encode()
+    return HANDSHAKE.pack(value | SHARED_MEMORY) + NAME_LENGTH.pack(len(name)) + name
+
+
+def parse_handshake(buffer):
+    """
+    :return: Handshake. If shared_memory is True, the segment name follows.
+    """
+    value = HANDSHAKE.unpack(bytes(buffer))[0]
+    return Handshake(value & SEND_TYPE_MASK, bool(value & BATCHED), (value >> _VERSION_SHIFT) & 0xFF,
+                     bool(value & SHARED_MEMORY), bool(value & SCHEMAS), bool(value & DELTAS), bool(value & TRACE))
+
+
+def parse_header(buffer):
+    """
+    :param buffer: the HEADER.size bytes of a version 2 frame header.
+    :return: FrameHeader
+    """
+    return FrameHeader(*HEADER.unpack(bytes(buffer)))
+
+
+class FrameWriter(object):
+    def __init__(self, frame_version=LEGACY_FRAMES):
+        """
+        Builds the frames for one stream and numbers them.
+        :param frame_version: LEGACY_FRAMES or FRAME_V2.
+        """
+        if frame_version not in FRAME_VERSIONS:
+            raise ValueError("frame_version must be LEGACY_FRAMES or FRAME_V2")
+        self.frame_version = frame_version
+        self.sequence = 0
+
+    def frame(self, size, payload, flags=0, metadata=b'', now=None, sequence=None):
+        """
+        Put a header in front of a payload.
+        :param size: size of the payload in bytes.
+        :param payload: bytes-like object or list of buffers as returned by encode().
+        :param flags: frame flags (version 2 only).
+        :param metadata: additional bytes sent between header and payload (version 2 only).
+        :param now: send time. Uses time.time() if None (version 2 only).
+        :param sequence: sequence number of an already framed message, to frame another encoding of the same message.
+               The next sequence number is used if None (version 2 only).
+        :return: list of buffers making up the frame.
+        """
+        buffers = list(payload) if isinstance(payload, list) else [payload]
+        if sequence is None:
+            self.sequence += 1
+            sequence = self.sequence
+        if self.frame_version == LEGACY_FRAMES:
+            return [LEGACY_HEADER.pack(size)] + buffers
+        codec = NONE
+        if len(buffers) == 1 and is_compressed(buffers[0]):
+            # the codec goes into the header instead of the payload envelope
+            codec = buffers[0][ENVELOPE_SIZE - 1]
+            buffers = [memoryview(buffers[0])[ENVELOPE_SIZE:]]
+            size -= ENVELOPE_SIZE
+        if now is None:
+            now = time.time()
+        header = HEADER.pack(FRAME_V2, codec, flags, len(metadata), size, sequence, now)
+        if metadata:
+            return [header, metadata] + buffers
+        return [header] + buffers
@@ -0,0 +1,143 @@
+"""
+Counters and latency histograms of the sockets, returned by their stats() method.
+
+Histograms count durations in buckets growing by powers of two from 1 µs to several minutes, so recording a duration
+is one float decomposition and one increment and percentiles are exact to within a factor of two.
+"""
+import math
+import time
+from threading import Thread, Event, current_thread
+
+_SMALLEST_EXPONENT = -20  # the first bucket holds durations below 2 ** -20 s (about 1 µs)
+_BUCKETS = 40
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'count', 'total', 'maximum')
+
+    def __init__(self):
+        self.counts = [0] * _BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def record(self, seconds):
+        """
+        :param seconds: duration to add.
+        """
+        index = math.frexp(seconds)[1] - _SMALLEST_EXPONENT if seconds > 0 else 0
+        self.counts[min(max(index, 0), _BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+    def merge(self, other):
+        """
+        Add the durations recorded by another histogram.
+        """
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+
+    def percentile(self, fraction):
+        """
+        :param fraction: i.e. 0.99 for the 99th percentile.
+        :return: upper bound in seconds of the bucket holding the percentile or None if nothing was recorded.
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(2.0 ** (index + _SMALLEST_EXPONENT), self.maximum)
+        return self.maximum
+
+    def snapshot(self):
+        """
+        :return: dict with count, mean, p50, p90, p99 and max in seconds.
+        """
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.percentile(0.5),
+                'p90': self.percentile(0.9),
+                'p99': self.percentile(0.99),
+                'max': self.maximum if self.count else None}
+
+
+class Metrics(object):
+    def __init__(self, histograms):
+        """
+        Counters of a socket.
+        :param histograms: names of the durations recorded, i.e. ('encode', 'write').
+        """
+        self.started = time.monotonic()
+        self.messages = 0
+        self.bytes = 0
+        self.errors = 0  # messages that could not be encoded, sent or decoded
+        self.connections = 0  # connections established or accepted
+        self.disconnects = 0
+        self.histograms = {name: Histogram() for name in histograms}
+
+    def count(self, nbytes, messages=1):
+        self.messages += messages
+        self.bytes += nbytes
+
+    def record(self, name, seconds):
+        self.histograms[name].record(seconds)
+
+    def snapshot(self):
+        """
+        :return: dict with the counters, average rates since the socket was created and a snapshot of every
+                 histogram.
+        """
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        stats = {'elapsed_seconds': elapsed,
+                 'messages': self.messages,
+                 'bytes': self.bytes,
+                 'messages_per_second': self.messages / elapsed,
+                 'bytes_per_second': self.bytes / elapsed,
+                 'errors': self.errors,
+                 'connections': self.connections,
+                 'disconnects': self.disconnects,
+                 'reconnects': max(0, self.connections - 1)}
+        for name, histogram in self.histograms.items():
+            stats[name + '_seconds'] = histogram.snapshot()
+        return stats
+
+
+class MetricsReporter(object):
+    def __init__(self, stats, callback, interval=1.0, as_daemon=True):
+        """
+        Calls callback(stats()) every interval seconds from a thread of its own.
+        :param stats: function returning the stats of a socket.
+        :param callback: function taking the stats dict.
+        :param interval: time in seconds between calls.
+        :param as_daemon: runs the thread as daemon.
+        """
+        if not callable(callback):
+            raise ValueError("metrics_callback must be a callable function taking one input.")
+        self.stats = stats
+        self.callback = callback
+        self.interval = interval
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=as_daemon)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.callback(self.stats())
+            except Exception as e:
+                print('metrics_callback raised', repr(e))
+
+    def stop(self):
+        self._stop.set()
+        # stop() may be called from inside the callback
+        if self._thread.is_alive() and self._thread is not current_thread():
+            self._thread.join(timeout=2)
@@ -0,0 +1,412 @@
+"""
+Recording of TCP streams and replay of the recordings without decoding or encoding a single message.
+
+StreamRecorder connects to a TCPSendSocket like a TCPReceiveSocket does (or taps it next to the other receivers when
+the sender runs as a server) and receives every frame straight into a memory-mapped log. A recording is a directory:
+
+    stream.json     send type, batching, frame version, schema caching and delta encoding of the stream
+    000000.frames   the frames as they came in: frame header, metadata and payload
+    000000.index    one INDEX record per frame: arrival time, sequence number, offset and size
+    000001.frames   ... a new segment is started once a frame does not fit into the current one
+
+Messages sent through shared memory are copied out of the ring into the log, so recorded frames always carry the
+message itself. Legacy frames have no sequence number, they are numbered by the recorder starting at 1.
+
+StreamReplayer reads a recording and hands the payloads to a TCPSendSocket or UDPSendSocket as DataSocket.Encoded
+messages, which the sockets send as they are.
+"""
+import errno
+import json
+import mmap
+import os
+import struct
+import time
+import numpy as np
+from .Serialization import RAW, Encoded
+from .Codecs import NONE, ENVELOPE_SIZE, envelope
+from .Framing import FRAME_V2, FLAG_BATCH, FLAG_PONG, HEADER, LEGACY_HEADER, parse_header
+from .SharedMemoryRing import DESCRIPTOR, SLOT_MESSAGE
+from .SendQueue import BLOCK
+from .TCPDataSocket import TCPReceiveSocket, _shutdown, _MAX_RETRY_DELAY
+
+STREAM_FILE = 'stream.json'
+FRAMES_SUFFIX = '.frames'
+INDEX_SUFFIX = '.index'
+
+# time (receiver clock), sequence number, offset of the frame in the segment, payload size, size of frame header and
+# metadata, frame flags, codec id of the payload (version 2 frames only)
+INDEX = np.dtype([('time', '<f8'), ('sequence', '<u8'), ('offset', '<u8'), ('size', '<u8'), ('header_size', '<u4'),
+                  ('flags', '<u2'), ('codec', 'u1'), ('reserved', 'u1')])
+_RECORD = struct.Struct('<dQQQIHBx')
+
+REPLAY_QUEUE_SIZE = 64
+_NOT_SUPPORTED = (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS)  # by the file system
+
+
+def _segment_name(path, number):
+    return os.path.join(path, '{:06d}'.format(number))
+
+
+def _allocate(fd, size):
+    # reserve the disk space up front, so a full disk fails here and not on a write to the memory map, which would
+    # crash the process
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            if e.errno not in _NOT_SUPPORTED:
+                raise
+    os.ftruncate(fd, size)
+
+
+class _Segment(object):
+    def __init__(self, path, number, size):
+        """
+        A frames file of the recording, memory-mapped for writing, and its index.
+        :param size: size of the memory map in bytes. The file is cut to the used size when closed.
+        """
+        name = _segment_name(path, number)
+        self.file = open(name + FRAMES_SUFFIX, 'w+b')
+        _allocate(self.file.fileno(), size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.view = memoryview(self.map)
+        self.index = open(name + INDEX_SUFFIX, 'wb')
+        self.size = size
+        self.used = 0
+
+    def reserve(self, nbytes):
+        """
+        :return: writable view of the next nbytes bytes or None if they do not fit.
+        """
+        if self.used + nbytes > self.size:
+            return None
+        return self.view[self.used:self.used + nbytes]
+
+    def commit(self, received, sequence, header_size, size, flags, codec):
+        """
+        Add the frame written into the last reserved view.
+        """
+        self.index.write(_RECORD.pack(received, sequence, self.used, size, header_size, flags, codec))
+        self.used += header_size + size
+
+    def close(self):
+        self.index.close()
+        self.view.release()
+        self.map.close()
+        self.file.truncate(self.used)
+        self.file.close()
+
+
+class StreamRecorder(TCPReceiveSocket):
+    def __init__(self,
+                 path,
+                 tcp_port,
+                 tcp_ip='localhost',
+                 as_server=False,
+                 segment_size=1 << 30,
+                 verbose=True,
+                 as_daemon=True,
+                 metrics_callback=None,
+                 metrics_interval=1.0):
+        """
+        Records the frames of a TCPSendSocket into a directory without decoding them, so recording keeps up with
+        whatever the connection carries. Takes the place of a TCPReceiveSocket, or connects to a sender running as
+        server next to its other receivers. RAW streams can not be recorded because they have no frames.
+        If the sender reconnects, recording continues as long as the stream format stays the same.
+        :param path: directory of the recording. Created if it does not exist and must not hold a recording yet.
+        :param tcp_port: TCP port to use. Ignored for unix domain sockets.
+        :param tcp_ip: ip address to connect to or 'unix:///path/to/file' for a unix domain socket.
+        :param as_server: Whether to run this socket as a server or client (default). This needs to be opposite
+               whatever the SendSocket is configured to be.
+        :param segment_size: size in bytes of the frames files. The disk space of a segment is reserved when it is
+               started. Frames larger than this get a segment of their own.
+        :param verbose: Whether or not to print errors and status messages.
+        :param as_daemon: runs underlying threads as daemon.
+        :param metrics_callback: optional function called with stats() every metrics_interval seconds from a thread
+               of its own.
+        :param metrics_interval: time in seconds between calls of metrics_callback.
+        """
+        if os.path.exists(os.path.join(path, STREAM_FILE)):
+            raise FileExistsError(path + ' already holds a recording')
+        os.makedirs(path, exist_ok=True)
+        super(StreamRecorder, self).__init__(tcp_port, tcp_ip=tcp_ip, verbose=verbose, as_server=as_server,
+                                             as_daemon=as_daemon, metrics_callback=metrics_callback,
+                                             metrics_interval=metrics_interval)
+        self.path = path
+        self.segment_size = segment_size
+        self.stream = None  # format of the recorded stream as written to stream.json
+        self.segments = 0
+        self._segment = None  # type: _Segment
+        self._sequence = 0  # number of the last legacy frame
+        self._descriptor = bytearray(DESCRIPTOR.size)
+
+    def stop(self):
+        """
+        Stop recording and close the recording files.
+        """
+        super(StreamRecorder, self).stop()
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+    def stats(self):
+        """
+        Snapshot of what the recorder did so far: frames (messages) and bytes recorded, connections, messages missed
+        because they were overwritten in shared memory before they were copied, the number of segments and a
+        histogram of the time spent receiving a frame after its header arrived (read_seconds).
+        :return: dict
+        """
+        stats = self.metrics.snapshot()
+        stats['missed_messages'] = self.missed_messages
+        stats['segments'] = self.segments
+        return stats
+
+    def _accept_stream(self):
+        """
+        Check the handshake of a new connection and start the recording with the first one.
+        :return: False if the stream can not be recorded (into this recording).
+        """
+        handshake = self._handshake
+        stream = {'send_type': handshake.send_type,
+                  'batched': handshake.batched,
+                  'frame_version': handshake.frame_version,
+                  'schemas': handshake.schemas,
+                  'deltas': handshake.deltas}
+        if handshake.send_type == RAW:
+            problem = 'RAW streams can not be recorded'
+        elif self.stream is not None and stream != self.stream:
+            problem = 'the sender changed the stream format, it is not recorded into the same recording'
+        else:
+            if self.stream is None:
+                self.stream = stream
+                with open(os.path.join(self.path, STREAM_FILE), 'w') as f:
+                    json.dump(dict(stream, created=time.time()), f, indent=1)
+            return True
+        if self.verbose:
+            print(problem)
+        _shutdown(self.connection)
+        self.is_connected = False
+        self.shut_down_flag.wait(_MAX_RETRY_DELAY)
+        return False
+
+    def _reserve(self, nbytes):
+        view = None if self._segment is None else self._segment.reserve(nbytes)
+        if view is None:
+            if self._segment is not None:
+                self._segment.close()
+            self._segment = _Segment(self.path, self.segments, max(self.segment_size, nbytes))
+            self.segments += 1
+            view = self._segment.reserve(nbytes)
+        return view
+
+    def _receive_data(self):
+        self._initialize()
+        if self.as_server:
+            try:
+                self.connection.setblocking(True)
+            except AttributeError as e:
+                self.is_connected = False
+        if not self.is_connected or not self._accept_stream():
+            return
+        while self.is_connected and not self.shut_down_flag.is_set():
+            try:
+                if not self._record_frame():
+                    return
+            except OSError as e:  # the disk is full or the recording directory went away
+                self.metrics.errors += 1
+                if self.verbose:
+                    print(e)
+                self.shut_down_flag.set()
+                return
+
+    def _record_frame(self):
+        """
+        Receive one frame into the recording.
+        :return: False if the connection was closed.
+        """
+        header = None
+        metadata = b''
+        if self.frame_version == FRAME_V2:
+            buf = memoryview(self._frame_header)[:HEADER.size]
+            if not self._receive_into(buf):
+                return False
+            received = time.time()
+            header = parse_header(buf)
+            if header.metadata_size:
+                metadata = bytearray(header.metadata_size)
+                if not self._receive_into(memoryview(metadata)):
+                    return False
+            if header.flags & FLAG_PONG:  # no clock pings are sent, but they are not messages either
+                return True
+            size = header.size
+            sequence = header.sequence
+        else:
+            buf = memoryview(self._frame_header)[:LEGACY_HEADER.size]
+            if not self._receive_into(buf):
+                return False
+            received = time.time()
+            size = LEGACY_HEADER.unpack(buf)[0]
+            self._sequence += 1
+            sequence = self._sequence
+        start = time.perf_counter()
+
+        slot = None
+        if self._shared_memory is not None:
+            descriptor = memoryview(self._descriptor)
+            if not self._receive_into(descriptor[:1]):
+                return False
+            size -= 1  # inline messages follow the kind of the message
+            if bytes(descriptor[:1]) == SLOT_MESSAGE:
+                if not self._receive_into(descriptor[1:]):
+                    return False
+                slot = DESCRIPTOR.unpack(descriptor)[1]
+                size = self._shared_memory.message_size(slot)
+                if size is None:
+                    self.missed_messages += 1
+                    return True
+
+        header_size = len(buf) + len(metadata)
+        view = self._reserve(header_size + size)
+        # the header is written anew, because shared memory messages are recorded without their descriptor
+        if header is None:
+            LEGACY_HEADER.pack_into(view, 0, size)
+            flags = codec = 0
+        else:
+            HEADER.pack_into(view, 0, header.version, header.codec, header.flags, header.metadata_size, size,
+                             header.sequence, header.time)
+            view[len(buf):header_size] = metadata
+            flags, codec = header.flags, header.codec
+        if slot is None:
+            if not self._receive_into(view[header_size:]):
+                return False
+        elif not self._shared_memory.read_into(slot, view[header_size:]):
+            self.missed_messages += 1
+            return True
+        self._segment.commit(received, sequence, header_size, size, flags, codec)
+        self.metrics.count(header_size + size)
+        self.metrics.record('read', time.perf_counter() - start)
+        return True
+
+
+class StreamReplayer(object):
+    def __init__(self, path):
+        """
+        Reads a recording made by StreamRecorder. Payloads are memory-mapped, so recordings larger than the memory
+        can be replayed.
+        :param path: directory of the recording.
+        """
+        with open(os.path.join(path, STREAM_FILE)) as f:
+            self.stream = json.load(f)
+        numbers = sorted(int(name[:-len(INDEX_SUFFIX)]) for name in os.listdir(path) if name.endswith(INDEX_SUFFIX))
+        indexes = []
+        for number in numbers:
+            with open(_segment_name(path, number) + INDEX_SUFFIX, 'rb') as f:
+                data = f.read()
+            # a recorder that did not stop cleanly may have left a partial record behind
+            indexes.append(np.frombuffer(data[:len(data) - len(data) % INDEX.itemsize], INDEX))
+        self.path = path
+        self.index = np.concatenate(indexes) if indexes else np.zeros(0, INDEX)
+        self.position = 0  # next message replayed
+        self._segment_of = np.repeat(np.arange(len(numbers)), [len(index) for index in indexes])
+        self._files = [_segment_name(path, number) + FRAMES_SUFFIX for number in numbers]
+        self._maps = [None] * len(numbers)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def duration(self):
+        """
+        Time in seconds between the first and the last recorded message.
+        """
+        if not len(self.index):
+            return 0.0
+        return float(self.index['time'][-1] - self.index['time'][0])
+
+    def sender_options(self):
+        """
+        :return: dict of TCPSendSocket arguments that announce the recorded stream format to the receivers and send
+                 every replayed message, i.e. TCPSendSocket(port, **replayer.sender_options()). UDPSendSocket needs
+                 only send_type.
+        """
+        return {'send_type': self.stream['send_type'],
+                'frame_version': self.stream['frame_version'],
+                'batch_interval': 0 if self.stream['batched'] else None,
+                'cache_schemas': self.stream['schemas'],
+                'delta_encoding': self.stream['deltas'],
+                'queue_size': REPLAY_QUEUE_SIZE,
+                'queue_policy': BLOCK}
+
+    def seek(self, seconds=None, sequence=None):
+        """
+        Continue the replay at the first message recorded at least seconds after the first message, or at the first
+        message with at least the given sequence number. Receivers of streams with cached schemas or delta encoding
+        can only decode messages that follow the messages they depend on, so such streams should be replayed from
+        the start.
+        :return: the new position.
+        """
+        if seconds is not None:
+            times = self.index['time']
+            self.position = int(np.searchsorted(times, times[0] + seconds)) if len(times) else 0
+        elif sequence is not None:
+            later = np.flatnonzero(self.index['sequence'] >= sequence)
+            self.position = int(later[0]) if len(later) else len(self.index)
+        else:
+            self.position = 0
+        return self.position
+
+    def message(self, position):
+        """
+        :param position: number of the message in the recording.
+        :return: DataSocket.Encoded of the message. The payload is a view into the recording.
+        """
+        record = self.index[position]
+        segment = self._segment_of[position]
+        if self._maps[segment] is None:
+            with open(self._files[segment], 'rb') as f:
+                self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start = int(record['offset']) + int(record['header_size'])
+        size = int(record['size'])
+        payload = memoryview(self._maps[segment])[start:start + size]
+        batch = bool(self.stream['batched'] or record['flags'] & FLAG_BATCH)
+        if record['codec'] != NONE:  # the codec of version 2 frames is in the header, the sender needs the envelope
+            return Encoded(self.stream['send_type'], size + ENVELOPE_SIZE, [envelope(int(record['codec'])), payload],
+                           batch)
+        return Encoded(self.stream['send_type'], size, payload, batch)
+
+    def replay(self, sender, speed=1.0, end=None):
+        """
+        Send the recorded messages from the current position on with the timing they were recorded with.
+        :param sender: TCPSendSocket created with sender_options() or UDPSendSocket with the recorded send type.
+        :param speed: replay speed relative to the recording, i.e. 2.0 sends twice as fast. None sends the messages
+               as fast as the sender takes them.
+        :param end: position to stop at. Replays until the end of the recording if None.
+        :return: number of messages replayed.
+        """
+        end = len(self.index) if end is None else min(end, len(self.index))
+        first = self.position
+        if first >= end:
+            return 0
+        times = self.index['time']
+        started = time.monotonic()
+        while self.position < end:
+            if speed is not None:
+                wait = started + (times[self.position] - times[first]) / speed - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            sender.send_data(self.message(self.position))
+            self.position += 1
+        return end - first
+
+    def close(self):
+        """
+        Unmap the recording. Call the flush() of the senders first, queued messages are views into the recording.
+        """
+        for i, segment in enumerate(self._maps):
+            if segment is not None:
+                try:
+                    segment.close()
+                except BufferError:  # views are still in use, the memory is unmapped once they are gone
+                    pass
+                self._maps[i] = None
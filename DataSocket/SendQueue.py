@@ -0,0 +1,114 @@
+from threading import Condition
+from collections import deque
+from queue import Empty
+import time
+
+# queue policies that decide what happens when a message is sent while the queue is full
+BLOCK = 1  # block the caller of send_data until there is room (lossless)
+DROP_OLDEST = 2  # discard the oldest queued message
+DROP_NEWEST = 3  # discard the message being sent
+LATEST = 4  # only ever keep the most recent message (conflation)
+
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, LATEST)
+
+
+class SendQueue(object):
+    def __init__(self, maxsize=1, policy=LATEST):
+        """
+        A bounded FIFO queue between the producer calling send_data and the sending thread. The API mirrors
+        queue.Queue (put/get/task_done/join) with an explicit policy for full queues.
+        :param maxsize: maximum number of queued messages. Ignored for the LATEST policy, which always holds one.
+        :param policy: one of BLOCK, DROP_OLDEST, DROP_NEWEST, LATEST.
+        """
+        if policy not in POLICIES:
+            raise ValueError("policy must be one of BLOCK, DROP_OLDEST, DROP_NEWEST or LATEST")
+        if policy == LATEST:
+            maxsize = 1
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.total = 0
+        self.high_water = 0
+        self.closed = False
+        self._items = deque()
+        self._unfinished = 0
+        self._condition = Condition()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item, timeout=None):
+        """
+        Queue an item applying the queue policy if the queue is full.
+        :param item: the item to queue.
+        :param timeout: maximum time in seconds to block with the BLOCK policy. Blocks indefinitely if None.
+        :return: True if the item was queued, False if it was dropped (including a BLOCK timeout, which counts as
+                 a drop) or the queue is closed.
+        """
+        with self._condition:
+            if self.closed:
+                return False
+            if len(self._items) >= self.maxsize:
+                if self.policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                elif self.policy == BLOCK:
+                    end = None if timeout is None else time.monotonic() + timeout
+                    while len(self._items) >= self.maxsize and not self.closed:
+                        remaining = None if end is None else end - time.monotonic()
+                        if remaining is not None and remaining <= 0:
+                            self.dropped += 1
+                            return False
+                        self._condition.wait(remaining)
+                    if self.closed:
+                        return False
+                else:
+                    self._items.popleft()
+                    self._unfinished -= 1
+                    self.dropped += 1
+            self._items.append(item)
+            self._unfinished += 1
+            self.total += 1
+            self.high_water = max(self.high_water, len(self._items))
+            self._condition.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        """
+        Remove and return the oldest item. Raises queue.Empty on timeout or when the queue was closed.
+        :param timeout: maximum time in seconds to wait for an item. Waits indefinitely if None.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._items or self.closed, timeout) or not self._items:
+                raise Empty
+            item = self._items.popleft()
+            self._condition.notify_all()
+            return item
+
+    def task_done(self):
+        """
+        Mark an item returned by get() as fully processed.
+        """
+        with self._condition:
+            self._unfinished -= 1
+            self._condition.notify_all()
+
+    def join(self, timeout=None):
+        """
+        Wait until every queued item was processed.
+        :param timeout: maximum time in seconds to wait. Waits indefinitely if None.
+        :return: True if the queue was drained, False on timeout or if the queue was closed.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._unfinished <= 0 or self.closed, timeout) \
+                   and self._unfinished <= 0
+
+    def close(self):
+        """
+        Wake up every blocked producer and consumer. No further items are accepted.
+        """
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
@@ -0,0 +1,228 @@
+"""
+Conversion between the data passed to send_data() and the payload of a single message for every send type. Used by
+the threaded and the asyncio sockets so they all speak the same wire format.
+"""
+from io import BytesIO
+import time
+import json
+import struct
+import numpy as np
+import h5py
+from .ArrayFormat import pack_arrays, unpack_arrays
+from .BinaryFormat import pack_values, unpack_values
+from .Codecs import decompress
+
+NUMPY = 1
+JSON = 2
+HDF = 3
+RAW = 4
+ARRAY = 5
+BINARY = 6
+
+SEND_TYPE_NAMES = {NUMPY: 'numpy files', JSON: 'json message', HDF: 'HDF5 files', RAW: 'raw data', ARRAY: 'raw arrays',
+                   BINARY: 'binary messages'}
+
+# flag added to the send type in the handshake when several messages are sent together in one batch
+BATCHED = 0x100
+SEND_TYPE_MASK = 0xFF
+
+_SUB_FRAME_SIZE = struct.Struct('<I')
+
+
+class Encoded(object):
+    __slots__ = ('send_type', 'size', 'payload', 'batch')
+
+    def __init__(self, send_type, size, payload, batch=False):
+        """
+        A message that is already encoded, i.e. read from a recording by DataSocket.Recording.StreamReplayer. Passed
+        to send_data(), it is sent as it is.
+        :param send_type: send type the payload was encoded with.
+        :param size: size of the payload in bytes.
+        :param payload: bytes-like object or list of buffers as returned by encode(), with the codec envelope if
+               compressed.
+        :param batch: whether the payload is a batch of messages as returned by encode_batch().
+        """
+        self.send_type = send_type
+        self.size = size
+        self.payload = payload
+        self.batch = batch
+
+
+def _json_default(value):
+    # numpy arrays and scalars anywhere in the message are converted while serializing it, instead of serializing
+    # the message a second time after a TypeError
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError('Object of type ' + type(value).__name__ + ' is not JSON serializable')
+
+
+def encode(send_type, data, include_time=False, compressor=None, now=None):
+    """
+    Serialize data into the payload of one message.
+    :param send_type: one of NUMPY, JSON, HDF, RAW, ARRAY, BINARY.
+    :param data: the data passed to send_data().
+    :param include_time: add the send time to the message as '_time'.
+    :param compressor: optional DataSocket.Codecs.Compressor for NUMPY and HDF payloads.
+    :param now: send time to include. Uses time.time() if None.
+    :return: (size of the payload in bytes or None for RAW, payload as a bytes-like object or a list of buffers)
+    """
+    if now is None:
+        now = time.time()
+    if send_type == NUMPY:
+        # the numpy file is only deflated by numpy itself when no other compression was chosen
+        savez = np.savez_compressed if compressor is None else np.savez
+        if isinstance(data, dict):
+            arrays = {key: np.asarray(value) for key, value in data.items()}
+            if include_time:
+                arrays['_time'] = np.asarray(now)
+            f = BytesIO()
+            savez(f, **arrays)
+        else:
+            data_as_numpy = np.asarray(data)
+            f = BytesIO()
+            if include_time:
+                savez(f, data=data_as_numpy, _time=np.asarray(now))
+            else:
+                savez(f, data=data_as_numpy)
+
+        # send the file memory without copying it into a new bytes object
+        f = f.getbuffer()
+        size = f.nbytes
+        if compressor is not None:
+            f = compressor.compress(f)
+            size = len(f)
+
+    elif send_type == JSON:
+        if include_time:
+            data = {'data': data, '_time': now}
+        f = json.dumps(data, default=_json_default).encode()
+        size = len(f)
+
+    elif send_type == HDF:
+        f = BytesIO()
+        h5f = h5py.File(f, 'w')
+        if isinstance(data, dict):
+            datasets = dict(data)
+            if include_time:
+                datasets['_time'] = now
+            for key in datasets.keys():
+                h5f.create_dataset(key, data=datasets[key])
+        else:
+            h5f.create_dataset('data', data=data)
+            if include_time:
+                h5f.create_dataset('_time', data=now)
+
+        h5f.close()
+        # send the file memory without copying it into a new bytes object
+        f = f.getbuffer()
+        size = f.nbytes
+        if compressor is not None:
+            f = compressor.compress(f)
+            size = len(f)
+
+    elif send_type == ARRAY:
+        if include_time:
+            size, f = pack_arrays(data, extra={'_time': now})
+        else:
+            size, f = pack_arrays(data)
+
+    elif send_type == BINARY:
+        if include_time:
+            size, f = pack_values(data, extra={'_time': now})
+        else:
+            size, f = pack_values(data)
+
+    elif send_type == RAW:
+        size = None
+        f = data
+    else:
+        raise ValueError('unknown send type ' + str(send_type))
+    return size, f
+
+
+def decode(data_mode, buf, array_decoder=None):
+    """
+    Rebuild the data from the payload of one message.
+    :param data_mode: one of NUMPY, JSON, HDF, RAW, ARRAY, BINARY.
+    :param buf: bytes-like object holding the complete payload. ARRAY and BINARY arrays are views into buf.
+    :param array_decoder: the stateful decoder of the stream (ArrayFormat.SchemaDecoder or
+           DeltaEncoding.DeltaDecoder) if the sender caches ARRAY schemas or sends ARRAY deltas.
+    :return: the decoded data.
+    """
+    if data_mode == NUMPY:
+        as_file = BytesIO(decompress(buf))
+        as_file.seek(0)
+        return np.load(as_file)
+
+    elif data_mode == JSON:
+        if isinstance(buf, memoryview):
+            buf = buf.tobytes()
+        return json.loads(buf)
+
+    elif data_mode == ARRAY:
+        if array_decoder is not None:
+            return array_decoder.unpack(buf)
+        return unpack_arrays(buf)
+
+    elif data_mode == BINARY:
+        return unpack_values(buf)
+
+    elif data_mode == HDF:
+        as_file = BytesIO(decompress(buf))
+        as_file.seek(0)
+        data = h5py.File(as_file, 'r')
+        if len(data.keys()) > 1:
+            new_data = {}
+            for key in data.keys():
+                new_data[key] = np.array(data.get(key))
+        else:
+            new_data = np.array(data.get(list(data.keys())[0]))
+        return new_data
+
+    elif data_mode == RAW:
+        return bytes(buf)
+    raise ValueError('unknown send type ' + str(data_mode))
+
+
+def encode_batch(send_type, payloads):
+    """
+    Combine several encoded messages into the payload of one batch. JSON messages become one json list, all other
+    send types are concatenated with a 4 byte little-endian size in front of every message.
+    :param send_type: one of NUMPY, JSON, HDF, ARRAY, BINARY.
+    :param payloads: list of (size, payload) as returned by encode().
+    :return: (size of the batch in bytes, batch as a bytes-like object or a list of buffers)
+    """
+    if send_type == RAW:
+        raise ValueError('RAW messages can not be batched')
+    if send_type == JSON:
+        batch = b'[' + b','.join(f for _, f in payloads) + b']'
+        return len(batch), batch
+    buffers = []
+    for size, f in payloads:
+        buffers.append(_SUB_FRAME_SIZE.pack(size))
+        if isinstance(f, list):
+            buffers.extend(f)
+        else:
+            buffers.append(f)
+    return sum(size for size, _ in payloads) + _SUB_FRAME_SIZE.size * len(payloads), buffers
+
+
+def decode_batch(data_mode, buf, array_decoder=None):
+    """
+    Split the payload of a batch and decode every message in it.
+    :param data_mode: one of NUMPY, JSON, HDF, ARRAY, BINARY.
+    :param buf: bytes-like object holding the complete batch.
+    :param array_decoder: the stateful ARRAY decoder of the stream (see decode).
+    :return: list of decoded messages in the order they were sent.
+    """
+    if data_mode == JSON:
+        return decode(JSON, buf)
+    view = memoryview(buf)
+    messages = []
+    offset = 0
+    while offset < len(view):
+        size = _SUB_FRAME_SIZE.unpack_from(view, offset)[0]
+        offset += _SUB_FRAME_SIZE.size
+        messages.append(decode(data_mode, view[offset:offset + size], array_decoder))
+        offset += size
+    return messages
@@ -0,0 +1,178 @@
+"""
+Shared memory transport for senders and receivers on the same host.
+
+The sender writes every message into a ring of fixed size slots in a shared memory segment and only sends a small
+descriptor (the slot sequence number) over the regular connection, which serves as notification channel. Receivers
+copy the message out of the slot and decode it as usual. The ring has a single producer and any number of consumers
+and never takes a lock: the producer always overwrites the oldest slot, and a consumer that fell more than the number
+of slots behind detects the overwritten slot by its sequence number and skips the message.
+
+Segment layout (all integers little-endian):
+
+    control block (64 bytes): magic, number of slots (uint32), slot size (uint64), last written sequence (uint64)
+    slot i: slot header (64 bytes): sequence (uint64), message size (uint64), followed by slot size bytes of data
+
+Slot data start on a 64 byte boundary so ARRAY messages keep their alignment.
+"""
+import struct
+from threading import Lock
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+_MAGIC = b'DSRING01'
+_CONTROL = struct.Struct('<8sIQQ')
+_SLOT_HEADER = struct.Struct('<QQ')
+_BLOCK = 64
+_SEQUENCE_OFFSET = struct.calcsize('<8sIQ')
+
+# descriptor sent over the connection for every message
+DESCRIPTOR = struct.Struct('<cQ')
+SLOT_MESSAGE = b'S'  # followed by the sequence number of the slot holding the message
+INLINE_MESSAGE = b'I'  # followed by the message itself, used for messages larger than a slot
+
+
+def _aligned(size):
+    return (size + _BLOCK - 1) // _BLOCK * _BLOCK
+
+
+_register_lock = Lock()
+
+
+def attach_segment(name):
+    """
+    Map an existing shared memory segment without making this process responsible for removing it.
+    :param name: name of the segment.
+    :return: multiprocessing.shared_memory.SharedMemory
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # python < 3.13 has no track argument
+        pass
+    # older versions register every mapped segment with the resource tracker, which removes it once this process
+    # ends. Unregistering it afterwards would also drop the registration of the creating process if both share a
+    # tracker (same or forked process), so the registration of this segment is skipped instead.
+    register = resource_tracker.register
+
+    def register_others(segment_name, rtype):
+        if rtype != 'shared_memory' or segment_name.lstrip('/') != name.lstrip('/'):
+            register(segment_name, rtype)
+
+    with _register_lock:
+        resource_tracker.register = register_others
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def _check_available():
+    if shared_memory is None:
+        raise RuntimeError('the shared memory transport needs python 3.8 or newer.')
+
+
+class SharedMemoryWriter(object):
+    def __init__(self, slots, slot_size):
+        """
+        Create a new shared memory ring. Only the creating process writes to it.
+        :param slots: number of slots in the ring.
+        :param slot_size: maximum message size in bytes that fits into a slot.
+        """
+        _check_available()
+        if slots < 1 or slot_size < 1:
+            raise ValueError('the shared memory ring needs at least one slot of at least one byte')
+        self.slots = slots
+        self.slot_size = slot_size
+        self.stride = _BLOCK + _aligned(slot_size)
+        self.sequence = 0
+        self._memory = shared_memory.SharedMemory(create=True, size=_BLOCK + slots * self.stride)
+        self._buffer = self._memory.buf
+        _CONTROL.pack_into(self._buffer, 0, _MAGIC, slots, slot_size, 0)
+
+    @property
+    def name(self):
+        return self._memory.name
+
+    def write(self, size, buffers):
+        """
+        Copy a message into the next slot.
+        :param size: size of the message in bytes.
+        :param buffers: list of bytes-like objects making up the message.
+        :return: the sequence number of the slot or None if the message does not fit into a slot.
+        """
+        if size > self.slot_size:
+            return None
+        sequence = self.sequence + 1
+        slot = _BLOCK + (sequence % self.slots) * self.stride
+        # readers treat a slot with an unexpected sequence number as overwritten, so mark it while writing
+        _SLOT_HEADER.pack_into(self._buffer, slot, 0, size)
+        position = slot + _BLOCK
+        for buffer in buffers:
+            view = memoryview(buffer).cast('B')
+            self._buffer[position:position + len(view)] = view
+            position += len(view)
+        _SLOT_HEADER.pack_into(self._buffer, slot, sequence, size)
+        struct.pack_into('<Q', self._buffer, _SEQUENCE_OFFSET, sequence)
+        self.sequence = sequence
+        return sequence
+
+    def close(self):
+        """
+        Close and remove the shared memory segment. Receivers that are still attached keep their mapping.
+        """
+        if self._memory is None:
+            return
+        self._buffer.release()
+        self._memory.close()
+        try:
+            self._memory.unlink()
+        except FileNotFoundError:
+            pass
+        self._memory = None
+
+
+class SharedMemoryReader(object):
+    def __init__(self, name):
+        """
+        Attach to the shared memory ring of a sender on the same host.
+        :param name: name of the shared memory segment announced by the sender.
+        """
+        _check_available()
+        self._memory = attach_segment(name)
+        self._buffer = self._memory.buf
+        magic, self.slots, self.slot_size, _ = _CONTROL.unpack_from(self._buffer, 0)
+        if magic != _MAGIC:
+            self.close()
+            raise ValueError('shared memory segment ' + name + ' is not a DataSocket ring')
+        self.stride = _BLOCK + _aligned(self.slot_size)
+
+    def _slot(self, sequence):
+        return _BLOCK + (sequence % self.slots) * self.stride
+
+    def message_size(self, sequence):
+        """
+        :return: size of the message in the slot with this sequence number or None if it was already overwritten.
+        """
+        slot_sequence, size = _SLOT_HEADER.unpack_from(self._buffer, self._slot(sequence))
+        if slot_sequence != sequence:
+            return None
+        return size
+
+    def read_into(self, sequence, view):
+        """
+        Copy a message out of its slot.
+        :param sequence: sequence number from the descriptor.
+        :param view: writable memoryview of message_size(sequence) bytes.
+        :return: False if the slot was overwritten before or while copying, in which case view holds garbage.
+        """
+        slot = self._slot(sequence)
+        view[:] = self._buffer[slot + _BLOCK:slot + _BLOCK + len(view)]
+        return _SLOT_HEADER.unpack_from(self._buffer, slot) == (sequence, len(view))
+
+    def close(self):
+        if self._memory is None:
+            return
+        self._buffer.release()
+        self._memory.close()
+        self._memory = None
@@ -1,26 +1,86 @@
 from threading import Event, Thread, Lock
-from socket import socket, AF_INET, SOCK_STREAM, IPPROTO_TCP, TCP_NODELAY, SOL_SOCKET, SO_REUSEADDR, error
+from socket import socket, AF_INET, SOCK_STREAM, IPPROTO_TCP, TCP_NODELAY, SOL_SOCKET, SO_REUSEADDR, SHUT_RDWR, error
 import time
-from io import BytesIO
-import numpy as np
-import os
-import struct
-import json
-import h5py
+from .Serialization import NUMPY, JSON, HDF, RAW, ARRAY, BINARY, SEND_TYPE_NAMES, Encoded, encode, decode, \
+    encode_batch, decode_batch
+from .Codecs import NONE, get_compressor, decompress
+from .ArrayFormat import SchemaEncoder, SchemaDecoder, receive_arrays
+from .DeltaEncoding import DeltaEncoder, DeltaDecoder
+from .BufferPool import PooledBuffer
+from .SendQueue import SendQueue, Empty, BLOCK, LATEST
+from .Dispatcher import Dispatcher, THREAD, STRICT, current_lease
+from .DecodePool import DecodePool
+from .Metrics import Metrics, MetricsReporter
+from .Waker import Waker, wait_readable
+from .FanOut import FanOut, Client, MAX_IOV, BLOCK_ON_SLOW
+from .Framing import FrameWriter, LEGACY_FRAMES, FRAME_V2, FLAG_BATCH, FLAG_TRACE, FLAG_PONG, HEADER, \
+    LEGACY_HEADER, NAME_LENGTH, handshake, parse_handshake, parse_header
+from .Tracing import TraceRecorder, PingReader, STAMPS, PONG
+from .Addresses import AF_UNIX, unix_path, remove_stale_socket_file, remove_socket_file
+from .SharedMemoryRing import SharedMemoryWriter, SharedMemoryReader, DESCRIPTOR, SLOT_MESSAGE, INLINE_MESSAGE
+# reconnect attempts back off from the first to the maximum delay (seconds) while the peer is not available
+_FIRST_RETRY_DELAY = 0.001
+_MAX_RETRY_DELAY = 0.05
 
-NUMPY = 1
-JSON = 2
-HDF = 3
-RAW = 4
 
-
-def _get_socket():
+def _get_socket(unix=False):
+    if unix:
+        return socket(AF_UNIX, SOCK_STREAM)
     new_socket = socket(AF_INET, SOCK_STREAM)
     new_socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
     new_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
     return new_socket
 
 
+def _bind(sock, address, verbose):
+    """
+    Bind a listening socket, replacing the stale file of a unix domain socket left behind by a crashed server.
+    :return: the path of the bound socket file or None for TCP sockets.
+    """
+    if isinstance(address, tuple):
+        sock.bind(address)
+        if verbose:
+            print('listening on port ', address[1])
+        return None
+    remove_stale_socket_file(address)
+    sock.bind(address)
+    if verbose:
+        print('listening on ', address)
+    return address
+
+
+def _shutdown(sock):
+    """
+    Shut a socket down so threads blocked in recv/accept on it return right away.
+    """
+    try:
+        sock.shutdown(SHUT_RDWR)
+    except (OSError, AttributeError):
+        pass
+
+
+def _sendmsg_all(connection, buffers):
+    """
+    Send a list of buffers with scatter-gather I/O so the buffers never have to be joined into one bytes object.
+    :param connection: a connected stream socket.
+    :param buffers: list of bytes-like objects to send in order.
+    """
+    if not hasattr(connection, 'sendmsg'):  # i.e. windows
+        for buffer in buffers:
+            connection.sendall(buffer)
+        return
+    views = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+    while views:
+        sent = connection.sendmsg(views[:MAX_IOV])
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+
 class TCPSendSocket(object):
     def __init__(self,
                  tcp_port,
@@ -29,34 +89,155 @@ class TCPSendSocket(object):
                  verbose=True,
                  as_server=True,
                  include_time=False,
-                 as_daemon=True):
+                 as_daemon=True,
+                 compression=None,
+                 compression_level=None,
+                 queue_size=1,
+                 queue_policy=LATEST,
+                 slow_consumer_policy=BLOCK_ON_SLOW,
+                 max_lag_bytes=None,
+                 max_lag_seconds=None,
+                 batch_interval=None,
+                 batch_size=65536,
+                 frame_version=LEGACY_FRAMES,
+                 shared_memory_slot_size=None,
+                 shared_memory_slots=8,
+                 cache_schemas=False,
+                 delta_encoding=False,
+                 keyframe_interval=100,
+                 delta_threshold=0.5,
+                 metrics_callback=None,
+                 metrics_interval=1.0,
+                 trace=False):
         """
         A TCP socket class to send data to a specific port and address.
-        :param tcp_port: TCP port to use.
-        :param tcp_ip: ip address to connect to.
+        :param tcp_port: TCP port to use. Ignored for unix domain sockets.
+        :param tcp_ip: ip address to connect to. 'unix:///path/to/file' uses a unix domain socket at that path instead,
+               which is faster for peers on the same host.
         :param send_type: This is the data type used to send the data. DataSocket.NUMPY uses a numpy file to store the
                data for sending. This is ideal for large arrays. DataSocket.JSON converts the data to a json formatted string.
                JSON is best for smaller messages. DataSocket.HDF uses the HDF5 file format and performance is probably
                comparable to NUMPY. DataSocket.RAW expects a bytes object and sends it directly with no processing. The
-               receiving socket must be manually set to receive raw data.
+               receiving socket must be manually set to receive raw data. DataSocket.ARRAY sends a small header
+               followed by the uncompressed array memory without any intermediate copies. This is the fastest option
+               for large arrays on fast links. DataSocket.BINARY sends nested dicts and lists of numbers, strings,
+               bytes and arrays in a compact binary format with the array memory sent as it is, for messages that mix
+               arrays with other values.
         :param verbose: Whether or not to print errors and status messages.
         :param as_server: Whether to run this socket as a server (default: True) or client. When run as a server, the
-               socket supports multiple clients and sends each message to every connected client.
+               socket supports multiple clients and sends each message to every connected client. A single thread
+               accepts clients and writes to all of them without blocking.
         :param include_time: Appends time.time() value when sending the data message.
         :param as_daemon: runs the underlying threads as daemon.
+        :param compression: Compression used for NUMPY and HDF payloads. None (default) keeps the original behaviour
+               (NUMPY files are deflated, HDF files are not compressed). 'none' disables compression, 'zlib', 'lzma'
+               and 'bz2' always compress with that codec and 'auto' decides per message whether compressing pays off
+               given the measured compression ratio and link throughput. A DataSocket.Codecs.Compressor may also be
+               passed.
+        :param compression_level: compression level used by the chosen codec.
+        :param queue_size: maximum number of messages waiting to be sent.
+        :param queue_policy: what to do when send_data is called while the send queue is full. DataSocket.LATEST
+               (default) only keeps the most recent message, which suits control loops. DataSocket.BLOCK blocks the
+               caller until there is room and never loses messages. DataSocket.DROP_OLDEST and DataSocket.DROP_NEWEST
+               discard the oldest queued or the new message respectively.
+        :param slow_consumer_policy: how to treat clients that can not keep up when running as a server. Every client
+               has its own outbound buffer so the policy only affects the lagging client.
+               DataSocket.BLOCK_ON_SLOW (default) waits until every client got a message before sending the next one.
+               DataSocket.SKIP_TO_LATEST replaces the messages a lagging client has not started receiving with the
+               newest one. DataSocket.DISCONNECT_SLOW disconnects clients lagging more than max_lag_bytes or
+               max_lag_seconds. client_stats() shows how far behind every client is.
+        :param max_lag_bytes: number of bytes waiting for a client before it is disconnected by DISCONNECT_SLOW.
+        :param max_lag_seconds: time in seconds a client may lag behind before it is disconnected by DISCONNECT_SLOW.
+        :param batch_interval: when set, messages queued within this many seconds of each other are combined into a
+               single message on the wire, which saves system calls and receiver wake ups for high rates of small
+               messages. Use a queue_size larger than 1 so messages can accumulate. Not supported for RAW and matlab
+               receivers.
+        :param batch_size: a batch is sent right away once its messages add up to this many bytes.
+        :param frame_version: DataSocket.LEGACY_FRAMES (default) puts a 4 byte size in front of every message, which
+               is what the matlab sockets understand. DataSocket.FRAME_V2 uses a header with 64-bit size, sequence
+               number, send time, codec and flags, which lets receivers detect skipped messages. The version is
+               announced in the handshake, so TCPReceiveSocket adapts automatically.
+        :param shared_memory_slot_size: When set, messages are passed to the receivers through a ring of
+               shared_memory_slots slots of this many bytes in shared memory and the connection only carries a small
+               notification per message. All receivers must run on the same host. Messages larger than a slot are sent
+               over the connection instead. Shared memory only delivers the latest values: the sender never waits
+               for the receivers and overwrites slots that were not read yet, so receivers falling more than
+               shared_memory_slots messages behind skip messages, which they count in missed_messages. Not supported
+               for RAW and matlab receivers and can not be combined with queue_policy=BLOCK.
+        :param shared_memory_slots: number of slots in the shared memory ring.
+        :param cache_schemas: For the ARRAY send type only. The keys, dtypes and shapes of a message (its schema) are
+               sent once with the first message using them, and later messages with the same schema only carry a
+               schema id and the array memory. Receivers that connect later or skipped messages get the schema with
+               their next message. Meant for streams of small arrays with the same structure every time. Not
+               supported with shared memory.
+        :param delta_encoding: For the ARRAY send type only. Only the elements that changed since the previous message
+               are sent, or a small marker if nothing changed. Meant for values that change little between messages
+               (i.e. occupancy grids, calibration tables). Receivers that connect later or skipped messages get the
+               full value with their next message. Received arrays are read only. Not supported together with
+               cache_schemas or shared memory.
+        :param keyframe_interval: with delta_encoding, the full value is sent every keyframe_interval messages.
+        :param delta_threshold: with delta_encoding, an array is sent in full once its changed elements (with their
+               indices) make up more than this fraction of its size.
+        :param metrics_callback: optional function called with stats() every metrics_interval seconds from a thread
+               of its own, i.e. to log or plot the throughput. No thread is started if None.
+        :param metrics_interval: time in seconds between calls of metrics_callback.
+        :param trace: stamp every message when it is queued, taken from the queue and encoded and send the stamps
+               along in the frame, so TCPReceiveSocket can break the latency of every message down into stages. The
+               sender also answers the clock pings receivers use to estimate the offset between the clocks. Needs
+               frame_version=FRAME_V2. For batches, the stamps of the first message of the batch are sent.
         """
+        if batch_interval is not None and send_type == RAW:
+            raise ValueError("RAW messages can not be batched")
+        if trace and (frame_version != FRAME_V2 or send_type == RAW):
+            raise ValueError("tracing needs frame_version=FRAME_V2 and can not be used with RAW messages")
+        if shared_memory_slot_size is not None and send_type == RAW:
+            raise ValueError("RAW messages can not be sent through shared memory")
+        if shared_memory_slot_size is not None and queue_policy == BLOCK:
+            raise ValueError("the shared memory ring only keeps the latest messages and can not be combined with "
+                             "queue_policy=BLOCK")
+        if cache_schemas and send_type != ARRAY:
+            raise ValueError("schemas can only be cached for the ARRAY send type")
+        if cache_schemas and shared_memory_slot_size is not None:
+            raise ValueError("schemas can not be cached for messages sent through shared memory")
+        if delta_encoding and (send_type != ARRAY or cache_schemas or shared_memory_slot_size is not None):
+            raise ValueError("delta_encoding needs the ARRAY send type and can not be combined with cache_schemas or "
+                             "shared memory")
         self.send_type = send_type
+        self.compressor = get_compressor(compression, compression_level)
         self.data_to_send = b'0'
         self.port = int(tcp_port)
         self.ip = tcp_ip
-        self.new_value_available = Event()
+        self.unix_path = unix_path(tcp_ip)
+        self.address = (tcp_ip, self.port) if self.unix_path is None else self.unix_path
+        self.send_queue = SendQueue(queue_size, queue_policy)
         self.stop_thread = Event()
-        self.socket = _get_socket()
+        self.socket = _get_socket(self.unix_path is not None)
+        self._socket_file = None  # unix domain socket file bound by this socket
         self.verbose = verbose
         self.as_server = as_server
         self.include_time = include_time
-        self.connected_clients = []  # type: list[list[socket, str, bool]]
-        self._gather_connections_thread = Thread(target=self._gather_connections, daemon=as_daemon)
+        self.connected_clients = []  # type: list[Client]
+        self.slow_consumer_policy = slow_consumer_policy
+        self.max_lag_bytes = max_lag_bytes
+        self.max_lag_seconds = max_lag_seconds
+        self.batch_interval = batch_interval
+        self.batch_size = batch_size
+        self.frame_version = frame_version
+        self._frame_writer = FrameWriter(frame_version)
+        self.shared_memory_slot_size = shared_memory_slot_size
+        self.shared_memory_slots = shared_memory_slots
+        self._shared_memory = None  # type: SharedMemoryWriter
+        self._schema_encoder = SchemaEncoder() if cache_schemas else None
+        self._delta_encoder = DeltaEncoder(keyframe_interval, delta_threshold) if delta_encoding else None
+        self._fan_out = None  # type: FanOut
+        self.trace = trace
+        self._stamps = None  # enqueued and dequeued time of the message (or first message of the batch) being sent
+        self._write_lock = Lock()  # in client mode, clock ping answers are written by another thread
+        self.metrics = Metrics(('encode', 'write'))
+        self._metrics_reporter = None
+        if metrics_callback is not None:
+            self._metrics_reporter = MetricsReporter(self.stats, metrics_callback, metrics_interval, as_daemon)
+        self._server_thread = Thread(target=self._serve, daemon=as_daemon)
         self.sending_thread = Thread(target=self._run, daemon=as_daemon)
 
     def send_data(self, data):
@@ -71,10 +252,70 @@ class TCPSendSocket(object):
                      a dict of values or numpy arrays
                         i.e.   data = {'data1': numpy_array1,
                                        'data2': numpy_array2}
-        :return: Nothing
+                     Dicts are copied before queueing, so the caller may reuse them right away. Arrays are not copied
+                     and must not be modified in place until they were sent.
+                     A DataSocket.Encoded message (i.e. from DataSocket.StreamReplayer) is sent without encoding. It
+                     must have been encoded with the send_type of this socket and be a batch exactly when
+                     batch_interval is set.
+        :return: True if the message was queued, False if it was dropped because of the queue policy.
+        """
+        if isinstance(data, dict):
+            data = dict(data)
+        if self.trace:
+            return self.send_queue.put((time.time(), data))
+        return self.send_queue.put(data)
+
+    @property
+    def queue_depth(self):
+        """
+        Number of messages currently waiting to be sent.
+        """
+        return len(self.send_queue)
+
+    @property
+    def dropped_messages(self):
+        """
+        Number of messages discarded because of the queue policy.
+        """
+        return self.send_queue.dropped
+
+    def flush(self, timeout=None):
+        """
+        Block until every queued message was sent. With slow_consumer_policy SKIP_TO_LATEST or DISCONNECT_SLOW,
+        clients that can not take more data when flush() is called are not waited for, so one stalled client does not
+        hold it up. client_stats() shows what is still pending for them.
+        :param timeout: maximum time in seconds to wait. Waits indefinitely if None.
+        :return: True if the send queue was drained.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        if not self.send_queue.join(timeout):
+            return False
+        if self._fan_out is not None:
+            return self._fan_out.wait_sent(None if end is None else max(0.0, end - time.monotonic()),
+                                           skip_lagging=self.slow_consumer_policy != BLOCK_ON_SLOW)
+        return True
+
+    def client_stats(self):
+        """
+        :return: list with a dict per connected client describing its lag (pending_messages, pending_bytes,
+                 lag_seconds) and how much was sent to it.
+        """
+        return [client.stats() for client in list(self.connected_clients)]
+
+    def stats(self):
+        """
+        Snapshot of what the socket did so far: messages and bytes sent (a message sent to several clients counts
+        once), encoding errors, connections, queue state and histograms of the time spent encoding messages
+        (encode_seconds) and handing them to the connections (write_seconds, which includes waiting for slow
+        clients with BLOCK_ON_SLOW), plus client_stats() as clients.
+        :return: dict
         """
-        self.data_to_send = data
-        self.new_value_available.set()
+        stats = self.metrics.snapshot()
+        stats['queue_depth'] = len(self.send_queue)
+        stats['queue_high_water'] = self.send_queue.high_water
+        stats['dropped'] = self.send_queue.dropped
+        stats['clients'] = self.client_stats()
+        return stats
 
     def start(self, blocking=False):
         """
@@ -82,6 +323,10 @@ class TCPSendSocket(object):
         :param blocking: Will block the calling thread until a connection is established to at least one receiver.
         :return: Nothing
         """
+        if self._metrics_reporter is not None:
+            self._metrics_reporter.start()
+        if self.shared_memory_slot_size is not None and self._shared_memory is None:
+            self._shared_memory = SharedMemoryWriter(self.shared_memory_slots, self.shared_memory_slot_size)
         self._establish_connection()
         self.sending_thread.start()
         if blocking:
@@ -93,163 +338,273 @@ class TCPSendSocket(object):
         Stop the socket and it's associated threads.
         """
         self.stop_thread.set()
-        if self._gather_connections_thread.is_alive():
-            self._gather_connections_thread.join(timeout=2)
+        self.send_queue.close()
+        if self._metrics_reporter is not None:
+            self._metrics_reporter.stop()
+        if self._fan_out is not None:
+            self._fan_out.wake()
+        elif self.trace:
+            _shutdown(self.socket)  # wakes up the thread answering clock pings
+        if self._server_thread.is_alive():
+            self._server_thread.join(timeout=2)
         if self.sending_thread.is_alive():
             self.sending_thread.join(timeout=2)
         self.socket.close()
+        if self._socket_file is not None:
+            remove_socket_file(self._socket_file)
+            self._socket_file = None
+        if self._shared_memory is not None:
+            self._shared_memory.close()
 
-    def _gather_connections(self):
-        self.socket.bind((self.ip, self.port))
-        self.socket.setblocking(0)
-        if self.verbose:
-            print('listening on port ', self.port)
-        self.socket.listen(1)
+    def _serve(self):
+        self._socket_file = _bind(self.socket, self.address, self.verbose)
+        self._fan_out.run(self.stop_thread)
 
-        while not self.stop_thread.is_set():
-            clients_to_remove = []
-            for client in self.connected_clients:
-                if not client[2]:
-                    clients_to_remove.append(client)
-            for client in clients_to_remove:
-                self.connected_clients.remove(client)
+    def _handshake(self):
+        if self.send_type == RAW:
+            return None
+        return handshake(self.send_type, self.batch_interval is not None, self.frame_version,
+                         None if self._shared_memory is None else self._shared_memory.name,
+                         self._schema_encoder is not None, self._delta_encoder is not None, self.trace)
 
-            if self.stop_thread.is_set():
-                return
+    def _pong(self, pinged, arrived):
+        """
+        :return: buffers of the frame answering a clock ping (see DataSocket.Tracing).
+        """
+        return self._frame_writer.frame(0, b'', FLAG_PONG, PONG.pack(pinged, arrived), sequence=0)
+
+    def _answer_pings(self, connection):
+        # in client mode nothing else reads from the connection
+        pings = PingReader()
+        while connection.connected and not self.stop_thread.is_set():
             try:
-                connection, client_address = self.socket.accept()
-            except BlockingIOError:
-                continue
-            new_connection = [connection, client_address, True]
-            self.connected_clients.append(new_connection)  # boolean is for connected
-            if not self.send_type == RAW:
-                type_msg = struct.pack('I', self.send_type)
-                new_connection[0].sendall(type_msg)
+                data = connection.socket.recv(4096)
+            except OSError:
+                return
+            if not data:  # the sending thread notices the disconnect with its next message
+                return
+            arrived = time.time()
+            for pinged in pings.feed(data):
+                try:
+                    with self._write_lock:
+                        _sendmsg_all(connection.socket, self._pong(pinged, arrived))
+                except OSError:
+                    return
 
     def _establish_connection(self):
         while not len(self.connected_clients) > 0:
             if self.stop_thread.is_set():
                 break
-            if self.as_server and not self._gather_connections_thread.is_alive():
-                self._gather_connections_thread.start()
+            if self.as_server and not self._server_thread.is_alive():
+                handshake = self._handshake()
+                self._fan_out = FanOut(self.socket, handshake, self.verbose, self.slow_consumer_policy,
+                                       self.max_lag_bytes, self.max_lag_seconds, self.metrics,
+                                       self._pong if self.trace else None,
+                                       self.compressor.observe_send if self.compressor is not None else None)
+                self.connected_clients = self._fan_out.clients
+                self._server_thread.start()
                 break
             else:
                 if len(self.connected_clients) > 0:
-                    self.connected_clients[0][0].close()
+                    self.connected_clients[0].socket.close()
                     self.connected_clients.clear()
+                retry_delay = _FIRST_RETRY_DELAY
                 while not len(self.connected_clients) > 0:
                     try:
-                        self.socket.connect((self.ip, self.port))
+                        self.socket.connect(self.address)
                     except (ConnectionError, OSError) as e:
-                        self.socket = _get_socket()
-                        time.sleep(0.001)
+                        self.socket.close()
+                        self.socket = _get_socket(self.unix_path is not None)
+                        if self.stop_thread.wait(retry_delay):
+                            return
+                        retry_delay = min(2 * retry_delay, _MAX_RETRY_DELAY)
                         continue
-                    self.connected_clients.append([self.socket, 0, True])
+                    self.connected_clients.append(Client(self.socket, self.address))
                     if not self.send_type == RAW:
-                        type_msg = struct.pack('I', self.send_type)
+                        type_msg = self._handshake()
                         try:
                             self.socket.sendall(type_msg)
                         except ConnectionError as e:
                             self.connected_clients.clear()
                             continue
+                    self.metrics.connections += 1
+                    if self.trace:
+                        Thread(target=self._answer_pings, args=(self.connected_clients[0],),
+                               daemon=self.sending_thread.daemon).start()
 
     def _run(self):
         while not self.stop_thread.is_set():
-            if not self.as_server and not self.connected_clients[0][2]:
-                self.connected_clients[0][0].close()
+            if not self.as_server and not self.connected_clients[0].connected:
+                self.metrics.disconnects += 1
+                self.connected_clients[0].socket.close()
                 self.connected_clients.clear()
                 self._establish_connection()
-            while not self.new_value_available.is_set():
-                time.sleep(0.0001)
-                if self.stop_thread.is_set():
-                    return
+            self._stamps = None
+            try:
+                self.data_to_send = self._take(self.send_queue.get())
+            except Empty:  # the queue was closed by stop()
+                return
             if self.stop_thread.is_set():
                 return
-            self._send_data()
-            self.new_value_available.clear()
+            if self.batch_interval is not None and not isinstance(self.data_to_send, Encoded):
+                self._send_batch()
+                continue
+            try:
+                self._send_data()
+            finally:
+                self.send_queue.task_done()
+
+    def _send_batch(self):
+        """
+        Collect the messages queued within batch_interval (or until batch_size bytes) and send them as one message.
+        """
+        deadline = time.monotonic() + self.batch_interval
+        payloads = []
+        dependencies = []
+        nbytes = 0
+        count = 1
+        try:
+            while True:
+                try:
+                    payload, message_dependencies = self._encode()
+                    payloads.append(payload)
+                    dependencies.append(message_dependencies)
+                    nbytes += payload[0]
+                except TypeError as e:
+                    self.metrics.errors += 1
+                    if self.verbose: print(e)
+                remaining = deadline - time.monotonic()
+                if nbytes >= self.batch_size or remaining <= 0:
+                    break
+                try:
+                    self.data_to_send = self._take(self.send_queue.get(timeout=remaining))
+                except Empty:
+                    break
+                count += 1
+            if payloads and len(self.connected_clients) > 0:
+                self._send_encoded(*encode_batch(self.send_type, payloads), flags=FLAG_BATCH,
+                                   dependencies=self._batch_dependencies(dependencies), messages=len(payloads))
+        finally:
+            for _ in range(count):
+                self.send_queue.task_done()
+
+    def _take(self, item):
+        """
+        :param item: what send_data() put into the send queue.
+        :return: the message. When tracing, the time it was queued and taken out is kept for the frame.
+        """
+        if not self.trace:
+            return item
+        if self._stamps is None:
+            self._stamps = (item[0], time.time())
+        return item[1]
 
     def _send_data(self):
         if len(self.connected_clients) < 1:
             return
-        now = time.time()
-        if self.send_type == NUMPY:
-            if isinstance(self.data_to_send, dict):
-                if self.include_time:
-                    self.data_to_send['_time'] = now
-                for key in self.data_to_send.keys():
-                    self.data_to_send[key] = np.asarray(self.data_to_send[key])
-                f = BytesIO()
-                np.savez_compressed(f, **self.data_to_send)
-            else:
-                data_as_numpy = np.asarray(self.data_to_send)
-                f = BytesIO()
-                if self.include_time:
-                    np.savez_compressed(f, data=data_as_numpy, _time=np.asarray(now))
-                else:
-                    np.savez_compressed(f, data=data_as_numpy)
-
-            # determine file size in bytes
-            f.seek(0, os.SEEK_END)
-            size = f.tell()
-            f.seek(0)
-            f = f.read()
+        if isinstance(self.data_to_send, Encoded):
+            message = self.data_to_send
+            if message.send_type != self.send_type or message.batch != (self.batch_interval is not None):
+                self.metrics.errors += 1
+                if self.verbose:
+                    print('the encoded message does not match the send_type or batching of the socket')
+                return
+            self._send_encoded(message.size, message.payload, FLAG_BATCH if message.batch else 0)
+            return
+        try:
+            (size, f), dependencies = self._encode()
+        except TypeError as e:
+            self.metrics.errors += 1
+            if self.verbose: print(e)
+            return
+        self._send_encoded(size, f, dependencies=dependencies)
 
-        elif self.send_type == JSON:
-            if self.include_time:
-                data_as_dict = {'data': self.data_to_send, '_time': now}
-                try:
-                    f = json.dumps(data_as_dict).encode()
-                except TypeError:
-                    try:
-                        data_as_dict['data'] = data_as_dict['data'].tolist()
-                        f = json.dumps(data_as_dict).encode()
-                    except TypeError as e:
-                        if self.verbose: print(e)
-            else:
-                try:
-                    f = json.dumps(self.data_to_send).encode()
-                except TypeError as e1:
-                    try:
-                        f = json.dumps(self.data_to_send.tolist()).encode()
-                    except TypeError as e:
-                        if self.verbose: print(e1, e)
-
-            size = len(f)
-        elif self.send_type == HDF:
-            f = BytesIO()
-            h5f = h5py.File(f, 'w')
-            if isinstance(self.data_to_send, dict):
-                if self.include_time:
-                    self.data_to_send['_time'] = now
-                for key in self.data_to_send.keys():
-                    h5f.create_dataset(key, data=self.data_to_send[key])
-            else:
-                if self.include_time:
-                    h5f.create_dataset('data', data=self.data_to_send, _time=now)
-                else:
-                    h5f.create_dataset('data', data=self.data_to_send)
+    def _encode(self):
+        """
+        Encode data_to_send.
+        :return: ((size, payload), dependencies). dependencies is None unless schemas are cached or deltas are sent,
+                 in which case it is (state the receiver needs, state the message leaves behind, (size, payload) of
+                 the same message not needing anything) as used by Client.select.
+        """
+        start = time.perf_counter()
+        try:
+            if self._schema_encoder is None and self._delta_encoder is None:
+                return encode(self.send_type, self.data_to_send, self.include_time, self.compressor), None
+            extra = {'_time': time.time()} if self.include_time else None
+            if self._schema_encoder is not None:
+                schema_id, payload, full_payload = self._schema_encoder.pack(self.data_to_send, extra)
+                schema = {('schema', schema_id): True}
+                return payload, (schema, schema, full_payload)
+            base, state, payload, keyframe = self._delta_encoder.pack(self.data_to_send, extra)
+            return payload, ({} if base is None else {'delta': base}, {'delta': state}, keyframe)
+        finally:
+            self.metrics.record('encode', time.perf_counter() - start)
 
-            h5f.close()
-            # determine file size in bytes
-            f.seek(0, os.SEEK_END)
-            size = f.tell()
-            f.seek(0)
-            f = f.read()
+    def _batch_dependencies(self, dependencies):
+        """
+        Combine the dependencies of the messages of a batch.
+        """
+        if self._schema_encoder is None and self._delta_encoder is None:
+            return None
+        requires = {}
+        provides = {}
+        for message_requires, message_provides, _ in dependencies:
+            for key, value in message_requires.items():
+                # state left behind by an earlier message of the batch is not required from the receiver
+                if key not in provides and key not in requires:
+                    requires[key] = value
+            provides.update(message_provides)
+        return requires, provides, encode_batch(self.send_type, [standalone for _, _, standalone in dependencies])
 
-        elif self.send_type == RAW:
-            size = None
-            f = self.data_to_send
-        [self._send_f(connection, size, f) for connection in self.connected_clients if connection[2]]
+    def _send_encoded(self, size, f, flags=0, dependencies=None, messages=1):
+        start = time.perf_counter()
+        metadata = b''
+        if self.trace:
+            metadata = STAMPS.pack(self._stamps[0], self._stamps[1], time.time())
+            flags |= FLAG_TRACE
+        if self.send_type == RAW:
+            buffers = f if isinstance(f, list) else [f]
+        elif self._shared_memory is not None:
+            payload = f if isinstance(f, list) else [f]
+            sequence = self._shared_memory.write(size, payload)
+            if sequence is None:  # too large for a slot
+                buffers = self._frame_writer.frame(size + 1, [INLINE_MESSAGE] + payload, flags, metadata)
+            else:
+                buffers = self._frame_writer.frame(DESCRIPTOR.size, DESCRIPTOR.pack(SLOT_MESSAGE, sequence), flags,
+                                                   metadata)
+        else:
+            buffers = self._frame_writer.frame(size, f, flags, metadata)
+        if dependencies is not None:
+            # the same message with the same sequence number for receivers that miss what it depends on
+            requires, provides, standalone = dependencies
+            dependencies = (requires, provides, self._frame_writer.frame(*standalone, flags=flags, metadata=metadata,
+                                                                         sequence=self._frame_writer.sequence))
+        if self.as_server:
+            # serialized once, the same buffers are written to every client by the server thread
+            start = time.perf_counter()
+            self._fan_out.publish(buffers, dependencies)
+            if self.slow_consumer_policy == BLOCK_ON_SLOW:
+                self._fan_out.wait_sent()
+        else:
+            [self._send_f(connection, size, connection.select(buffers, dependencies))
+             for connection in self.connected_clients if connection.connected]
+        self.metrics.record('write', time.perf_counter() - start)
+        self.metrics.count(sum(len(buffer) for buffer in buffers) if size is None else size, messages)
 
-    def _send_f(self, connection, size, file):
+    def _send_f(self, connection, size, buffers):
+        start = time.perf_counter()
         try:
-            if not self.send_type == RAW:
-                connection[0].send(struct.pack('I', size))
-            connection[0].sendall(file)  # Send data
+            # header and payload go out in the same system call
+            with self._write_lock:
+                _sendmsg_all(connection.socket, buffers)
+            connection.sent_messages += 1
+            connection.sent_bytes += sum(len(buffer) for buffer in buffers)
+            if self.compressor is not None and size:
+                self.compressor.observe_send(size, time.perf_counter() - start)
         except ConnectionError as e:
             if self.verbose:
                 print(e)
-            connection[2] = False
+            connection.connected = False
 
 
 class TCPReceiveSocket(object):
@@ -261,26 +616,83 @@ class TCPReceiveSocket(object):
                  as_server=False,
                  receive_as_raw=False,
                  receive_buffer_size=4095,
-                 as_daemon=True):
+                 as_daemon=True,
+                 deliver_batches=False,
+                 chunk_size=None,
+                 chunk_handler=None,
+                 buffer_pool=None,
+                 worker_threads=4,
+                 decode_processes=0,
+                 decode_inline_size=64 * 1024,
+                 metrics_callback=None,
+                 metrics_interval=1.0,
+                 trace_callback=None):
         """
         Receiving TCP socket to be used with TCPSendSocket.
-        :param tcp_port: TCP port to use.
+        :param tcp_port: TCP port to use. Ignored for unix domain sockets.
         :param handler_function: The handle to a function that will be called everytime a message is received. Must take
                one parameter that is the message. The message is exactly what was sent from TCPSendSocket.
                example:
                         def my_handler(received_data):
                             print(received_data)
-        :param tcp_ip: ip address to connect to.
+               If None, no handler thread is started. Messages can then be read from new_data or handled with
+               subscribe().
+        :param tcp_ip: ip address to connect to. 'unix:///path/to/file' uses a unix domain socket at that path instead,
+               which is faster for peers on the same host.
         :param verbose: Whether or not to print errors and status messages.
         :param as_server: Whether to run this socket as a server (default: False) or client. This needs to be opposite
                           whatever the SendSocket is configured to be.
         :param receive_as_raw: Whether or not the incoming data is just raw bytes or is a predefined format (JSON, NUMPY, HDF)
         :param receive_buffer_size: available buffer size in bytes when receiving messages
         :param as_daemon: runs underlying threads as daemon.
+        :param deliver_batches: When the sender batches messages (see TCPSendSocket batch_interval), pass the handler
+               the list of messages of a batch instead of calling it once per message.
+        :param chunk_size: When set, ARRAY messages are received in chunks of this many bytes straight into the
+               destination arrays instead of into a receive buffer of the full message size first. Meant for very
+               large arrays. Batched messages are always received as a whole.
+        :param chunk_handler: optional function called from the receiving thread after every chunk of a chunked
+               ARRAY message as chunk_handler(key, array, received_bytes, total_bytes). array is the partially filled
+               destination array, so processing can start before the transfer finished. The complete message is
+               passed to handler_function as usual.
+        :param buffer_pool: a DataSocket.BufferPool to take receive buffers from instead of allocating a new one for
+               every message. Buffers go back to the pool once handler_function returned. ARRAY data and the arrays
+               of BINARY messages are views into the receive buffer, so with a pool they are only valid inside
+               handler_function. To keep them longer, call retain_message() inside handler_function and release()
+               the returned buffer when done, or copy them. new_data should not be read from other threads when a
+               pool is used.
+        :param worker_threads: number of threads shared by the handlers subscribed with execution=DataSocket.POOL.
+        :param decode_processes: When set, NUMPY, JSON and HDF messages of at least decode_inline_size bytes are
+               decompressed and decoded by this many worker processes instead of the receiving thread. Handlers still
+               get the messages in the order received. NUMPY messages arrive as a dict of arrays instead of an npz
+               file. Scripts using this must start the socket under if __name__ == '__main__' on platforms that
+               spawn processes (windows, macOS).
+        :param decode_inline_size: messages smaller than this many bytes are decoded on the receiving thread, because
+               handing them to a worker process takes longer than decoding them.
+        :param metrics_callback: optional function called with stats() every metrics_interval seconds from a thread
+               of its own. No thread is started if None.
+        :param metrics_interval: time in seconds between calls of metrics_callback.
+        :param trace_callback: optional function called with a DataSocket.Tracing.MessageTrace for every message
+               (or batch) from a sender with trace=True, once all handlers are done with it. The trace holds the
+               timestamps of every stage on the clock of this socket and stages() returns their durations. It is
+               called from the thread of the handler that finished last and should return quickly. The durations
+               are also summarized in stats()['trace'].
         """
+        if chunk_handler is not None and not callable(chunk_handler):
+            raise ValueError("chunk_handler must be a callable function taking four inputs.")
         self.receive_buffer_size = receive_buffer_size
+        self.deliver_batches = deliver_batches
+        self.chunk_size = chunk_size
+        self.chunk_handler = chunk_handler
+        self.buffer_pool = buffer_pool
+        self.batched = False
+        self.frame_version = LEGACY_FRAMES
+        self.last_header = None  # header of the last received FRAME_V2 message
+        self.last_sequence = None
+        self.missed_messages = 0  # gaps in the sequence numbers of FRAME_V2 messages
+        self.out_of_order_messages = 0
         self.receive_as_raw = receive_as_raw
         self.max_tcp_packet_size = 1408
+        subscribed = handler_function is not None
         if handler_function is None:
             def pass_func(data):
                 pass
@@ -292,25 +704,47 @@ class TCPReceiveSocket(object):
         self.verbose = verbose
         self.handler_function = handler_function
         self._new_data = None
+        self.metrics = Metrics(('read', 'decode'))
+        self._metrics_reporter = None
+        if metrics_callback is not None:
+            self._metrics_reporter = MetricsReporter(self.stats, metrics_callback, metrics_interval, as_daemon)
+        self._tracer = TraceRecorder(trace_callback, verbose)
+        self._traced = False  # whether the sender traces its messages
+        self.dispatcher = Dispatcher(worker_threads, verbose, as_daemon)
+        if subscribed:
+            # handler_function only ever gets the newest message, like before there were subscriptions
+            self.subscribe(handler_function)
+        self._decode_pool = None  # type: DecodePool
+        if decode_processes:
+            self._decode_pool = DecodePool(self._deliver, decode_processes, decode_inline_size, verbose=verbose,
+                                           as_daemon=as_daemon)
+        self._frame_header = bytearray(HEADER.size)
+        self._shared_memory = None  # type: SharedMemoryReader
+        self._array_decoder = None  # SchemaDecoder or DeltaDecoder if the sender caches schemas or sends deltas
+        self._handshake = None  # Handshake of the current connection
         self._new_data_lock = Lock()
-        self.new_data_flag = Event()
-        self.handler_thread = Thread(target=self._handler, daemon=as_daemon)
         self.thread = Thread(target=self._run, daemon=as_daemon)
-        self.socket = _get_socket()
         self.port = int(tcp_port)
         self.ip = tcp_ip
+        self.unix_path = unix_path(tcp_ip)
+        self.address = (tcp_ip, self.port) if self.unix_path is None else self.unix_path
+        self.socket = _get_socket(self.unix_path is not None)
+        self._socket_file = None  # unix domain socket file bound by this socket
         self.block_size = 0
         self.is_connected = False
         self.shut_down_flag = Event()
         self.data_mode = None
         self.as_server = as_server
         self.connection = None
+        self._waker = Waker()
 
     def start(self, blocking=False):
         """
         Start the socket service.
         :param blocking: Will block the calling thread until a connection is established.
         """
+        if self._metrics_reporter is not None:
+            self._metrics_reporter.start()
         self.thread.start()
         if blocking:
             while not self.is_connected:
@@ -321,14 +755,30 @@ class TCPReceiveSocket(object):
         Stop the socket and it's associated threads.
         """
         self.shut_down_flag.set()
+        if self._metrics_reporter is not None:
+            self._metrics_reporter.stop()
+        # wake up the threads blocked waiting for a connection, data or a new message
+        self._waker.wake()
+        _shutdown(self.connection)
         if self.thread.is_alive():
             self.thread.join(timeout=2)
 
-        if self.handler_thread.is_alive():
-            self.handler_thread.join(timeout=2)
+        if self._decode_pool is not None:
+            self._decode_pool.close()
+        self.dispatcher.close()  # messages that were not handled yet are dropped
         self.shut_down_flag.clear()
+        self._waker.clear()
         self.socket.close()
-        self.socket = _get_socket()
+        self.socket = _get_socket(self.unix_path is not None)
+        if self._socket_file is not None:
+            remove_socket_file(self._socket_file)
+            self._socket_file = None
+        self._close_shared_memory()
+
+    def _close_shared_memory(self):
+        if self._shared_memory is not None:
+            self._shared_memory.close()
+            self._shared_memory = None
 
     @property
     def new_data(self):
@@ -340,33 +790,155 @@ class TCPReceiveSocket(object):
         with self._new_data_lock:
             self._new_data = data
 
+    def _deliver(self, data, lease=None, trace=None):
+        """
+        Pass a received message (or batch) to every subscribed handler.
+        :param lease: PooledBuffer the data point into. Released once every handler is done with it.
+        :param trace: MessageTrace of the message. Reported once every handler is done with it.
+        """
+        if trace is not None and trace.decoded is None:
+            trace.decoded = time.time()  # decoded by the decode pool
+        self.new_data = data
+        self.metrics.messages += len(data) if self.batched else 1
+        self.dispatcher.dispatch(data if self.batched else [data], lease, self.batched and self.deliver_batches,
+                                 trace)
+        if lease is not None:
+            lease.release()  # the subscriptions retained it as long as they need it
+        if trace is not None:
+            trace.release()
+
+    def subscribe(self,
+                  handler,
+                  execution=THREAD,
+                  queue_size=1,
+                  queue_policy=LATEST,
+                  ordering=STRICT,
+                  order_key=None,
+                  concurrency=1):
+        """
+        Add a handler that is called with every received message, in addition to handler_function. Messages are
+        decoded once and passed to every handler. Each handler has its own backlog, so a slow handler only misses its
+        own messages. Can be called before or after start().
+            example:
+                    receive_socket.subscribe(plot, queue_policy=DataSocket.LATEST)  # only ever draws the newest
+                    receive_socket.subscribe(log, queue_size=1000, queue_policy=DataSocket.BLOCK)  # sees every message
+                    receive_socket.subscribe(process, execution=DataSocket.POOL, ordering=DataSocket.PER_KEY,
+                                             order_key='sensor', concurrency=4, queue_size=100,
+                                             queue_policy=DataSocket.DROP_OLDEST)
+        :param handler: function taking one parameter, the message.
+        :param execution: DataSocket.THREAD calls the handler on a thread of its own. DataSocket.POOL calls it on the
+               worker_threads shared by all POOL handlers of this socket. DataSocket.INLINE calls it on the receiving
+               thread, which stops receiving until the handler returned.
+        :param queue_size: maximum number of messages waiting for the handler.
+        :param queue_policy: what to do with a new message while queue_size messages are waiting:
+               DataSocket.LATEST only keeps the newest message, DROP_OLDEST and DROP_NEWEST discard the oldest waiting
+               or the new message, BLOCK stops receiving until there is room (which holds up the other handlers too).
+        :param ordering: for POOL handlers. DataSocket.STRICT handles one message at a time in the order received.
+               PER_KEY handles messages with the same order_key in order and different keys in parallel. UNORDERED
+               handles up to concurrency messages in parallel.
+        :param order_key: with PER_KEY, the dict key whose value groups the messages or a function taking a message
+               and returning its group.
+        :param concurrency: maximum number of messages of this handler handled in parallel with PER_KEY or
+               UNORDERED.
+        :return: Subscription to pass to unsubscribe(). Its stats() tell how many messages were handled, dropped and
+                 are waiting.
+        """
+        return self.dispatcher.subscribe(handler, execution, queue_size, queue_policy, ordering, order_key,
+                                         concurrency)
+
+    def unsubscribe(self, subscription):
+        """
+        Remove a handler added with subscribe(). Messages still waiting for it are dropped.
+        """
+        self.dispatcher.unsubscribe(subscription)
+
+    def handler_stats(self):
+        """
+        :return: list with a dict per handler (handler_function first, if given) holding the number of messages
+                 handled, dropped and waiting, the highest number that waited, exceptions raised and the time spent in
+                 the handler.
+        """
+        return self.dispatcher.stats()
+
+    def decode_stats(self):
+        """
+        :return: dict with the number of messages decoded by worker processes and on the receiving thread, messages
+                 being decoded and decoding errors, or None if decode_processes is not set.
+        """
+        if self._decode_pool is None:
+            return None
+        return self._decode_pool.stats()
+
+    def stats(self):
+        """
+        Snapshot of what the socket did so far: messages delivered to the handlers (every message of a batch counts),
+        bytes received, decoding errors, connections, missed and out of order messages and histograms of the time
+        spent receiving the payload of a message (read_seconds), decoding it on the receiving thread
+        (decode_seconds) and in the handlers (handler_seconds), plus handler_stats() as handlers and decode_stats()
+        as decode_pool. For senders with trace=True, trace holds the number of traced messages, the estimated
+        offset between the clocks of sender and receiver (clock_offset, sender minus receiver, in seconds) and
+        histograms of the durations of every stage (see DataSocket.Tracing.STAGES) as <stage>_seconds.
+        :return: dict
+        """
+        stats = self.metrics.snapshot()
+        stats['handler_seconds'] = self.dispatcher.handler_time().snapshot()
+        stats['missed_messages'] = self.missed_messages
+        stats['out_of_order_messages'] = self.out_of_order_messages
+        stats['handlers'] = self.handler_stats()
+        stats['decode_pool'] = self.decode_stats()
+        stats['trace'] = self._tracer.snapshot()
+        if self._decode_pool is not None:
+            stats['errors'] += self._decode_pool.errors
+        return stats
+
+    def retain_message(self):
+        """
+        Keep the receive buffer of the message currently passed to a handler from being reused. Only needed with a
+        buffer_pool, when ARRAY or BINARY arrays have to outlive the call to the handler. Must be called from inside the
+        handler.
+            example:
+                    def my_handler(received_data):
+                        buffer = receive_socket.retain_message()
+                        work_queue.put((received_data, buffer))  # the worker calls buffer.release() when done
+        :return: DataSocket.PooledBuffer to release() once the data are not used anymore. Can be used in a with
+                 statement.
+        """
+        lease = current_lease()
+        if lease is None:
+            return PooledBuffer(None, None, 0)
+        return lease.retain()
+
     def _establish_connection(self):
         while not self.is_connected:
             if self.shut_down_flag.is_set():
                 break
-            self.socket = _get_socket()
+            self.socket.close()  # the listening socket or connection of the previous connection
+            self.socket = _get_socket(self.unix_path is not None)
             if self.as_server:
-                self.socket.bind((self.ip, self.port))
+                self._socket_file = _bind(self.socket, self.address, self.verbose)
                 self.socket.setblocking(False)
-                if self.verbose:
-                    print('listening on port ', self.port)
                 self.socket.listen(1)
                 while not self.is_connected:
-                    if self.shut_down_flag.is_set():
-                        return
+                    if not wait_readable(self.socket, self._waker) or self.shut_down_flag.is_set():
+                        if self.shut_down_flag.is_set():
+                            return
+                        continue
                     try:
                         self.connection, client_address = self.socket.accept()
                     except BlockingIOError as e:
                         continue
                     self.is_connected = True
             else:
-
+                retry_delay = _FIRST_RETRY_DELAY
                 while not self.is_connected:
                     try:
-                        self.socket.connect((self.ip, self.port))
+                        self.socket.connect(self.address)
                     except (ConnectionError, OSError) as e:
-                        self.socket = _get_socket()
-                        time.sleep(0.001)
+                        self.socket.close()
+                        self.socket = _get_socket(self.unix_path is not None)
+                        if self.shut_down_flag.wait(retry_delay):
+                            return
+                        retry_delay = min(2 * retry_delay, _MAX_RETRY_DELAY)
                         continue
                     self.connection = self.socket
                     self.is_connected = True
@@ -374,44 +946,62 @@ class TCPReceiveSocket(object):
     def _initialize(self):
         while not self.is_connected and not self.shut_down_flag.is_set():
             self._establish_connection()
+            if not self.is_connected:  # stopped while connecting
+                continue
             if not self.receive_as_raw:
                 try:
                     bytes_received = self.connection.recv(4)
-                except (BlockingIOError, AttributeError) as e:
-                    if isinstance(e, AttributeError):
+                except (BlockingIOError, AttributeError, ConnectionError) as e:
+                    if isinstance(e, (AttributeError, ConnectionError)):
                         self.is_connected = False
                         continue
                     if self.verbose: print(e)
                     time.sleep(0.25)
                     bytes_received = self.connection.recv(4)
+                if len(bytes_received) < 4:  # connection closed before the handshake
+                    self.is_connected = False
+                    continue
 
-                data_type = struct.unpack('I', bytes_received)[0]
+                self.metrics.connections += 1
+                handshake = parse_handshake(bytes_received)
+                self._handshake = handshake
+                data_type, self.batched, self.frame_version = handshake[:3]
+                self._array_decoder = SchemaDecoder() if handshake.schemas else \
+                    DeltaDecoder() if handshake.deltas else None
+                self.last_sequence = None
+                self._traced = handshake.trace
+                if self._traced:
+                    self._tracer.clock.reset()
+                self._close_shared_memory()
+                if handshake.shared_memory and not self._attach_shared_memory():
+                    _shutdown(self.connection)
+                    self.is_connected = False
+                    self.shut_down_flag.wait(_MAX_RETRY_DELAY)
+                    continue
             else:
                 data_type = RAW
 
-            if data_type == NUMPY:
-                self.data_mode = NUMPY
-                if self.verbose:
-                    print('Expecting numpy files on receive.')
-            elif data_type == JSON:
-                self.data_mode = JSON
+            if data_type in SEND_TYPE_NAMES:
+                self.data_mode = data_type
                 if self.verbose:
-                    print('Expecting json message on receive.')
-            elif data_type == HDF:
-                self.data_mode = HDF
-                if self.verbose:
-                    print('Expecting HDF5 files on receive.')
-            elif data_type == RAW:
-                self.data_mode = RAW
-                if self.verbose:
-                    print('Expecting raw data on receive.')
+                    print('Expecting ' + SEND_TYPE_NAMES[data_type] + ' on receive.')
 
-            self.new_data_flag.clear()
-            if not self.handler_thread.is_alive():
-                try:
-                    self.handler_thread.start()
-                except RuntimeError:
-                    pass
+    def _attach_shared_memory(self):
+        if self.as_server:
+            self.connection.setblocking(True)
+        length = bytearray(NAME_LENGTH.size)
+        if not self._receive_into(memoryview(length)):
+            return False
+        name = bytearray(NAME_LENGTH.unpack(length)[0])
+        if not self._receive_into(memoryview(name)):
+            return False
+        try:
+            self._shared_memory = SharedMemoryReader(name.decode())
+        except (OSError, ValueError, RuntimeError) as e:  # i.e. the sender runs on another host
+            if self.verbose:
+                print(e)
+            return False
+        return True
 
     def _run(self):
         while not self.shut_down_flag.is_set():
@@ -423,6 +1013,8 @@ class TCPReceiveSocket(object):
             except BlockingIOError as e:
                 if self.verbose: print(e)
                 self.is_connected = False
+            if not self.shut_down_flag.is_set():
+                self.metrics.disconnects += 1
 
     def _receive_data_raw(self):
         self._initialize()
@@ -463,7 +1055,8 @@ class TCPReceiveSocket(object):
             except BlockingIOError as e:
                 if total_received > 0:
                     nbytes = -1
-                    self.new_data = bytes(buf[:total_received])
+                    self.metrics.bytes += total_received
+                    self._deliver(bytes(buf[:total_received]))
                     view = memoryview(buf)
                 continue
 
@@ -472,7 +1065,65 @@ class TCPReceiveSocket(object):
                 continue
             nbytes = 0
             total_received = 0
-            self.new_data_flag.set()
+
+    def _receive_into(self, view):
+        """
+        Fill view with data from the connection.
+        :return: False if the connection was closed or the socket is shutting down before view was filled.
+        """
+        toread = len(view)
+        while toread and self.is_connected:
+            if self.shut_down_flag.is_set():
+                return False
+            try:
+                nbytes = self.connection.recv_into(view, toread)
+            except OSError as e:
+                if self.verbose: print(e)
+                self.is_connected = False
+                return False
+            if nbytes == 0:
+                self.is_connected = False
+                return False
+            view = view[nbytes:]  # slicing views is cheap
+            toread -= nbytes
+        return toread == 0
+
+    def _acquire(self, size):
+        if self.buffer_pool is None:
+            return PooledBuffer(None, bytearray(size), size)
+        return self.buffer_pool.acquire(size)
+
+    def _read_shared_memory(self, descriptor):
+        """
+        Copy the message announced by a descriptor out of the shared memory ring.
+        :param descriptor: PooledBuffer holding the descriptor. It is released.
+        :return: PooledBuffer holding the message or None if it was already overwritten by the sender.
+        """
+        sequence = DESCRIPTOR.unpack(descriptor.view)[1]
+        descriptor.release()
+        size = self._shared_memory.message_size(sequence)
+        if size is None:
+            return None
+        lease = self._acquire(size)
+        if not self._shared_memory.read_into(sequence, lease.view):
+            lease.release()
+            return None
+        return lease
+
+    def _ping(self, now):
+        try:
+            self.connection.sendall(self._tracer.clock.ping(now))
+        except OSError as e:
+            if self.verbose:
+                print(e)
+
+    def _check_sequence(self, sequence):
+        if self.last_sequence is not None:
+            if sequence <= self.last_sequence:
+                self.out_of_order_messages += 1
+                return
+            self.missed_messages += sequence - self.last_sequence - 1
+        self.last_sequence = sequence
 
     def _receive_data(self):
         self._initialize()
@@ -482,79 +1133,111 @@ class TCPReceiveSocket(object):
             except AttributeError as e:
                 self.is_connected = False
         while self.is_connected and not self.shut_down_flag.is_set():
-            toread = 4
-            buf = bytearray(toread)
-            view = memoryview(buf)
-            while toread and self.is_connected:
-                if self.shut_down_flag.is_set():
+            header = None
+            trace = None
+            if self._traced:
+                now = time.time()
+                if self._tracer.clock.due(now):
+                    self._ping(now)
+            if self.frame_version == FRAME_V2:
+                buf = memoryview(self._frame_header)[:HEADER.size]
+                if not self._receive_into(buf):
                     return
-                try:
-                    nbytes = self.connection.recv_into(view, toread)
-                except OSError as e:
-                    if self.verbose: print(e)
-                    self.is_connected = False
-                    return
-                if nbytes == 0:
-                    self.is_connected = False
-                    return
-                view = view[nbytes:]  # slicing views is cheap
-                toread -= nbytes
-
-            toread = int.from_bytes(buf, "little")
-            buf = bytearray(toread)
-            view = memoryview(buf)
-            while toread and self.is_connected:
-                if self.shut_down_flag.is_set():
-                    return
-                try:
-                    nbytes = self.connection.recv_into(view, toread)
-                except OSError as e:
-                    if self.verbose: print(e)
-                    self.is_connected = False
-                    return
-                if nbytes == 0:
-                    self.is_connected = False
+                received = time.time()
+                header = parse_header(buf)
+                metadata = None
+                if header.metadata_size:
+                    metadata = bytearray(header.metadata_size)
+                    if not self._receive_into(memoryview(metadata)):
+                        return
+                if header.flags & FLAG_PONG:
+                    self._tracer.clock.pong(*PONG.unpack_from(metadata), header.time, received)
+                    continue
+                if header.flags & FLAG_TRACE:
+                    trace = self._tracer.start(header.sequence, metadata, header.time, received)
+                toread = header.size
+            else:
+                buf = memoryview(self._frame_header)[:LEGACY_HEADER.size]
+                if not self._receive_into(buf):
                     return
-                view = view[nbytes:]  # slicing views is cheap
-                toread -= nbytes
+                toread = LEGACY_HEADER.unpack(buf)[0]
 
-            if self.data_mode == NUMPY:
-                as_file = BytesIO(buf)
-                as_file.seek(0)
+            self.metrics.bytes += len(buf) + toread
+            start = time.perf_counter()
+            if self.chunk_size and self.data_mode == ARRAY and not self.batched and self._shared_memory is None and \
+                    self._array_decoder is None and (header is None or header.codec == NONE):
                 try:
-                    self.new_data = np.load(as_file)
-                except OSError as e:
+                    data = receive_arrays(self._receive_into, toread, self.chunk_size, self.chunk_handler)
+                except ValueError as e:
+                    # the stream can not be resynchronized after a malformed header
+                    self.metrics.errors += 1
                     if self.verbose:
                         print(e)
-                    continue
+                    return
+                if data is None:
+                    return
+                self.metrics.record('read', time.perf_counter() - start)
+                if header is not None:
+                    self._check_sequence(header.sequence)
+                    self.last_header = header
+                if trace is not None:
+                    trace.read = trace.decoded = time.time()
+                self._deliver(data, trace=trace)
+                continue
 
-            elif self.data_mode == JSON:
-                self.new_data = json.loads(buf.decode())
+            lease = self._acquire(toread)
+            buf = lease.view
+            if not self._receive_into(buf):
+                lease.release()
+                return
+            if self._shared_memory is not None:
+                if bytes(buf[:1]) == INLINE_MESSAGE:
+                    buf = buf[1:]
+                else:
+                    lease = self._read_shared_memory(lease)
+                    if lease is None:
+                        self.missed_messages += 1
+                        continue
+                    buf = lease.view
+            self.metrics.record('read', time.perf_counter() - start)
+            if trace is not None:
+                trace.read = time.time()
 
-            elif self.data_mode == HDF:
-                as_file = BytesIO(buf)
-                as_file.seek(0)
-                try:
-                    data = h5py.File(as_file, 'r')
-                    if len(data.keys()) > 1:
-                        new_data = {}
-                        for key in data.keys():
-                            new_data[key] = np.array(data.get(key))
-                    else:
-                        new_data = np.array(data.get(list(data.keys())[0]))
-                    self.new_data = new_data
-                except OSError as e:
-                    if self.verbose:
-                        print(e)
-                    continue
+            if self._decode_pool is not None and self.data_mode in (NUMPY, JSON, HDF):
+                if header is not None:
+                    self._check_sequence(header.sequence)
+                    self.last_header = header
+                # the pool copies or decodes the message before returning and delivers it in order
+                self._decode_pool.submit(self.data_mode, self.batched, None if header is None else header.codec, buf,
+                                         trace)
+                lease.release()
+                continue
 
-            self.new_data_flag.set()
+            start = time.perf_counter()
+            try:
+                if header is not None:
+                    self._check_sequence(header.sequence)
+                    self.last_header = header
+                    buf = decompress(buf, header.codec)
+                if self.batched:
+                    data = decode_batch(self.data_mode, buf, self._array_decoder)
+                else:
+                    data = decode(self.data_mode, buf, self._array_decoder)
+            except (OSError, ValueError) as e:
+                self.metrics.errors += 1
+                if self.verbose:
+                    print(e)
+                lease.release()
+                continue
+            self.metrics.record('decode', time.perf_counter() - start)
+            if trace is not None:
+                trace.decoded = time.time()
 
-    def _handler(self):
-        while True:
-            while not self.new_data_flag.is_set():
-                if self.shut_down_flag.is_set():
-                    return
-                time.sleep(0.001)
-            self.new_data_flag.clear()
-            self.handler_function(self.new_data)
+            if self.data_mode in (ARRAY, BINARY):
+                # ARRAY and BINARY arrays are views into the receive buffer, which is released once the message was
+                # handled
+                self._deliver(data, lease, trace)
+            else:
+                # all other send types are copied out of the receive buffer while decoding
+                lease.release()
+                self._deliver(data, trace=trace)
@@ -0,0 +1,235 @@
+"""
+End-to-end tracing of single messages, enabled with TCPSendSocket(trace=True).
+
+The sender stamps every message when it was queued, taken from the queue and encoded and sends the stamps in the
+metadata of its FRAME_V2 frame, whose header already holds the time it was framed. The receiver adds when the frame
+header arrived, the payload was read and decoded and when the handlers started and finished with the message.
+
+To compare stamps taken on different hosts, the receiver estimates the offset between the two clocks like NTP does:
+it writes a PING with its own time to the connection and the sender answers with a FLAG_PONG frame holding the ping
+time, the time the ping arrived and (in the frame header) the time the answer was sent. Of the last few exchanges, the
+one with the shortest round trip gives the offset, so answers delayed behind large messages do not distort it.
+"""
+import struct
+from collections import deque
+from threading import Lock
+from .Metrics import Histogram
+
+STAMPS = struct.Struct('<ddd')  # metadata of traced frames: enqueued, dequeued, encoded (sender clock)
+PING = struct.Struct('<4sd')  # magic, receiver time
+PONG = struct.Struct('<dd')  # metadata of pong frames: ping time (receiver clock), ping arrival (sender clock)
+PING_MAGIC = b'DSPI'
+
+# durations reported for every traced message
+STAGES = ('queue',  # waiting in the send queue
+          'encode',  # encoding (for batches, until the batch was complete)
+          'transit',  # from framing until the frame header arrived: writing, network and waiting to be read
+          'read',  # receiving the payload
+          'decode',  # decoding, including waiting for the decode pool
+          'dispatch',  # until the first handler started
+          'handler',  # from the first handler starting until the last one finished
+          'total')  # from send_data() until the last handler finished
+
+_SYNC_SAMPLES = 8  # number of exchanges the offset is chosen from
+_SYNC_SPACING = 0.05  # seconds between pings until that many exchanges were made
+_SYNC_RETRY = 1.0  # seconds until an unanswered ping is repeated
+
+
+class PingReader(object):
+    def __init__(self):
+        """
+        Splits the bytes a receiver writes to its connection into pings.
+        """
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """
+        :param data: bytes read from the connection.
+        :return: list with the receiver time of every complete ping.
+        """
+        self._buffer += data
+        times = []
+        while len(self._buffer) >= PING.size:
+            magic, sent = PING.unpack_from(self._buffer)
+            if magic != PING_MAGIC:  # not written by a receiving socket, there is nothing to resynchronize to
+                self._buffer.clear()
+                break
+            del self._buffer[:PING.size]
+            times.append(sent)
+        return times
+
+
+class ClockSync(object):
+    def __init__(self, interval=10.0):
+        """
+        Estimate of the offset between the clock of the sender and the receiver.
+        :param interval: time in seconds between pings once the estimate settled.
+        """
+        self.interval = interval
+        self.offset = None  # sender clock minus receiver clock in seconds
+        self.round_trip = None  # round trip of the exchange the offset was taken from
+        self._samples = deque(maxlen=_SYNC_SAMPLES)
+        self._next_ping = 0.0
+
+    def reset(self):
+        """
+        Forget the estimate, i.e. after connecting to another sender.
+        """
+        self.offset = None
+        self.round_trip = None
+        self._samples.clear()
+        self._next_ping = 0.0
+
+    def due(self, now):
+        return now >= self._next_ping
+
+    def ping(self, now):
+        """
+        :param now: current time of the receiver.
+        :return: the bytes to write to the connection.
+        """
+        self._next_ping = now + _SYNC_RETRY
+        return PING.pack(PING_MAGIC, now)
+
+    def pong(self, pinged, arrived, answered, now):
+        """
+        Add an exchange.
+        :param pinged: receiver time the ping was written.
+        :param arrived: sender time the ping arrived.
+        :param answered: sender time the answer was written.
+        :param now: receiver time the answer arrived.
+        """
+        round_trip = (now - pinged) - (answered - arrived)
+        self._samples.append((round_trip, ((arrived - pinged) + (answered - now)) / 2))
+        self.round_trip, self.offset = min(self._samples)
+        settled = len(self._samples) == self._samples.maxlen
+        self._next_ping = now + (self.interval if settled else _SYNC_SPACING)
+
+
+def _between(start, end):
+    return None if start is None or end is None else end - start
+
+
+class MessageTrace(object):
+    __slots__ = ('sequence', 'enqueued', 'dequeued', 'encoded', 'sent', 'received', 'read', 'decoded',
+                 'handler_start', 'handler_end', 'clock_offset', '_recorder', '_references', '_lock')
+
+    def __init__(self, recorder, sequence, stamps, sent, received, clock_offset):
+        """
+        Timestamps of one message (or batch of messages) in seconds since the epoch on the clock of the receiver.
+        Stamps of stages the message did not reach are None.
+        :param recorder: TraceRecorder the trace is reported to once all handlers are done with the message.
+        :param sequence: sequence number of the frame.
+        :param stamps: enqueued, dequeued and encoded time as sent by the sender.
+        :param sent: time the frame was framed as sent by the sender.
+        :param received: time the frame header arrived.
+        :param clock_offset: sender clock minus receiver clock or None if not known yet, in which case the sender
+               stamps are taken as they are.
+        """
+        offset = clock_offset or 0.0
+        self.sequence = sequence
+        self.enqueued, self.dequeued, self.encoded = (stamp - offset for stamp in stamps)
+        self.sent = sent - offset
+        self.received = received
+        self.read = None
+        self.decoded = None
+        self.handler_start = None
+        self.handler_end = None
+        self.clock_offset = clock_offset
+        self._recorder = recorder
+        self._references = 1
+        self._lock = Lock()
+
+    def handled(self, start, end):
+        """
+        Note that a handler ran from start to end.
+        """
+        with self._lock:
+            if self.handler_start is None or start < self.handler_start:
+                self.handler_start = start
+            if self.handler_end is None or end > self.handler_end:
+                self.handler_end = end
+
+    def stages(self):
+        """
+        :return: dict with the duration in seconds of every stage in STAGES, None for stages that were not reached.
+        """
+        last = next(stamp for stamp in (self.handler_end, self.decoded, self.read, self.received) if stamp is not None)
+        return {'queue': self.dequeued - self.enqueued,
+                'encode': self.encoded - self.dequeued,
+                'transit': self.received - self.sent,
+                'read': _between(self.received, self.read),
+                'decode': _between(self.read, self.decoded),
+                'dispatch': _between(self.decoded, self.handler_start),
+                'handler': _between(self.handler_start, self.handler_end),
+                'total': last - self.enqueued}
+
+    def retain(self):
+        with self._lock:
+            self._references += 1
+        return self
+
+    def release(self):
+        """
+        Give up one reference. The trace is reported once the last reference was released.
+        """
+        with self._lock:
+            self._references -= 1
+            if self._references:
+                return
+        self._recorder.finish(self)
+
+    def __repr__(self):
+        return 'MessageTrace(' + ', '.join('{}={:.6f}'.format(stage, seconds)
+                                           for stage, seconds in self.stages().items() if seconds is not None) + ')'
+
+
+class TraceRecorder(object):
+    def __init__(self, callback=None, verbose=True):
+        """
+        Collects the traces of a receiving socket.
+        :param callback: optional function called with every finished MessageTrace, from the thread that finished
+               it last.
+        :param verbose: Whether or not to print exceptions raised by callback.
+        """
+        if callback is not None and not callable(callback):
+            raise ValueError("trace_callback must be a callable function taking one input.")
+        self.callback = callback
+        self.verbose = verbose
+        self.clock = ClockSync()
+        self.messages = 0
+        self.histograms = {stage: Histogram() for stage in STAGES}
+        self._lock = Lock()
+
+    def start(self, sequence, metadata, sent, received):
+        """
+        :param metadata: metadata of a FLAG_TRACE frame.
+        :return: MessageTrace of the frame.
+        """
+        return MessageTrace(self, sequence, STAMPS.unpack_from(metadata), sent, received, self.clock.offset)
+
+    def finish(self, trace):
+        with self._lock:
+            self.messages += 1
+            for stage, seconds in trace.stages().items():
+                if seconds is not None:
+                    self.histograms[stage].record(seconds)
+        if self.callback is not None:
+            try:
+                self.callback(trace)
+            except Exception as e:
+                if self.verbose:
+                    print('trace_callback raised', repr(e))
+
+    def snapshot(self):
+        """
+        :return: dict with the number of traced messages, the clock offset and the round trip it was measured with
+                 and a histogram snapshot of every stage as <stage>_seconds.
+        """
+        with self._lock:
+            stats = {'messages': self.messages,
+                     'clock_offset': self.clock.offset,
+                     'round_trip': self.clock.round_trip}
+            for stage, histogram in self.histograms.items():
+                stats[stage + '_seconds'] = histogram.snapshot()
+        return stats
@@ -1,15 +1,24 @@
 from threading import Event, Thread, Lock
-from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SOCK_DGRAM
-import time
-from io import BytesIO
-import numpy as np
-import os
+from socket import socket, AF_INET, SOL_SOCKET, SO_REUSEADDR, SO_RCVBUF, SOCK_DGRAM, IPPROTO_IP, \
+    IP_MULTICAST_TTL, IP_MULTICAST_LOOP, IP_MULTICAST_IF, IP_ADD_MEMBERSHIP, IP_DROP_MEMBERSHIP, INADDR_ANY, \
+    inet_aton
+import ipaddress
+import random
 import struct
-import json
+import time
+from .Serialization import NUMPY, RAW, Encoded, encode, decode, encode_batch, decode_batch
+from .Datagrams import Reassembler, fragment, path_datagram_size, MAX_DATAGRAM_SIZE, MAX_MESSAGE_SIZE, HEADER, \
+    FLAG_BATCH
+from .Codecs import get_compressor
+from .SendQueue import SendQueue, Empty, LATEST
+from .Metrics import Metrics, MetricsReporter
+from .Waker import Waker, wait_readable
 
 
-NUMPY = 1
-JSON = 2
+# upper bound of the bytes encode_batch adds per message
+_BATCH_OVERHEAD = 4
+# maximum number of datagrams read per wake up of the receiving thread
+_DATAGRAMS_PER_WAKEUP = 256
 
 
 def _get_socket():
@@ -18,85 +27,262 @@ def _get_socket():
     return new_socket
 
 
+def _is_multicast(ip):
+    try:
+        return ipaddress.ip_address(ip).is_multicast
+    except ValueError:  # a host name
+        return False
+
+
+def _membership(group, interface):
+    """
+    :return: the ip_mreq structure for joining or leaving a multicast group on an interface (any interface if None).
+    """
+    if interface is None:
+        return inet_aton(group) + struct.pack('!I', INADDR_ANY)
+    return inet_aton(group) + inet_aton(interface)
+
+
 class UDPSendSocket(object):
-    def __init__(self, udp_port, udp_ip='localhost', send_type=NUMPY, verbose=True):
+    def __init__(self, udp_port, udp_ip='localhost', send_type=NUMPY, verbose=True, compression=None,
+                 compression_level=None, max_datagram_size=None, multicast_ttl=1, multicast_interface=None,
+                 multicast_loopback=True, queue_size=1, queue_policy=LATEST, batch_interval=None, metrics_callback=None,
+                 metrics_interval=1.0):
+        """
+        A UDP socket class to send data to a specific port and address. Messages larger than a datagram are split
+        into fragments that UDPReceiveSocket puts back together (see DataSocket.Datagrams).
+        :param udp_port: UDP port to send to.
+        :param udp_ip: ip address to send to. A multicast group address (224.0.0.0 to 239.255.255.255) sends every
+               message once to all UDPReceiveSockets subscribed to that group.
+        :param send_type: DataSocket.NUMPY or DataSocket.JSON
+        :param verbose: Whether or not to print errors and status messages.
+        :param compression: Compression used for NUMPY payloads. None (default) deflates the numpy file as before,
+               'none', 'zlib', 'lzma', 'bz2' or 'auto' select a codec (see TCPSendSocket).
+        :param compression_level: compression level used by the chosen codec.
+        :param max_datagram_size: maximum size of a datagram in bytes. If None, the largest datagram that fits the
+               MTU of the path to the receiver is used (1472 bytes on ethernet), so fragments are never split by IP.
+        :param multicast_ttl: number of routers multicast messages may pass. 1 (default) keeps them in the local
+               network.
+        :param multicast_interface: ip address of the local interface multicast messages are sent from. Uses the
+               interface of the default route if None. Use '127.0.0.1' to stay on the local host.
+        :param multicast_loopback: whether receivers on the sending host get the multicast messages too.
+        :param queue_size: maximum number of messages waiting to be sent.
+        :param queue_policy: what to do when send_data is called while the send queue is full (see TCPSendSocket).
+        :param batch_interval: when set, small messages queued within this many seconds of each other are packed
+               into as few datagrams as possible, which saves a system call and a receiver wake up per message. 0
+               packs only what is already queued and adds no delay. Use a queue_size larger than 1 so messages can
+               accumulate. Not supported for RAW.
+        :param metrics_callback: optional function called with stats() every metrics_interval seconds from a thread
+               of its own. No thread is started if None.
+        :param metrics_interval: time in seconds between calls of metrics_callback.
+        """
+        if batch_interval is not None and send_type == RAW:
+            raise ValueError("RAW messages can not be batched")
         self.send_type = send_type
+        self.max_datagram_size = max_datagram_size
+        self.datagram_size = None
+        self._message_id = random.getrandbits(32)  # a restarted sender does not reuse recent message ids
+        self.compressor = get_compressor(compression, compression_level)
         self.data_to_send = b'0'
         self.port = int(udp_port)
         self.ip = udp_ip
-        self.new_value_available = Event()
+        self.send_queue = SendQueue(queue_size, queue_policy)
+        self.batch_interval = batch_interval
+        self.metrics = Metrics(('encode', 'write'))
+        self._metrics_reporter = None
+        if metrics_callback is not None:
+            self._metrics_reporter = MetricsReporter(self.stats, metrics_callback, metrics_interval)
         self.thread = Thread(target=self.run)
         self.stop_thread = Event()
         self.connected = False
         self.socket = _get_socket()
-        self.socket.bind((self.ip, self.port))
         self.destination = (self.ip, self.port)
+        self.multicast = _is_multicast(self.ip)
+        if self.multicast:
+            self.socket.setsockopt(IPPROTO_IP, IP_MULTICAST_TTL, multicast_ttl)
+            self.socket.setsockopt(IPPROTO_IP, IP_MULTICAST_LOOP, int(multicast_loopback))
+            if multicast_interface is not None:
+                self.socket.setsockopt(IPPROTO_IP, IP_MULTICAST_IF, inet_aton(multicast_interface))
         self.verbose = verbose
 
     def run(self):
-        self.socket = _get_socket()
+        if self.max_datagram_size is None:
+            self.datagram_size = path_datagram_size(self.destination)
+        else:
+            self.datagram_size = min(self.max_datagram_size, MAX_DATAGRAM_SIZE)
         if self.verbose:
             print('sending data to ', str(self.port) + '@' + self.ip)
 
         while True:
-            while not self.new_value_available.is_set():
-                time.sleep(0.0001)
-                if self.stop_thread.is_set():
-                    return
+            try:
+                self.data_to_send = self.send_queue.get()
+            except Empty:  # the queue was closed by stop()
+                return
             if self.stop_thread.is_set():
                 return
-            self._send_data()
-            self.new_value_available.clear()
+            if self.batch_interval is not None and not isinstance(self.data_to_send, Encoded):
+                self._send_batch()
+                continue
+            try:
+                self._send_data()
+            finally:
+                self.send_queue.task_done()
 
     def send_data(self, data):
-        self.data_to_send = data
-        self.new_value_available.set()
+        if isinstance(data, dict):
+            data = dict(data)
+        return self.send_queue.put(data)
+
+    @property
+    def queue_depth(self):
+        """
+        Number of messages waiting to be sent.
+        """
+        return len(self.send_queue)
+
+    @property
+    def dropped_messages(self):
+        """
+        Number of messages discarded by the queue policy.
+        """
+        return self.send_queue.dropped
+
+    def flush(self, timeout=None):
+        """
+        Block until every queued message was sent.
+        :param timeout: maximum time in seconds to wait. Waits indefinitely if None.
+        :return: True if the queue was drained, False on timeout.
+        """
+        return self.send_queue.join(timeout)
+
+    def stats(self):
+        """
+        Snapshot of what the socket did so far: messages and bytes sent, encoding errors, queue state and histograms
+        of the time spent encoding messages (encode_seconds) and writing their datagrams (write_seconds).
+        :return: dict
+        """
+        stats = self.metrics.snapshot()
+        stats['queue_depth'] = len(self.send_queue)
+        stats['queue_high_water'] = self.send_queue.high_water
+        stats['dropped'] = self.send_queue.dropped
+        return stats
+
+    def _encode(self):
+        start = time.perf_counter()
+        try:
+            return encode(self.send_type, self.data_to_send, compressor=self.compressor)
+        finally:
+            self.metrics.record('encode', time.perf_counter() - start)
 
     def _send_data(self):
-        if self.send_type == NUMPY:
-            if isinstance(self.data_to_send, dict):
-                for key in self.data_to_send.keys():
-                    self.data_to_send[key] = np.asarray(self.data_to_send[key])
-                f = BytesIO()
-                np.savez_compressed(f, **self.data_to_send)
-            else:
-                data_as_numpy = np.asarray(self.data_to_send)
-                # print(np.max(data_as_numpy))
-                f = BytesIO()
-                np.savez_compressed(f, data=data_as_numpy)
-
-            # determine file size in bytes
-            f.seek(0, os.SEEK_END)
-            size = f.tell()
-            f.seek(0)
-            f = f.read()
-
-        elif self.send_type == JSON:
-            try:
-                f = json.dumps(self.data_to_send).encode()
-            except TypeError:
+        if isinstance(self.data_to_send, Encoded):
+            # batches are flagged per datagram, so they can be sent whether or not this socket batches itself
+            message = self.data_to_send
+            if message.send_type != self.send_type:
+                self.metrics.errors += 1
+                if self.verbose:
+                    print('the encoded message does not match the send_type of the socket')
+                return
+            self._send_message(message.size, message.payload, FLAG_BATCH if message.batch else 0)
+            return
+        try:
+            size, f = self._encode()
+        except (TypeError, ValueError) as e:
+            self.metrics.errors += 1
+            if self.verbose:
+                print(e)
+            return
+        self._send_message(size, f)
+
+    def _send_batch(self):
+        """
+        Pack the messages queued within batch_interval into as few datagrams as possible. A message that does not fit
+        into a datagram together with others is sent on its own.
+        """
+        deadline = time.monotonic() + self.batch_interval
+        capacity = self.datagram_size - HEADER.size
+        payloads = []
+        nbytes = 0
+        count = 1
+        try:
+            while True:
                 try:
-                    f = json.dumps(self.data_to_send.tolist()).encode()
-                except TypeError as e:
-                    print(e)
+                    size, f = self._encode()
+                except (TypeError, ValueError) as e:
+                    self.metrics.errors += 1
+                    if self.verbose:
+                        print(e)
+                else:
+                    if nbytes + size + _BATCH_OVERHEAD > capacity and payloads:
+                        self._send_packed(payloads)
+                        payloads = []
+                        nbytes = 0
+                    if size + _BATCH_OVERHEAD > capacity:
+                        self._send_message(size, f)
+                    else:
+                        payloads.append((size, f))
+                        nbytes += size + _BATCH_OVERHEAD
+                # keep taking what is already queued after the deadline, but stop once the producer is faster than
+                # the datagrams can be filled so task_done() is not held back indefinitely
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 and count >= self.send_queue.maxsize:
+                    break
+                try:
+                    self.data_to_send = self.send_queue.get(timeout=max(remaining, 0))
+                except Empty:
+                    break
+                count += 1
+            if payloads:
+                self._send_packed(payloads)
+        finally:
+            for _ in range(count):
+                self.send_queue.task_done()
+
+    def _send_packed(self, payloads):
+        if len(payloads) == 1:
+            self._send_message(*payloads[0])
+        else:
+            self._send_message(*encode_batch(self.send_type, payloads), flags=FLAG_BATCH, messages=len(payloads))
 
+    def _send_message(self, size, f, flags=0, messages=1):
+        start = time.perf_counter()
+        if size is None:  # RAW
             size = len(f)
+        try:
+            self._message_id += 1
+            datagrams = fragment(self._message_id, size, f, self.datagram_size, flags)
+        except ValueError as e:
+            self.metrics.errors += 1
+            if self.verbose:
+                print(e)
+            return
 
         try:
-            data_size = struct.pack('I', size)
-            self.socket.sendto(struct.pack('I', size), self.destination)
-            self.socket.sendto(f, self.destination)  # Send data
+            for datagram in datagrams:
+                if hasattr(self.socket, 'sendmsg'):
+                    self.socket.sendmsg(datagram, (), 0, self.destination)
+                else:  # i.e. windows
+                    self.socket.sendto(b''.join(datagram), self.destination)
         except ConnectionError as e:
+            self.metrics.errors += 1
             if self.verbose:
                 print(e)
             self.socket.close()
             self.connected = False
+            return
+        self.metrics.record('write', time.perf_counter() - start)
+        self.metrics.count(size, messages)
 
     def start(self):
+        if self._metrics_reporter is not None:
+            self._metrics_reporter.start()
         self.thread.start()
 
     def stop(self):
         self.stop_thread.set()
+        self.send_queue.close()
+        if self._metrics_reporter is not None:
+            self._metrics_reporter.stop()
         if self.thread.is_alive():
             self.thread.join()
         self.socket.close()
@@ -104,7 +290,38 @@ class UDPSendSocket(object):
 
 # a client socket
 class UDPReceiveSocket(object):
-    def __init__(self, udp_port, handler_function=None, udp_ip='localhost', verbose=True, send_type=NUMPY):
+    def __init__(self, udp_port, handler_function=None, udp_ip='localhost', verbose=True, send_type=NUMPY,
+                 reassembly_timeout=1.0, socket_buffer_size=None, multicast_interface=None, deliver_batches=False,
+                 metrics_callback=None, metrics_interval=1.0, max_message_size=MAX_MESSAGE_SIZE,
+                 max_pending_messages=1024):
+        """
+        Receiving UDP socket to be used with UDPSendSocket. Messages are delivered once all of their fragments
+        arrived. Lost, incomplete, late and reordered messages are counted (see missed_messages and following).
+        :param udp_port: UDP port to listen on.
+        :param handler_function: function called with every received message.
+        :param udp_ip: ip address to listen on. For a multicast group address, the socket listens on all interfaces and
+               joins the group, so every subscriber gets each message the sender sent once. Only one sender should
+               publish to a group and port.
+        :param verbose: Whether or not to print errors and status messages.
+        :param send_type: the send_type of the UDPSendSocket.
+        :param reassembly_timeout: time in seconds to wait for the remaining fragments of a message before it is
+               dropped.
+        :param socket_buffer_size: size of the operating system receive buffer in bytes (SO_RCVBUF). Large messages
+               arrive as bursts of datagrams, which are lost when they do not fit into this buffer.
+        :param multicast_interface: ip address of the local interface to join multicast groups on. Any interface if
+               None. Use '127.0.0.1' to receive multicast messages sent on the local host.
+        :param deliver_batches: All datagrams that are waiting when the receiving thread wakes up are read at once
+               and their messages are passed to the handler together. By default the handler is called once per
+               message. When True, it is called once with the list of messages instead. If the handler can not keep
+               up, the messages received in the meantime are handled together with its next call.
+        :param metrics_callback: optional function called with stats() every metrics_interval seconds from a thread
+               of its own. No thread is started if None.
+        :param metrics_interval: time in seconds between calls of metrics_callback.
+        :param max_message_size: largest message in bytes accepted. Datagrams of larger messages are counted as
+               invalid_datagrams in stats() instead of allocating a buffer for them.
+        :param max_pending_messages: number of received messages kept while the handler is busy. Beyond that, the
+               oldest messages are dropped and counted in dropped_messages.
+        """
         if handler_function is None:
             def pass_func(data):
                 pass
@@ -116,7 +333,15 @@ class UDPReceiveSocket(object):
         self.data_mode = send_type
         self.verbose = verbose
         self.handler_function = handler_function
+        self.deliver_batches = deliver_batches
+        self.metrics = Metrics(('read', 'decode', 'handler'))
+        self._metrics_reporter = None
+        if metrics_callback is not None:
+            self._metrics_reporter = MetricsReporter(self.stats, metrics_callback, metrics_interval)
         self._new_data = None
+        self._new_messages = None  # messages received since the handler last ran
+        self.max_pending_messages = max_pending_messages
+        self.dropped_messages = 0  # received messages dropped because the handler did not keep up
         self._new_data_lock = Lock()
         self.new_data_flag = Event()
         self.handler_thread = Thread(target=self._handler)
@@ -127,6 +352,60 @@ class UDPReceiveSocket(object):
         self.block_size = 0
         self.is_connected = False
         self.shut_down_flag = Event()
+        self.socket_buffer_size = socket_buffer_size
+        self.multicast = _is_multicast(udp_ip)
+        self.multicast_interface = multicast_interface
+        self._reassembler = Reassembler(reassembly_timeout, max_message_size=max_message_size)
+        self._waker = Waker()
+
+    @property
+    def received_messages(self):
+        return self._reassembler.received_messages
+
+    @property
+    def missed_messages(self):
+        """
+        Number of messages that were sent but never delivered.
+        """
+        return self._reassembler.missed_messages
+
+    @property
+    def incomplete_messages(self):
+        """
+        Number of messages dropped because not all of their fragments arrived within reassembly_timeout.
+        """
+        return self._reassembler.incomplete_messages
+
+    @property
+    def late_fragments(self):
+        """
+        Number of fragments arriving after their message was delivered or dropped.
+        """
+        return self._reassembler.late_fragments
+
+    @property
+    def out_of_order_messages(self):
+        """
+        Number of messages completed after a newer message was delivered. They are still passed to the handler.
+        """
+        return self._reassembler.out_of_order_messages
+
+    def stats(self):
+        """
+        Snapshot of what the socket did so far: messages decoded (every message of a batch counts), bytes received,
+        decoding errors, the loss counters (including dropped_messages) and histograms of the time between the first and the last fragment of a
+        message (read_seconds), spent decoding (decode_seconds) and in the handler (handler_seconds, once per list
+        with deliver_batches).
+        :return: dict
+        """
+        stats = self.metrics.snapshot()
+        stats['missed_messages'] = self.missed_messages
+        stats['incomplete_messages'] = self.incomplete_messages
+        stats['late_fragments'] = self.late_fragments
+        stats['out_of_order_messages'] = self.out_of_order_messages
+        stats['invalid_datagrams'] = self._reassembler.invalid_datagrams
+        stats['dropped_messages'] = self.dropped_messages
+        return stats
 
     @property
     def new_data(self):
@@ -135,87 +414,142 @@ class UDPReceiveSocket(object):
 
     @new_data.setter
     def new_data(self, data):
+        self._add_new_messages([data])
+
+    def _add_new_messages(self, messages):
         with self._new_data_lock:
-            self._new_data = data
+            self._new_data = messages[-1]
+            if self._new_messages is None:
+                self._new_messages = messages
+            else:
+                self._new_messages.extend(messages)
+            excess = len(self._new_messages) - self.max_pending_messages
+            if excess > 0:
+                del self._new_messages[:excess]
+                self.dropped_messages += excess
 
     def start(self):
+        if self._metrics_reporter is not None:
+            self._metrics_reporter.start()
         self.thread.start()
 
     def stop(self):
         self.shut_down_flag.set()
+        if self._metrics_reporter is not None:
+            self._metrics_reporter.stop()
+        # wake up the threads blocked waiting for datagrams or a new message
+        self._waker.wake()
+        self.new_data_flag.set()
         if self.thread.is_alive():
             self.thread.join()
         self.shut_down_flag.set()
         if self.handler_thread.is_alive():
             self.handler_thread.join()
         self.shut_down_flag.clear()
+        self.new_data_flag.clear()
+        self._waker.clear()
         self.socket.close()
         self.socket = _get_socket()
 
     def initialize(self):
         while not self.is_connected and not self.shut_down_flag.is_set():
             try:
-                self.socket.bind((self.ip, self.port))
+                if self.socket_buffer_size is not None:
+                    self.socket.setsockopt(SOL_SOCKET, SO_RCVBUF, self.socket_buffer_size)
+                if self.multicast:
+                    self.socket.bind(('', self.port))
+                    self.join_group(self.ip, self.multicast_interface)
+                else:
+                    self.socket.bind((self.ip, self.port))
+                self.socket.setblocking(False)
             except (ConnectionError, OSError) as e:
                 # print(e)
                 self.socket = _get_socket()
-                time.sleep(0.001)
+                self.shut_down_flag.wait(0.001)
                 continue
             if self.verbose:
                 print("connected to ", str(self.port) + '@' + self.ip)
             self.is_connected = True
             self.handler_thread.start()
 
+    def join_group(self, group, interface=None):
+        """
+        Subscribe to a multicast group. Messages sent to the group on this socket's port are received from then on.
+        :param group: multicast group address.
+        :param interface: ip address of the local interface to join on. Any interface if None.
+        """
+        self.socket.setsockopt(IPPROTO_IP, IP_ADD_MEMBERSHIP, _membership(group, interface))
+
+    def leave_group(self, group, interface=None):
+        """
+        Unsubscribe from a multicast group joined with join_group() or through udp_ip.
+        :param group: multicast group address.
+        :param interface: the interface the group was joined on.
+        """
+        self.socket.setsockopt(IPPROTO_IP, IP_DROP_MEMBERSHIP, _membership(group, interface))
+
     def recieve_data(self):
         self.initialize()
+        buf = bytearray(MAX_DATAGRAM_SIZE + 1)
+        view = memoryview(buf)
         while self.is_connected and not self.shut_down_flag.is_set():
-            toread = 4
-            buf = bytearray(toread)
-            view = memoryview(buf)
-            while toread:
+            # incomplete messages have to be expired even if no more datagrams arrive
+            timeout = self._reassembler.timeout if self._reassembler.pending else None
+            if not wait_readable(self.socket, self._waker, timeout):
                 if self.shut_down_flag.is_set():
                     return
+                self._reassembler.expire()
+                continue
+            messages = []
+            for _ in range(_DATAGRAMS_PER_WAKEUP):
                 try:
-                    nbytes = self.socket.recvfrom_into(view, toread)[0]
+                    nbytes = self.socket.recvfrom_into(buf)[0]
+                except BlockingIOError:
+                    break
                 except OSError as e:
-                    print(e)
+                    if self.verbose:
+                        print(e)
                     continue
-                view = view[nbytes:]  # slicing views is cheap
-                toread -= nbytes
-
-            toread = int.from_bytes(buf, "little")
-            buf = bytearray(toread)
-            view = memoryview(buf)
-            while toread:
-                if self.shut_down_flag.is_set():
-                    return
-                try:
-                    nbytes = self.socket.recvfrom_into(view, toread)[0]
-                except OSError as e:
-                    print(e)
+                self.metrics.bytes += nbytes
+                message = self._reassembler.add(view[:nbytes])
+                if message is None:
                     continue
-                view = view[nbytes:]  # slicing views is cheap
-                toread -= nbytes
-
-            if self.data_mode == NUMPY:
-                as_file = BytesIO(buf)
-                as_file.seek(0)
+                self.metrics.record('read', self._reassembler.assembly_seconds)
+                start = time.perf_counter()
                 try:
-                    self.new_data = np.load(as_file)
-                except OSError as e:
+                    if self._reassembler.flags & FLAG_BATCH:
+                        decoded = decode_batch(self.data_mode, message)
+                    else:
+                        decoded = [decode(self.data_mode, message)]
+                except (OSError, ValueError) as e:
+                    self.metrics.errors += 1
                     if self.verbose:
                         print(e)
                     continue
-            elif self.data_mode == JSON:
-                self.new_data = json.loads(buf.decode())
+                self.metrics.record('decode', time.perf_counter() - start)
+                self.metrics.messages += len(decoded)
+                messages.extend(decoded)
 
-            self.new_data_flag.set()
+            if messages:
+                self._add_new_messages(messages)
+                self.new_data_flag.set()
 
     def _handler(self):
         while True:
-            while not self.new_data_flag.is_set():
-                if self.shut_down_flag.is_set():
-                    return
-                time.sleep(0.001)
+            self.new_data_flag.wait()
+            if self.shut_down_flag.is_set():
+                return
             self.new_data_flag.clear()
-            self.handler_function(self.new_data)
+            with self._new_data_lock:
+                messages, self._new_messages = self._new_messages, None
+            if messages is None:
+                continue  # the flag was set for messages that were taken together with the previous ones
+            if self.deliver_batches:
+                start = time.perf_counter()
+                self.handler_function(messages)
+                self.metrics.record('handler', time.perf_counter() - start)
+            else:
+                for message in messages:
+                    start = time.perf_counter()
+                    self.handler_function(message)
+                    self.metrics.record('handler', time.perf_counter() - start)
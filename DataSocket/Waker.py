@@ -0,0 +1,48 @@
+from socket import socketpair
+import selectors
+
+
+class Waker(object):
+    def __init__(self):
+        """
+        A file descriptor that can be registered with a selector next to the sockets a thread is waiting on, so other
+        threads (i.e. stop()) can interrupt the wait without any polling.
+        """
+        self._reader, self._writer = socketpair()
+        self._reader.setblocking(False)
+        self._writer.setblocking(False)
+
+    def fileno(self):
+        return self._reader.fileno()
+
+    def wake(self):
+        try:
+            self._writer.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # already woken up or closed
+
+    def clear(self):
+        try:
+            while self._reader.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def close(self):
+        self._reader.close()
+        self._writer.close()
+
+
+def wait_readable(sock, waker, timeout=None):
+    """
+    Block until sock is readable or the waker was woken up.
+    :param sock: socket to wait on.
+    :param waker: Waker used to interrupt the wait.
+    :param timeout: maximum time to wait in seconds. Waits indefinitely if None.
+    :return: True if sock is readable.
+    """
+    with selectors.DefaultSelector() as selector:
+        selector.register(sock, selectors.EVENT_READ)
+        selector.register(waker, selectors.EVENT_READ)
+        ready = selector.select(timeout)
+    return any(key.fileobj is sock for key, _ in ready)
@@ -1,5 +1,13 @@
-from .TCPDataSocket import TCPSendSocket, TCPReceiveSocket, NUMPY, JSON, HDF, RAW
+from .TCPDataSocket import TCPSendSocket, TCPReceiveSocket, NUMPY, JSON, HDF, RAW, ARRAY, BINARY
 from .UDPDataSocket import UDPReceiveSocket, UDPSendSocket
+from .SendQueue import BLOCK, DROP_OLDEST, DROP_NEWEST, LATEST
+from .FanOut import BLOCK_ON_SLOW, SKIP_TO_LATEST, DISCONNECT_SLOW
+from .Framing import LEGACY_FRAMES, FRAME_V2
+from .BufferPool import BufferPool, PooledBuffer
+from .Dispatcher import INLINE, THREAD, POOL, STRICT, PER_KEY, UNORDERED
+from .AsyncDataSocket import AsyncTCPSendSocket, AsyncTCPReceiveSocket
+from .Serialization import Encoded
+from .Recording import StreamRecorder, StreamReplayer
 
 
 def install_matlab_socket_files(destination):
@@ -0,0 +1,13 @@
+"""
+Loopback benchmarks of the DataSocket sockets.
+
+Every scenario runs the sender and each receiver in a fresh process, sends as fast as the sockets allow for a fixed
+time (or at a fixed rate) and reports delivered messages/s and MB/s, end-to-end latency percentiles, CPU time per
+message and peak RSS of every process. Results are written as json so runs on different commits can be compared:
+
+    python -m benchmarks --quick --output before.json
+    python -m benchmarks --quick --output after.json
+    python -m benchmarks --compare before.json after.json
+
+Run python -m benchmarks --help for the filters that select part of the sweep.
+"""
@@ -0,0 +1,103 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+from .scenarios import TCP, UDP, SERVER, CLIENT, SEND_TYPES, PAYLOADS, sweep
+from .runner import run
+from .compare import load, compare
+
+HEADER = '{:<36} {:>10} {:>9} {:>6} {:>9} {:>9} {:>9} {:>10} {:>10} {:>8}'
+ROW = '{:<36} {:>10.0f} {:>9.1f} {:>6.3f} {:>9} {:>9} {:>9} {:>10} {:>10} {:>8.0f}'
+
+
+def _list(text, convert=str):
+    return tuple(convert(value) for value in text.split(','))
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _format(value, digits=3):
+    return '-' if value is None else '{:.{}f}'.format(value, digits)
+
+
+def _print(result):
+    if 'error' in result:
+        print('{:<36} failed: {}'.format(result['name'], result['error'].strip().splitlines()[-1]))
+        return
+    latency = result['latency_ms'] or {}
+    print(ROW.format(result['name'], result['messages_per_second'], result['megabytes_per_second'],
+                     result['delivered_fraction'] or 0, _format(latency.get('p50')), _format(latency.get('p99')),
+                     _format(latency.get('p99.9')), _format(result['sender_cpu_us_per_message'], 1),
+                     _format(result['receiver_cpu_us_per_message'], 1),
+                     max(result['sender_peak_rss_mb'], result['receiver_peak_rss_mb'])))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Loopback benchmarks of DataSocket.')
+    parser.add_argument('--output', help='write the results to this json file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    parser.add_argument('--quick', action='store_true',
+                        help='small and medium payloads to one receiver of a server for 1 s, a quick smoke run')
+    parser.add_argument('--transport', type=_list, default=(TCP, UDP), help='comma separated: tcp,udp')
+    parser.add_argument('--role', type=_list, default=(SERVER, CLIENT), help='comma separated: server,client')
+    parser.add_argument('--send-type', type=_list, default=tuple(SEND_TYPES),
+                        help='comma separated: ' + ','.join(SEND_TYPES))
+    parser.add_argument('--payload', type=_list, default=tuple(PAYLOADS), help='comma separated: ' + ','.join(PAYLOADS))
+    parser.add_argument('--receivers', type=lambda text: _list(text, int), default=(1, 2, 4),
+                        help='comma separated numbers of receiving processes')
+    parser.add_argument('--rate', type=float, help='messages per second to send, as fast as possible if not set')
+    parser.add_argument('--duration', type=float, help='seconds to send for (default 2, 1 with --quick)')
+    parser.add_argument('--port', type=int, default=47000, help='first port used, every scenario uses its own')
+    args = parser.parse_args()
+
+    if args.compare:
+        print('\n'.join(compare(load(args.compare[0]), load(args.compare[1]))))
+        return
+
+    if args.quick:
+        scenarios = sweep(args.transport, (SERVER,), args.send_type, ('small', 'medium'), (1,), args.rate,
+                          args.duration or 1.0)
+    else:
+        scenarios = sweep(args.transport, args.role, args.send_type, args.payload, args.receivers, args.rate,
+                          args.duration or 2.0)
+    if not scenarios:
+        parser.error('no supported scenario matches the filters')
+
+    meta = {'commit': _commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+    print('{} scenarios on {} ({} cpus)'.format(len(scenarios), meta['platform'], meta['cpu_count']))
+    print(HEADER.format('scenario', 'msg/s', 'MB/s', 'deliv', 'p50 ms', 'p99 ms', 'p99.9 ms', 'snd us/msg',
+                        'rcv us/msg', 'RSS MB'))
+    results = []
+    for index, scenario in enumerate(scenarios):
+        result = run(scenario, args.port + 2 * index)
+        _print(result)
+        sys.stdout.flush()
+        results.append(result)
+        if args.output:  # written after every scenario so a long sweep that is cut short still leaves results
+            with open(args.output, 'w') as f:
+                json.dump({'meta': meta, 'results': results}, f, indent=1, default=_json_default)
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(repr(value))
+
+
+if __name__ == '__main__':
+    main()
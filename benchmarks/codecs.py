@@ -0,0 +1,100 @@
+"""
+Encoding and decoding time and encoded size of single messages per send type, without sockets:
+
+    python -m benchmarks.codecs
+"""
+import argparse
+import time
+import numpy as np
+from DataSocket.Serialization import encode, decode
+from .scenarios import SEND_TYPES
+
+ROW = '{:<10} {:<8} {:>10} {:>12} {:>12}'
+
+
+def _telemetry():
+    # the kind of message JSON is used for today: a flat dict of numbers and strings
+    return {'robot': 'arm_2', 'state': 'moving', 'sequence': 123456, 'time': 1700000000.123,
+            'joints': [0.1 * i for i in range(7)], 'torques': [1.5 * i for i in range(7)], 'gripper': True}
+
+
+def _mixed():
+    rng = np.random.default_rng(0)
+    return {'camera': 'cam0', 'frame': 4711, 'exposure': 0.008,
+            'pose': {'position': rng.random(3), 'orientation': rng.random(4), 'frame_id': 'world'},
+            'detections': [{'label': 'cup', 'score': 0.93, 'box': [12, 40, 80, 120]},
+                           {'label': 'plate', 'score': 0.71, 'box': [100, 30, 220, 90]}],
+            'depth': rng.random((64, 64), dtype=np.float32)}
+
+
+def _image():
+    return {'camera': 'cam0', 'frame': 4711, 'time': 1700000000.123,
+            'image': np.random.default_rng(0).integers(0, 255, (480, 640, 3)).astype(np.uint8)}
+
+
+MESSAGES = {'telemetry': _telemetry, 'mixed': _mixed, 'image': _image}
+CODEC_SEND_TYPES = ('json', 'numpy', 'binary')
+
+
+def _touch(data):
+    # npz files only load (and decompress) their arrays on access, like a handler reading the message would
+    if hasattr(data, 'files'):
+        return {key: data[key] for key in data.files}
+    return data
+
+
+def _seconds_per_call(function, seconds):
+    function()  # warm up
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return elapsed / calls
+
+
+def measure(send_type, message, seconds=0.5):
+    """
+    :param send_type: a key of SEND_TYPES.
+    :param message: the message to send.
+    :param seconds: time spent on encoding and on decoding.
+    :return: dict with the encoded size in bytes and the time to encode and decode the message in microseconds, or
+             with the error if the send type can not carry the message.
+    """
+    mode = SEND_TYPES[send_type]
+    try:
+        size, payload = encode(mode, message)
+        buffer = b''.join(payload) if isinstance(payload, list) else bytes(payload)
+        _touch(decode(mode, buffer))
+    except (TypeError, ValueError) as e:
+        return {'error': str(e)}
+    return {'bytes': size,
+            'encode_us': _seconds_per_call(lambda: encode(mode, message), seconds) * 1e6,
+            'decode_us': _seconds_per_call(lambda: _touch(decode(mode, buffer)), seconds) * 1e6}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.codecs',
+                                     description='Encoding and decoding cost of single messages per send type.')
+    parser.add_argument('--message', default=','.join(MESSAGES), help='comma separated: ' + ','.join(MESSAGES))
+    parser.add_argument('--send-type', default=','.join(CODEC_SEND_TYPES),
+                        help='comma separated: ' + ','.join(SEND_TYPES))
+    parser.add_argument('--seconds', type=float, default=0.5, help='time spent per measurement')
+    args = parser.parse_args()
+
+    print(ROW.format('message', 'type', 'bytes', 'encode us', 'decode us'))
+    for name in args.message.split(','):
+        message = MESSAGES[name]()
+        for send_type in args.send_type.split(','):
+            result = measure(send_type, message, args.seconds)
+            if 'error' in result:
+                print('{:<10} {:<8} failed: {}'.format(name, send_type, result['error']))
+                continue
+            print(ROW.format(name, send_type, result['bytes'], '{:.1f}'.format(result['encode_us']),
+                             '{:.1f}'.format(result['decode_us'])))
+
+
+if __name__ == '__main__':
+    main()
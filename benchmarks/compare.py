@@ -0,0 +1,48 @@
+"""
+Side by side comparison of two result files written by python -m benchmarks --output.
+"""
+import json
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _ratio(new, old):
+    if not old or new is None:
+        return '-'
+    return '{:.2f}x'.format(new / old)
+
+
+def _latency(result):
+    latency = result.get('latency_ms')
+    return latency['p99'] if latency else None
+
+
+def _format(value):
+    return '-' if value is None else '{:.3f}'.format(value)
+
+
+def compare(old, new):
+    """
+    :param old: dict loaded from the result file of the baseline.
+    :param new: dict loaded from the result file to compare with it.
+    :return: list of lines with throughput and p99 latency of every scenario both files contain.
+    """
+    previous = {result['name']: result for result in old['results']}
+    lines = ['{} vs {}'.format(old['meta'].get('commit') or 'old', new['meta'].get('commit') or 'new'),
+             '{:<36} {:>12} {:>12} {:>7} {:>10} {:>10} {:>7}'.format('scenario', 'old msg/s', 'new msg/s', '',
+                                                                   'old p99 ms', 'new p99 ms', '')]
+    for result in new['results']:
+        base = previous.get(result['name'])
+        if base is None:
+            continue
+        if 'error' in result or 'error' in base:
+            lines.append('{:<36} {}'.format(result['name'], 'failed: ' + ('new' if 'error' in result else 'old')))
+            continue
+        lines.append('{:<36} {:>12.0f} {:>12.0f} {:>7} {:>10} {:>10} {:>7}'.format(
+            result['name'], base['messages_per_second'], result['messages_per_second'],
+            _ratio(result['messages_per_second'], base['messages_per_second']),
+            _format(_latency(base)), _format(_latency(result)), _ratio(_latency(result), _latency(base))))
+    return lines
@@ -0,0 +1,247 @@
+"""
+Runs a Scenario with the sender and every receiver in processes of their own and summarizes what they measured.
+"""
+import multiprocessing
+import resource
+import time
+import traceback
+import numpy as np
+from DataSocket import TCPSendSocket, TCPReceiveSocket, UDPSendSocket, UDPReceiveSocket, INLINE, BLOCK
+from .scenarios import TCP, CLIENT, SEND_TYPES, RAW_HEADER, make_payload, payload_bytes, make_message, \
+    read_message, scenario_name
+
+MULTICAST_GROUP = '239.255.77.1'
+WARM_UP_SECONDS = 0.3
+SEND_QUEUE_SIZE = 64
+START_TIMEOUT = 20  # seconds until a scenario is given up when the processes do not connect
+SETTLE_SECONDS = 0.3  # receivers are done once they did not get a message for this long after the sender finished
+SETTLE_TIMEOUT = 30
+
+
+def _usage():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024  # ru_maxrss is in KB on linux
+
+
+def _multicast(scenario):
+    return scenario.transport != TCP and scenario.receivers > 1
+
+
+def _receive(scenario, port, ready, warm, done, progress, results):
+    try:
+        send_type = SEND_TYPES[scenario.send_type]
+        raw = scenario.send_type == 'raw'
+        latencies = []
+        state = {'last': None, 'offset': 0}
+
+        def on_message(message):
+            now = time.monotonic()
+            if raw:
+                index, sent = RAW_HEADER.unpack_from(message, 0)[::-1]
+            else:
+                index, sent = read_message(message)
+            if index >= 0:
+                latencies.append(now - sent)
+                state['last'] = now
+            progress.value += 1
+
+        message_size = RAW_HEADER.size + payload_bytes(scenario)
+
+        def on_stream(chunk):
+            # raw TCP data arrive as a byte stream, so the headers are found by their offset
+            now = time.monotonic()
+            position = -state['offset'] % message_size
+            while position + RAW_HEADER.size <= len(chunk):
+                sent, index = RAW_HEADER.unpack_from(chunk, position)
+                if index >= 0:
+                    latencies.append(now - sent)
+                position += message_size
+            state['offset'] += len(chunk)
+            state['last'] = now
+            progress.value += 1
+
+        if scenario.transport == TCP:
+            receiver = TCPReceiveSocket(port, verbose=False, as_server=scenario.role == CLIENT,
+                                        receive_as_raw=raw, receive_buffer_size=1 << 20)
+            # INLINE sees every message, the default handler_function only the newest one
+            receiver.subscribe(on_stream if raw else on_message, execution=INLINE)
+            receiver.start(blocking=True)
+        else:
+            group = _multicast(scenario)
+            receiver = UDPReceiveSocket(port, lambda messages: [on_message(m) for m in messages],
+                                        udp_ip=MULTICAST_GROUP if group else 'localhost', verbose=False,
+                                        send_type=send_type, socket_buffer_size=1 << 23,
+                                        multicast_interface='127.0.0.1' if group else None, deliver_batches=True)
+            receiver.start()
+            time.sleep(0.2)  # the socket is bound once its thread runs
+        ready.set()
+
+        warm.wait()
+        cpu_start, _ = _usage()
+        delivered_start = state['offset'] if raw and scenario.transport == TCP else receiver.stats()['messages']
+        latencies.clear()
+        done.wait()
+        cpu_end, peak_rss = _usage()
+        if raw and scenario.transport == TCP:
+            delivered = (state['offset'] - delivered_start) // message_size
+        else:
+            # UDP handlers only get the newest messages when they fall behind, so latencies are a sample there
+            delivered = receiver.stats()['messages'] - delivered_start
+        stats = receiver.stats()
+        receiver.stop()
+        results.put(('receiver', {'delivered': delivered,
+                                  'last_receive': state['last'],
+                                  'latencies': np.array(latencies),
+                                  'cpu_seconds': cpu_end - cpu_start,
+                                  'peak_rss_mb': peak_rss,
+                                  'stats': stats}))
+    except Exception:
+        results.put(('error', traceback.format_exc()))
+
+
+def _send(scenario, port, ready, warm, stop, results):
+    try:
+        send_type = SEND_TYPES[scenario.send_type]
+        if scenario.transport == TCP:
+            sender = TCPSendSocket(port, send_type=send_type, verbose=False, as_server=scenario.role != CLIENT,
+                                   queue_size=SEND_QUEUE_SIZE, queue_policy=BLOCK)
+        else:
+            group = _multicast(scenario)
+            sender = UDPSendSocket(port, udp_ip=MULTICAST_GROUP if group else 'localhost', send_type=send_type,
+                                   verbose=False, multicast_interface='127.0.0.1' if group else None,
+                                   queue_size=SEND_QUEUE_SIZE, queue_policy=BLOCK)
+        sender.start()
+        for event in ready:
+            if not event.wait(START_TIMEOUT):
+                raise TimeoutError('receivers did not connect')
+        if scenario.transport == TCP:
+            while len(sender.connected_clients) < scenario.receivers:
+                time.sleep(0.01)
+
+        payload = make_payload(scenario)
+        end = time.monotonic() + WARM_UP_SECONDS
+        while time.monotonic() < end:
+            sender.send_data(make_message(scenario, payload, -1, time.monotonic()))
+        sender.flush()
+        time.sleep(WARM_UP_SECONDS)
+        warm.set()
+        time.sleep(0.05)
+
+        interval = 1 / scenario.rate if scenario.rate else None
+        cpu_start, _ = _usage()
+        t0 = time.monotonic()
+        sent = 0
+        while True:
+            now = time.monotonic()
+            if now - t0 >= scenario.duration:
+                break
+            if interval is not None:
+                wait = t0 + sent * interval - now
+                if wait > 0:
+                    time.sleep(wait)
+                    now = time.monotonic()
+            sender.send_data(make_message(scenario, payload, sent, now))
+            sent += 1
+        sender.flush()
+        t1 = time.monotonic()
+        cpu_end, peak_rss = _usage()
+        results.put(('sender', {'sent': sent,
+                                't0': t0,
+                                't1': t1,
+                                'cpu_seconds': cpu_end - cpu_start,
+                                'peak_rss_mb': peak_rss,
+                                'stats': sender.stats()}))
+        stop.wait()
+        sender.stop()
+    except Exception:
+        results.put(('error', traceback.format_exc()))
+
+
+def _percentiles(latencies):
+    if not len(latencies):
+        return None
+    p50, p99, p999 = np.percentile(latencies, (50, 99, 99.9)) * 1e3
+    return {'p50': p50, 'p99': p99, 'p99.9': p999, 'max': latencies.max() * 1e3}
+
+
+def summarize(scenario, sender, receivers):
+    """
+    :param sender: what the sending process reported.
+    :param receivers: list of what every receiving process reported.
+    :return: dict with the results of the scenario.
+    """
+    sent = sender['sent']
+    delivered = [r['delivered'] for r in receivers]
+    rates = [r['delivered'] / (r['last_receive'] - sender['t0'])
+             for r in receivers if r['last_receive'] is not None and r['last_receive'] > sender['t0']]
+    rate = float(np.mean(rates)) if rates else 0.0
+    total = sum(delivered)
+    return {'name': scenario_name(scenario),
+            'scenario': scenario._asdict(),
+            'payload_bytes': payload_bytes(scenario),
+            'sent': sent,
+            'delivered': delivered,
+            'delivered_fraction': total / (sent * len(receivers)) if sent else None,
+            'messages_per_second': rate,
+            'megabytes_per_second': rate * payload_bytes(scenario) / 1e6,
+            'latency_ms': _percentiles(np.concatenate([r['latencies'] for r in receivers])),
+            'sender_cpu_us_per_message': sender['cpu_seconds'] / sent * 1e6 if sent else None,
+            'receiver_cpu_us_per_message': (float(np.mean([r['cpu_seconds'] / r['delivered'] for r in receivers]))
+                                            * 1e6 if all(delivered) else None),
+            'sender_peak_rss_mb': sender['peak_rss_mb'],
+            'receiver_peak_rss_mb': max(r['peak_rss_mb'] for r in receivers),
+            'sender_stats': sender['stats'],
+            'receiver_stats': [r['stats'] for r in receivers]}
+
+
+def run(scenario, port):
+    """
+    Run one scenario.
+    :param port: port used by the sockets of the scenario.
+    :return: the dict of summarize() or {'name': ..., 'scenario': ..., 'error': traceback} if the scenario failed.
+    """
+    context = multiprocessing.get_context('spawn')  # fresh interpreters, so no process inherits another's memory
+    results = context.Queue()
+    ready = [context.Event() for _ in range(scenario.receivers)]
+    warm, done, stop = context.Event(), context.Event(), context.Event()
+    progress = [context.RawValue('q', 0) for _ in range(scenario.receivers)]
+    processes = [context.Process(target=_receive, args=(scenario, port, ready[i], warm, done, progress[i], results),
+                                 daemon=True)
+                 for i in range(scenario.receivers)]
+    processes.append(context.Process(target=_send, args=(scenario, port, ready, warm, stop, results), daemon=True))
+    for process in processes:
+        process.start()
+
+    sender, receivers, error = None, [], None
+    try:
+        kind, result = results.get(timeout=START_TIMEOUT + 2 * WARM_UP_SECONDS + scenario.duration + SETTLE_TIMEOUT)
+        if kind != 'sender':
+            raise RuntimeError(result)
+        sender = result
+        # the receivers may still be working through what the sockets buffered
+        deadline = time.monotonic() + SETTLE_TIMEOUT
+        counts = None
+        while time.monotonic() < deadline:
+            latest = [value.value for value in progress]
+            if latest == counts:
+                break
+            counts = latest
+            time.sleep(SETTLE_SECONDS)
+        done.set()
+        for _ in range(scenario.receivers):
+            kind, result = results.get(timeout=SETTLE_TIMEOUT)
+            if kind != 'receiver':
+                raise RuntimeError(result)
+            receivers.append(result)
+    except Exception as e:
+        error = str(e) or repr(e)
+    finally:
+        done.set()
+        stop.set()
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+    if error is not None:
+        return {'name': scenario_name(scenario), 'scenario': scenario._asdict(), 'error': error}
+    return summarize(scenario, sender, receivers)
@@ -0,0 +1,109 @@
+"""
+What the benchmarks sweep over and how messages carry their send time and index.
+"""
+from collections import namedtuple
+import struct
+import numpy as np
+from DataSocket import NUMPY, JSON, HDF, RAW, ARRAY, BINARY
+
+TCP = 'tcp'
+UDP = 'udp'
+SERVER = 'server'  # the sender listens and the receivers connect to it
+CLIENT = 'client'  # the receiver listens and the sender connects to it
+
+SEND_TYPES = {'numpy': NUMPY, 'json': JSON, 'hdf': HDF, 'raw': RAW, 'array': ARRAY, 'binary': BINARY}
+
+# name: (shape, dtype) of the array sent with every message
+PAYLOADS = {'small': ((16,), 'float64'),  # 128 bytes, i.e. a pose or a few sensor values
+            'medium': ((256, 256), 'uint8'),  # 64 KB, i.e. a small image
+            'large': ((1024, 1024), 'float32')}  # 4 MB, i.e. a depth map
+
+# RAW messages start with the send time and the message index
+RAW_HEADER = struct.Struct('<dq')
+
+Scenario = namedtuple('Scenario', ['transport', 'role', 'send_type', 'payload', 'receivers', 'rate', 'duration'])
+Scenario.__doc__ = """
+One benchmark run.
+:param transport: TCP or UDP.
+:param role: SERVER or CLIENT. CLIENT only works with one receiver and is not used for UDP.
+:param send_type: a key of SEND_TYPES.
+:param payload: a key of PAYLOADS.
+:param receivers: number of receiving processes. UDP uses a multicast group for more than one.
+:param rate: messages per second to send or None to send as fast as possible.
+:param duration: time in seconds messages are sent for.
+"""
+
+
+def scenario_name(scenario):
+    name = '{} {} {} {} x{}'.format(scenario.transport, scenario.role, scenario.send_type, scenario.payload,
+                                    scenario.receivers)
+    if scenario.rate:
+        name += ' @{:g}/s'.format(scenario.rate)
+    return name
+
+
+def supported(scenario):
+    """
+    :return: False for combinations the sockets do not offer or that would only measure json.dumps of megabytes.
+    """
+    if scenario.transport == UDP and (scenario.role != SERVER or scenario.send_type not in ('numpy', 'json', 'raw', 'binary')):
+        return False
+    if scenario.role == CLIENT and scenario.receivers != 1:
+        return False
+    if scenario.send_type == 'json' and scenario.payload == 'large':
+        return False
+    return True
+
+
+def sweep(transports=(TCP, UDP), roles=(SERVER, CLIENT), send_types=tuple(SEND_TYPES), payloads=tuple(PAYLOADS),
+          receivers=(1, 2, 4), rate=None, duration=2.0):
+    """
+    :return: list of every supported Scenario combining the given values.
+    """
+    scenarios = []
+    for transport in transports:
+        for role in roles:
+            for send_type in send_types:
+                for payload in payloads:
+                    for count in receivers:
+                        scenario = Scenario(transport, role, send_type, payload, count, rate, duration)
+                        if supported(scenario):
+                            scenarios.append(scenario)
+    return scenarios
+
+
+def make_payload(scenario):
+    shape, dtype = PAYLOADS[scenario.payload]
+    array = np.random.default_rng(0).integers(0, 100, shape).astype(dtype)
+    if scenario.send_type == 'json':
+        return array.tolist()
+    if scenario.send_type == 'raw':
+        return array.tobytes()
+    return array
+
+
+def payload_bytes(scenario):
+    shape, dtype = PAYLOADS[scenario.payload]
+    return int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+
+def make_message(scenario, payload, index, now):
+    """
+    :param payload: the result of make_payload().
+    :param index: message index, negative for warm up messages.
+    :param now: send time (time.monotonic(), which all processes on a host share).
+    """
+    if scenario.send_type == 'raw':
+        return RAW_HEADER.pack(now, index) + payload
+    if scenario.send_type == 'json':
+        return {'data': payload, 't': now, 'i': index}
+    return {'data': payload, 't': np.float64(now), 'i': np.int64(index)}
+
+
+def read_message(message):
+    """
+    Access the data of a received message like a handler would (npz files only decompress on access).
+    :return: (index, send time)
+    """
+    message['data']
+    return int(message['i']), float(message['t'])
@@ -0,0 +1,42 @@
+from DataSocket import AsyncTCPSendSocket, AsyncTCPReceiveSocket, NUMPY
+import asyncio
+import numpy as np
+
+
+number_of_messages = 5  # number of sample messages to send
+port = 4001  # TCP port to use
+
+
+# define a coroutine to send data across a TCP socket
+async def sending_function():
+    send_socket = AsyncTCPSendSocket(tcp_port=port, send_type=NUMPY)
+    await send_socket.start(blocking=True)
+
+    for i in range(number_of_messages):
+        await send_socket.send({'i': i*10,
+                                'data': np.random.random(4)})
+        await asyncio.sleep(0.25)
+
+    print("closing send socket.")
+    await send_socket.stop()
+
+
+# define a coroutine to receive and print data from a TCP socket
+async def receiving_function():
+    num_messages_received = 0
+    async with AsyncTCPReceiveSocket(tcp_port=port) as rec_socket:
+        async for data in rec_socket:
+            print('i=', data['i'], "data received: ", data['data'])
+            num_messages_received += 1
+            if num_messages_received == number_of_messages:
+                break
+        print("closing receive socket.")
+
+
+async def main():
+    # run both sockets concurrently on the same event loop
+    await asyncio.gather(sending_function(), receiving_function())
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,42 @@
+from DataSocket import UDPSendSocket, UDPReceiveSocket, JSON, BLOCK
+import time
+
+
+number_of_messages = 100000  # number of small json messages to send per run
+port = 4002  # UDP port to use
+
+
+def run(batch_interval):
+    num_messages_received = [0]
+
+    # count the messages instead of printing them so the handler is not the bottleneck
+    def count_messages(data):
+        num_messages_received[0] += 1
+
+    rec_socket = UDPReceiveSocket(udp_port=port, handler_function=count_messages, send_type=JSON, verbose=False,
+                                  socket_buffer_size=8 * 1024 ** 2)
+    rec_socket.start()
+    time.sleep(0.2)
+    send_socket = UDPSendSocket(udp_port=port, send_type=JSON, verbose=False, queue_size=1000,
+                                queue_policy=BLOCK, batch_interval=batch_interval)
+    send_socket.start()
+    time.sleep(0.1)
+
+    start = time.perf_counter()
+    for i in range(number_of_messages):
+        send_socket.send_data({'i': i, 'value': 0.5})
+    send_socket.flush()
+    duration = time.perf_counter() - start
+    time.sleep(0.5)  # let the receiver catch up
+
+    print('batch_interval={}: sent {:.0f} messages/s, {} of {} handled ({} missed)'.format(
+        batch_interval, number_of_messages / duration, num_messages_received[0], number_of_messages,
+        rec_socket.missed_messages))
+    send_socket.stop()
+    rec_socket.stop()
+
+
+if __name__ == '__main__':
+    run(batch_interval=None)  # one datagram per message
+    run(batch_interval=0)  # pack whatever is queued, no added delay
+    run(batch_interval=0.001)  # wait up to 1 ms to fill a datagram
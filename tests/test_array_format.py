@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+from DataSocket.ArrayFormat import ALIGNMENT, pack_arrays, unpack_arrays, receive_arrays
+
+
+def _join(packed):
+    size, buffers = packed
+    message = b''.join(bytes(buffer) for buffer in buffers)
+    assert len(message) == size
+    return message
+
+
+def _reader(message):
+    position = [0]
+
+    def receive_into(view):
+        end = position[0] + len(view)
+        if end > len(message):
+            return False
+        view[:] = message[position[0]:end]
+        position[0] = end
+        return True
+    return receive_into
+
+
+STRUCTURED = np.dtype([('id', '<i4'), ('position', '<f8', (3,)), ('flags', [('valid', 'u1'), ('kind', 'u1')])])
+
+
+def _structured():
+    array = np.zeros(4, dtype=STRUCTURED)
+    array['id'] = np.arange(4)
+    array['position'] = np.arange(12).reshape(4, 3) * 0.5
+    array['flags']['valid'] = [1, 0, 1, 0]
+    return array
+
+
+def test_single_array():
+    array = np.arange(12, dtype=np.float32).reshape(3, 4)
+    result = unpack_arrays(_join(pack_arrays(array)))
+    assert result.dtype == array.dtype
+    np.testing.assert_array_equal(result, array)
+
+
+def test_dict_of_arrays_and_extra():
+    data = {'image': np.arange(480 * 64, dtype=np.uint8).reshape(480, 64), 'pose': np.array([1.0, 2.0, 3.0]),
+            'count': 7}
+    result = unpack_arrays(_join(pack_arrays(data, extra={'_time': 12.5})))
+    assert set(result) == {'image', 'pose', 'count', '_time'}
+    np.testing.assert_array_equal(result['image'], data['image'])
+    np.testing.assert_array_equal(result['pose'], data['pose'])
+    assert result['count'] == 7 and result['_time'] == 12.5
+
+
+def test_arrays_are_aligned_views():
+    message = bytearray(_join(pack_arrays({'a': np.arange(3, dtype=np.uint8), 'b': np.arange(100.0)})))
+    result = unpack_arrays(message)
+    base = np.frombuffer(message, dtype=np.uint8).ctypes.data
+    for array in result.values():
+        assert (array.ctypes.data - base) % ALIGNMENT == 0
+        assert not array.flags.owndata
+
+
+@pytest.mark.parametrize('array', [np.asfortranarray(np.arange(24.0).reshape(2, 3, 4)),
+                                   np.arange(40).reshape(5, 8)[::2, 1::3],
+                                   np.arange(10, dtype='>u2'),
+                                   np.array(['a', 'bc', 'def']),
+                                   np.array(3.5),
+                                   np.zeros((0, 3))])
+def test_layouts_and_dtypes(array):
+    result = unpack_arrays(_join(pack_arrays({'x': array})))['x']
+    assert result.dtype == array.dtype
+    assert result.shape == array.shape
+    np.testing.assert_array_equal(result, array)
+
+
+def test_fortran_order_is_kept():
+    array = np.asfortranarray(np.arange(6.0).reshape(2, 3))
+    assert unpack_arrays(_join(pack_arrays(array))).flags.f_contiguous
+
+
+def test_structured_dtype():
+    array = _structured()
+    result = unpack_arrays(_join(pack_arrays(array)))
+    assert result.dtype == STRUCTURED
+    np.testing.assert_array_equal(result, array)
+
+
+def test_object_arrays_are_rejected():
+    with pytest.raises(TypeError):
+        pack_arrays(np.array([{}, None], dtype=object))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 4096, 1 << 20])
+def test_receive_arrays_in_chunks(chunk_size):
+    data = {'a': np.arange(1000, dtype=np.int16), 'f': np.asfortranarray(np.ones((3, 5))), 's': _structured()}
+    message = _join(pack_arrays(data))
+    chunks = []
+    result = receive_arrays(_reader(message), len(message), chunk_size,
+                            lambda key, array, received, total: chunks.append((key, received, total)))
+    for key, array in data.items():
+        assert result[key].dtype == array.dtype
+        np.testing.assert_array_equal(result[key], array)
+    assert chunks[-1][1] == chunks[-1][2]
+
+
+def test_receive_arrays_stream_ended():
+    message = _join(pack_arrays(np.arange(100)))
+    assert receive_arrays(_reader(message[:-10]), len(message), 64) is None
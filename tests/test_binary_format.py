@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+from DataSocket.ArrayFormat import ALIGNMENT
+from DataSocket.BinaryFormat import INLINE_BYTES, pack_values, unpack_values
+
+
+def _join(packed):
+    size, buffers = packed
+    message = b''.join(bytes(buffer) for buffer in buffers)
+    assert len(message) == size
+    return message
+
+
+def _round_trip(value, extra=None):
+    return unpack_values(_join(pack_values(value, extra)))
+
+
+@pytest.mark.parametrize('value', [None, True, False, 0, -1, 2 ** 63 - 1, -2 ** 63, 2 ** 200, -3 ** 90, 1.5,
+                                   float('inf'), 1 + 2j, '', 'text', 'ünïcödé', b'', b'\x00\x01',
+                                   bytes(range(256)) * 8, [], [1, 'a', None], {}, {'a': {'b': [1, {'c': 2.5}]}},
+                                   {1: 'int key', 'k': 'str key', b'b': 'bytes key', 2.5: 'float key'}])
+def test_python_values(value):
+    result = _round_trip(value)
+    assert result == value
+    assert type(result) is type(value)
+
+
+def test_tuples_are_received_as_lists():
+    assert _round_trip((1, (2, 3))) == [1, [2, 3]]
+
+
+def test_numpy_scalars_keep_their_dtype():
+    for value in (np.float32(1.25), np.int8(-3), np.uint64(2 ** 64 - 1), np.bool_(True), np.complex64(1j),
+                  np.datetime64('2024-01-02T03:04:05', 'ms'), np.dtype('>i4').type(7)):
+        result = _round_trip({'v': value})['v']
+        assert result.dtype == value.dtype
+        assert result == value
+
+
+@pytest.mark.parametrize('array', [np.arange(12, dtype=np.float32).reshape(3, 4),
+                                   np.asfortranarray(np.arange(24.0).reshape(2, 3, 4)),
+                                   np.arange(40).reshape(5, 8)[::2, 1::3],
+                                   np.arange(10, dtype='>u2'),
+                                   np.array(['a', 'bc']),
+                                   np.array(3.5),
+                                   np.zeros((0, 3), dtype=np.uint8)])
+def test_arrays(array):
+    result = _round_trip({'a': array})['a']
+    assert result.dtype == array.dtype
+    assert result.shape == array.shape
+    np.testing.assert_array_equal(result, array)
+
+
+def test_fortran_order_is_kept():
+    assert _round_trip(np.asfortranarray(np.ones((2, 3)))).flags.f_contiguous
+
+
+def test_structured_dtypes():
+    dtype = np.dtype([('id', '<i4'), ('position', '<f8', (3,)), ('flags', [('valid', 'u1')])])
+    array = np.zeros(3, dtype=dtype)
+    array['id'] = [4, 5, 6]
+    array['position'][1] = [1.0, 2.0, 3.0]
+    result = _round_trip({'array': array, 'scalar': array[1]})
+    assert result['array'].dtype == dtype and result['scalar'].dtype == dtype
+    np.testing.assert_array_equal(result['array'], array)
+    assert result['scalar'] == array[1]
+
+
+def test_arrays_are_aligned_views():
+    message = bytearray(_join(pack_values({'small': np.arange(3, dtype=np.uint8), 'name': 'x',
+                                           'large': np.arange(1000.0)})))
+    result = unpack_values(message)
+    base = np.frombuffer(message, dtype=np.uint8).ctypes.data
+    assert (result['large'].ctypes.data - base) % ALIGNMENT == 0
+    assert (result['small'].ctypes.data - base) % 16 == 0
+    assert not result['large'].flags.owndata
+
+
+def test_large_bytes_are_not_copied_on_send():
+    value = bytes(INLINE_BYTES * 4)
+    size, buffers = pack_values({'blob': value})
+    assert any(buffer is value for buffer in buffers)
+    assert _round_trip({'blob': value})['blob'] == value
+
+
+def test_mixed_message_and_extra():
+    message = {'camera': 'cam0', 'frame': 4711, 'pose': {'position': np.arange(3.0), 'frame_id': 'world'},
+               'detections': [{'label': 'cup', 'score': 0.93, 'box': [12, 40, 80, 120]}],
+               'depth': np.ones((16, 16), dtype=np.float32)}
+    result = _round_trip(message, extra={'_time': 12.5})
+    assert result['_time'] == 12.5
+    assert result['detections'] == message['detections']
+    np.testing.assert_array_equal(result['pose']['position'], message['pose']['position'])
+    np.testing.assert_array_equal(result['depth'], message['depth'])
+    assert _round_trip([1, 2], extra={'_time': 1.0}) == {'data': [1, 2], '_time': 1.0}
+
+
+@pytest.mark.parametrize('value', [object(), {(1, 2): 'tuple key'}, np.array([None, {}], dtype=object), {1, 2}])
+def test_unsupported_values(value):
+    with pytest.raises(TypeError):
+        pack_values(value)
+
+
+def test_malformed_message():
+    message = bytearray(_join(pack_values([1])))
+    message[4] = ord('?')
+    with pytest.raises(ValueError):
+        unpack_values(message)
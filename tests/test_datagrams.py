@@ -0,0 +1,126 @@
+import random
+import pytest
+from DataSocket.Datagrams import HEADER, FLAG_BATCH, MAX_FRAGMENTS, fragment, Reassembler
+
+
+def _datagrams(message_id, payload, datagram_size=100, flags=0):
+    return [b''.join(bytes(buffer) for buffer in datagram)
+            for datagram in fragment(message_id, len(payload), payload, datagram_size, flags)]
+
+
+def _add_all(reassembler, datagrams, now=0.0):
+    results = [reassembler.add(datagram, now) for datagram in datagrams]
+    return [bytes(result) for result in results if result is not None]
+
+
+def test_fragment_sizes():
+    payload = bytes(range(250))
+    datagrams = _datagrams(1, payload)
+    assert len(datagrams) == 3
+    assert all(len(datagram) <= 100 for datagram in datagrams)
+    assert b''.join(datagram[HEADER.size:] for datagram in datagrams) == payload
+
+
+def test_list_of_buffers_is_split_across_datagrams():
+    buffers = [b'a' * 30, memoryview(b'b' * 200), bytearray(b'c' * 5), b'']
+    datagrams = [b''.join(bytes(buffer) for buffer in datagram) for datagram in fragment(1, 235, buffers, 64)]
+    assert b''.join(datagram[HEADER.size:] for datagram in datagrams) == b''.join(bytes(b) for b in buffers)
+
+
+def test_too_many_fragments():
+    with pytest.raises(ValueError):
+        fragment(1, (MAX_FRAGMENTS + 1) * 10, b'', 10 + HEADER.size)
+
+
+@pytest.mark.parametrize('size', [0, 1, 86, 87, 1000])
+def test_in_order(size):
+    payload = bytes(random.Random(size).getrandbits(8) for _ in range(size))
+    reassembler = Reassembler()
+    assert _add_all(reassembler, _datagrams(7, payload)) == [payload]
+    assert reassembler.received_messages == 1 and reassembler.pending == 0
+
+
+def test_reordered_and_duplicated_fragments():
+    payload = bytes(range(256)) * 4
+    datagrams = _datagrams(1, payload)
+    shuffled = datagrams + datagrams[:3]
+    random.Random(0).shuffle(shuffled)
+    reassembler = Reassembler()
+    assert _add_all(reassembler, shuffled) == [payload]
+    assert reassembler.invalid_datagrams == 0
+
+
+def test_interleaved_messages_and_flags():
+    first, second = bytes(300), bytes(range(200))
+    a, b = _datagrams(1, first), _datagrams(2, second, flags=FLAG_BATCH)
+    interleaved = [a[0], b[0], a[1], b[1], b[2], a[2], a[3]]
+    reassembler = Reassembler()
+    results = []
+    for datagram in interleaved:
+        result = reassembler.add(datagram, 0.0)
+        if result is not None:
+            results.append((bytes(result), reassembler.flags))
+    assert results == [(second, FLAG_BATCH), (first, 0)]
+
+
+def test_lost_fragment_times_out():
+    payload = bytes(500)
+    reassembler = Reassembler(timeout=1.0)
+    datagrams = _datagrams(1, payload)
+    assert _add_all(reassembler, datagrams[:-1], now=0.0) == []
+    assert reassembler.pending == 1
+    reassembler.expire(now=2.0)
+    assert reassembler.pending == 0 and reassembler.incomplete_messages == 1
+    # the rest of the message arrives late
+    assert reassembler.add(datagrams[-1], now=2.1) is None
+    assert reassembler.late_fragments == 1
+
+
+def test_lost_and_reordered_messages_are_counted():
+    reassembler = Reassembler()
+    for message_id in (1, 2, 5, 3, 6):
+        _add_all(reassembler, _datagrams(message_id, b'x' * 10))
+    assert reassembler.received_messages == 5
+    assert reassembler.out_of_order_messages == 1
+    assert reassembler.missed_messages == 1  # message 4
+
+
+def test_message_id_wraps_around():
+    reassembler = Reassembler()
+    for message_id in (0xFFFFFFFE, 0xFFFFFFFF, 0x100000000, 0x100000001):
+        assert _add_all(reassembler, _datagrams(message_id, b'y' * 150)) == [b'y' * 150]
+    assert reassembler.missed_messages == 0
+
+
+def test_oldest_incomplete_message_is_dropped_beyond_max_pending():
+    reassembler = Reassembler(max_pending=2)
+    starts = [_datagrams(message_id, bytes(300)) for message_id in (1, 2, 3)]
+    for datagrams in starts:
+        reassembler.add(datagrams[0], 0.0)
+    assert reassembler.pending == 2 and reassembler.incomplete_messages == 1
+    assert _add_all(reassembler, starts[2][1:]) == [bytes(300)]
+
+
+@pytest.mark.parametrize('datagram', [b'', b'\x00' * (HEADER.size - 1), HEADER.pack(99, 0, 0, 1, 1, 0),
+                                      HEADER.pack(1, 0, 2, 2, 1, 10) + b'x' * 5, HEADER.pack(1, 0, 0, 1, 1, 10)])
+def test_invalid_datagrams(datagram):
+    reassembler = Reassembler()
+    assert reassembler.add(datagram, 0.0) is None
+    assert reassembler.invalid_datagrams == 1
+
+
+@pytest.mark.parametrize('index, count, size', [(0, MAX_FRAGMENTS, 0xFFFFFFFF),  # claims about 4 GB
+                                                (0, 2, 1000),  # more than two fragments of this size hold
+                                                (0, 3, 150),  # fits into two fragments of this size
+                                                (MAX_FRAGMENTS - 1, MAX_FRAGMENTS, 0xFFFFFFFF)])
+def test_implausible_sizes_allocate_nothing(index, count, size):
+    reassembler = Reassembler()
+    assert reassembler.add(HEADER.pack(1, 0, index, count, 1, size) + bytes(100), 0.0) is None
+    assert reassembler.invalid_datagrams == 1 and reassembler.pending == 0
+
+
+def test_max_message_size():
+    reassembler = Reassembler(max_message_size=250)
+    assert _add_all(reassembler, _datagrams(1, bytes(250))) == [bytes(250)]
+    assert _add_all(reassembler, _datagrams(2, bytes(251))) == []
+    assert reassembler.invalid_datagrams == 3 and reassembler.pending == 0
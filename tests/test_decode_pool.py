@@ -0,0 +1,64 @@
+import os
+import signal
+import time
+import numpy as np
+import pytest
+from DataSocket.DecodePool import DecodePool
+from DataSocket.Serialization import NUMPY, JSON, encode
+
+
+def _message(i, size=20000):
+    _, payload = encode(NUMPY, {'i': np.array([i]), 'x': np.random.default_rng(i).random(size)})
+    return b''.join(bytes(buffer) for buffer in payload) if isinstance(payload, list) else bytes(payload)
+
+
+@pytest.fixture
+def pool():
+    received = []
+    pool = DecodePool(lambda data, trace=None: received.append(int(data['i'][0])), 1, inline_size=1000,
+                      verbose=False)
+    pool.received = received
+    yield pool
+    pool.close()
+
+
+def test_messages_are_delivered_in_order(pool):
+    for i in range(10):
+        pool.submit(NUMPY, False, None, _message(i, size=10 if i % 3 else 20000))
+    assert pool.wait_idle(timeout=20)
+    assert pool.received == list(range(10))
+    stats = pool.stats()
+    assert stats['offloaded_messages'] == 4 and stats['inline_messages'] == 6 and stats['errors'] == 0
+
+
+def test_dead_worker_is_replaced(pool):
+    for i in range(3):
+        pool.submit(NUMPY, False, None, _message(i))
+    assert pool.wait_idle(timeout=20)
+    for pid in list(pool._executor._processes):
+        os.kill(pid, signal.SIGKILL)
+    time.sleep(0.5)  # until the pool noticed
+    for i in range(3, 10):
+        pool.submit(NUMPY, False, None, _message(i))
+    assert pool.wait_idle(timeout=20)
+    assert pool.received == list(range(10))
+    stats = pool.stats()
+    assert stats['errors'] == 1
+    # the messages after the one that found the pool broken are decoded by the new workers again
+    assert stats['offloaded_messages'] == 9
+
+
+def test_decoding_errors_are_counted(pool):
+    pool.submit(NUMPY, False, None, bytes(5000))
+    pool.submit(NUMPY, False, None, _message(1))
+    assert pool.wait_idle(timeout=20)
+    assert pool.received == [1]
+    assert pool.stats()['errors'] == 1
+
+
+def test_closed_pool_takes_no_messages():
+    received = []
+    pool = DecodePool(lambda data, trace=None: received.append(data), 1, inline_size=0, verbose=False)
+    pool.close()
+    pool.submit(JSON, False, None, b'{"a": 1}')
+    assert received == [] and pool.stats()['pending'] == 0
@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+from DataSocket.DeltaEncoding import DeltaEncoder, DeltaDecoder, HEADER, KEYFRAME, DELTA, UNCHANGED
+
+
+def _join(packed):
+    size, buffers = packed
+    message = b''.join(bytes(buffer) for buffer in buffers)
+    assert len(message) == size
+    return message
+
+
+def _kind(message):
+    return HEADER.unpack_from(message)[0]
+
+
+def _grid():
+    return {'grid': np.zeros((100, 100), dtype=np.int8), 'status': np.array([0, 0, 0], dtype=np.uint16)}
+
+
+def _assert_equal(result, expected):
+    assert set(result) == set(expected)
+    for key, array in expected.items():
+        assert result[key].dtype == array.dtype
+        np.testing.assert_array_equal(result[key], array)
+
+
+def test_keyframe_then_deltas():
+    encoder, decoder = DeltaEncoder(), DeltaDecoder()
+    data = _grid()
+    base, state, message, keyframe = encoder.pack(data)
+    assert base is None and message is keyframe
+    _assert_equal(decoder.unpack(_join(message)), data)
+    for i in range(1, 6):
+        data['grid'][i, i] = i
+        base, state, message, keyframe = encoder.pack(data)
+        message = _join(message)
+        assert _kind(message) == DELTA
+        assert len(message) < len(_join(keyframe))
+        _assert_equal(decoder.unpack(message), data)
+        assert decoder.state == state
+
+
+def test_unchanged():
+    encoder, decoder = DeltaEncoder(), DeltaDecoder()
+    data = _grid()
+    decoder.unpack(_join(encoder.pack(data)[2]))
+    message = _join(encoder.pack(data)[2])
+    assert _kind(message) == UNCHANGED and len(message) == HEADER.size
+    _assert_equal(decoder.unpack(message), data)
+
+
+def test_the_caller_may_modify_sent_arrays():
+    encoder, decoder = DeltaEncoder(), DeltaDecoder()
+    data = _grid()
+    decoder.unpack(_join(encoder.pack(data)[2]))
+    data['status'][1] = 5
+    _assert_equal(decoder.unpack(_join(encoder.pack(data)[2])), data)
+
+
+@pytest.mark.parametrize('change', [lambda data: data['grid'].fill(3),
+                                    lambda data: data.update(status=np.array([1.5, 2.5])),
+                                    lambda data: data.update(grid=np.zeros((10, 10), dtype=np.int8))])
+def test_large_or_structural_changes_are_sent_in_full(change):
+    encoder, decoder = DeltaEncoder(), DeltaDecoder()
+    data = _grid()
+    decoder.unpack(_join(encoder.pack(data)[2]))
+    change(data)
+    message = _join(encoder.pack(data)[2])
+    assert _kind(message) == DELTA
+    _assert_equal(decoder.unpack(message), data)
+
+
+def test_new_keys_send_a_keyframe():
+    encoder, decoder = DeltaEncoder(), DeltaDecoder()
+    data = _grid()
+    decoder.unpack(_join(encoder.pack(data)[2]))
+    data['new'] = np.arange(3)
+    base, _, message, _ = encoder.pack(data)
+    assert base is None and _kind(_join(message)) == KEYFRAME
+    _assert_equal(decoder.unpack(_join(message)), data)
+
+
+def test_keyframe_interval():
+    encoder = DeltaEncoder(keyframe_interval=3)
+    data = _grid()
+    kinds = []
+    for i in range(7):
+        data['grid'][0, i] = i
+        kinds.append(_kind(_join(encoder.pack(data)[2])))
+    assert kinds == [KEYFRAME, DELTA, DELTA, KEYFRAME, DELTA, DELTA, KEYFRAME]
+
+
+def test_receiver_that_missed_a_message():
+    encoder, decoder = DeltaEncoder(), DeltaDecoder()
+    data = _grid()
+    decoder.unpack(_join(encoder.pack(data)[2]))
+    data['grid'][1, 1] = 1
+    encoder.pack(data)  # lost
+    data['grid'][2, 2] = 2
+    _, _, message, keyframe = encoder.pack(data)
+    with pytest.raises(ValueError):
+        decoder.unpack(_join(message))
+    _assert_equal(decoder.unpack(_join(keyframe)), data)
+
+
+def test_single_array_nans_and_structured_dtypes():
+    encoder, decoder = DeltaEncoder(), DeltaDecoder()
+    values = np.full(50, np.nan)
+    decoder.unpack(_join(encoder.pack(values)[2]))
+    message = _join(encoder.pack(values)[2])
+    assert _kind(message) == UNCHANGED
+    decoder.unpack(message)
+    values = values.copy()
+    values[7] = 1.0
+    result = decoder.unpack(_join(encoder.pack(values)[2]))
+    np.testing.assert_array_equal(result, values)
+    assert not result.flags.writeable
+
+    encoder, decoder = DeltaEncoder(), DeltaDecoder()
+    table = np.zeros(20, dtype=[('id', '<i4'), ('gain', '<f8')])
+    decoder.unpack(_join(encoder.pack(table)[2]))
+    table['gain'][4] = 2.0
+    result = decoder.unpack(_join(encoder.pack(table)[2]))
+    assert result.dtype == table.dtype
+    np.testing.assert_array_equal(result, table)
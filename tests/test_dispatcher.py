@@ -0,0 +1,137 @@
+import threading
+import time
+import pytest
+from DataSocket import BLOCK, DROP_NEWEST, LATEST
+from DataSocket.Dispatcher import Dispatcher, INLINE, THREAD, POOL, STRICT, PER_KEY, UNORDERED
+
+
+def _wait_for(condition, timeout=5.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+class _Recorder(object):
+    """
+    Handler recording the messages, the threads they were handled on and how many ran at the same time.
+    """
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.messages = []
+        self.threads = set()
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, message):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.threads.add(threading.get_ident())
+        time.sleep(self.delay)
+        with self._lock:
+            self.messages.append(message)
+            self.running -= 1
+
+
+@pytest.fixture
+def dispatcher():
+    dispatcher = Dispatcher(worker_threads=4, verbose=False)
+    yield dispatcher
+    dispatcher.close()
+
+
+def test_inline_runs_on_the_receiving_thread(dispatcher):
+    handler = _Recorder()
+    dispatcher.subscribe(handler, execution=INLINE)
+    dispatcher.dispatch([1, 2, 3])
+    assert handler.messages == [1, 2, 3]
+    assert handler.threads == {threading.get_ident()}
+
+
+def test_thread_runs_in_order_on_its_own_thread(dispatcher):
+    handler = _Recorder()
+    subscription = dispatcher.subscribe(handler, execution=THREAD, queue_size=100, queue_policy=BLOCK)
+    for i in range(20):
+        dispatcher.dispatch([i])
+    assert subscription.wait_idle(timeout=5)
+    assert handler.messages == list(range(20))
+    assert len(handler.threads) == 1 and threading.get_ident() not in handler.threads
+
+
+def test_pool_strict_handles_one_message_at_a_time_in_order(dispatcher):
+    handler = _Recorder(delay=0.005)
+    subscription = dispatcher.subscribe(handler, execution=POOL, queue_size=100, queue_policy=BLOCK,
+                                        ordering=STRICT, concurrency=4)
+    for i in range(20):
+        dispatcher.dispatch([i])
+    assert subscription.wait_idle(timeout=5)
+    assert handler.messages == list(range(20))
+    assert handler.max_running == 1
+
+
+def test_pool_per_key_keeps_the_order_of_every_key(dispatcher):
+    handler = _Recorder(delay=0.01)
+    subscription = dispatcher.subscribe(handler, execution=POOL, queue_size=100, queue_policy=BLOCK,
+                                        ordering=PER_KEY, order_key='camera', concurrency=4)
+    for i in range(10):
+        dispatcher.dispatch([{'camera': camera, 'frame': i} for camera in ('a', 'b', 'c')])
+    assert subscription.wait_idle(timeout=5)
+    assert len(handler.messages) == 30
+    for camera in ('a', 'b', 'c'):
+        assert [m['frame'] for m in handler.messages if m['camera'] == camera] == list(range(10))
+    assert 1 < handler.max_running <= 3
+
+
+def test_pool_unordered_is_limited_by_concurrency(dispatcher):
+    handler = _Recorder(delay=0.01)
+    subscription = dispatcher.subscribe(handler, execution=POOL, queue_size=100, queue_policy=BLOCK,
+                                        ordering=UNORDERED, concurrency=3)
+    for i in range(20):
+        dispatcher.dispatch([i])
+    assert subscription.wait_idle(timeout=5)
+    assert sorted(handler.messages) == list(range(20))
+    assert 1 < handler.max_running <= 3
+
+
+@pytest.mark.parametrize('policy, handled', [(LATEST, [0, 9]), (DROP_NEWEST, [0, 1])])
+def test_slow_handler_queue_policy(dispatcher, policy, handled):
+    release = threading.Event()
+    handler = _Recorder()
+    subscription = dispatcher.subscribe(lambda message: release.wait(5) and handler(message), execution=THREAD,
+                                        queue_size=1, queue_policy=policy)
+    dispatcher.dispatch([0])
+    assert _wait_for(lambda: subscription.stats()['running'] == 1)
+    for i in range(1, 10):
+        dispatcher.dispatch([i])
+    release.set()
+    assert subscription.wait_idle(timeout=5)
+    assert handler.messages == handled
+    assert subscription.dropped == 8
+
+
+def test_every_subscription_gets_every_message(dispatcher):
+    first, second = _Recorder(), _Recorder()
+    subscriptions = [dispatcher.subscribe(first, execution=THREAD, queue_size=10, queue_policy=BLOCK),
+                     dispatcher.subscribe(second, execution=POOL, queue_size=10, queue_policy=BLOCK)]
+    dispatcher.dispatch([1, 2], as_list=True)
+    dispatcher.dispatch([3])
+    assert all(subscription.wait_idle(timeout=5) for subscription in subscriptions)
+    assert first.messages == second.messages == [[1, 2], 3]
+
+
+def test_handler_errors_are_counted(dispatcher):
+    subscription = dispatcher.subscribe(lambda message: 1 / message, execution=INLINE)
+    dispatcher.dispatch([1, 0, 2])
+    assert subscription.stats()['handled'] == 3 and subscription.errors == 1
+
+
+@pytest.mark.parametrize('arguments', [{'execution': 99}, {'queue_policy': 99}, {'ordering': 99},
+                                       {'execution': POOL, 'ordering': PER_KEY}])
+def test_invalid_arguments(dispatcher, arguments):
+    with pytest.raises(ValueError):
+        dispatcher.subscribe(lambda message: None, **arguments)
+
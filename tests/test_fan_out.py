@@ -0,0 +1,90 @@
+import socket
+import time
+import numpy as np
+import pytest
+from DataSocket import TCPSendSocket, TCPReceiveSocket, NUMPY, BLOCK, INLINE, BLOCK_ON_SLOW, SKIP_TO_LATEST, \
+    DISCONNECT_SLOW
+
+MESSAGES = 20
+
+
+def _free_port():
+    with socket.socket() as probe:
+        probe.bind(('localhost', 0))
+        return probe.getsockname()[1]
+
+
+def _wait_for(condition, timeout=10.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def serve():
+    """
+    Start a sender with the given slow consumer policy, a client that never reads and a receiver that keeps up.
+    """
+    started = []
+
+    def start(policy, **kwargs):
+        port = _free_port()
+        sender = TCPSendSocket(port, send_type=NUMPY, verbose=False, slow_consumer_policy=policy,
+                               queue_size=MESSAGES, queue_policy=BLOCK, **kwargs)
+        sender.start()
+        received = []
+        receiver = TCPReceiveSocket(port, verbose=False)
+        receiver.subscribe(received.append, execution=INLINE)
+        receiver.start(blocking=True)  # the sender is accepting connections once the receiver got in
+        stalled = socket.create_connection(('localhost', port))
+        stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        started.append((sender, stalled, receiver))
+        assert _wait_for(lambda: len(sender.connected_clients) == 2)
+        return sender, received
+
+    yield start
+    for sender, stalled, receiver in started:
+        stalled.close()
+        receiver.stop()
+        sender.stop()
+
+
+def _send(sender):
+    # random values do not compress, so the messages are far more than the socket buffers of the stalled client hold
+    for i in range(MESSAGES):
+        data = np.random.default_rng(i).random(100000)
+        data[0] = i
+        assert sender.send_data(data)
+
+
+def test_skip_to_latest(serve):
+    sender, received = serve(SKIP_TO_LATEST)
+    _send(sender)
+    assert sender.flush(timeout=10)
+    assert _wait_for(lambda: len(received) == MESSAGES)
+    assert [message['data'][0] for message in received] == list(range(MESSAGES))
+    stalled, fast = sorted(sender.client_stats(), key=lambda stats: stats['sent_messages'])
+    assert fast['pending_messages'] == 0 and fast['sent_messages'] == MESSAGES
+    # only the message being written and the newest one are kept for the stalled client
+    assert stalled['pending_messages'] <= 2 and stalled['skipped_messages'] > 0
+
+
+def test_disconnect_slow(serve):
+    sender, received = serve(DISCONNECT_SLOW, max_lag_bytes=2000000)
+    _send(sender)
+    assert sender.flush(timeout=10)
+    assert _wait_for(lambda: len(received) == MESSAGES)
+    assert _wait_for(lambda: len(sender.connected_clients) == 1)
+    assert sender.client_stats()[0]['sent_messages'] == MESSAGES
+    assert sender.stats()['disconnects'] == 1
+
+
+def test_flush_waits_for_a_stalled_client_with_block_on_slow(serve):
+    sender, received = serve(BLOCK_ON_SLOW)
+    _send(sender)
+    start = time.monotonic()
+    assert not sender.flush(timeout=0.5)
+    assert time.monotonic() - start < 5
@@ -0,0 +1,104 @@
+import json
+import socket
+import time
+import pytest
+from DataSocket import TCPSendSocket, TCPReceiveSocket, JSON, BLOCK, INLINE, LEGACY_FRAMES, FRAME_V2
+from DataSocket.Framing import LEGACY_HEADER, FrameWriter, handshake, parse_handshake, parse_header
+
+
+def _free_port():
+    with socket.socket() as probe:
+        probe.bind(('localhost', 0))
+        return probe.getsockname()[1]
+
+
+def _wait_for(condition, timeout=10.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def _serve_legacy(listener, messages):
+    """
+    Act as a sender that only knows the original format (i.e. the matlab sockets): a handshake without frame
+    version followed by messages with a 4 byte size in front.
+    """
+    connection, _ = listener.accept()
+    with connection:
+        connection.sendall(handshake(JSON))
+        for message in messages:
+            payload = json.dumps(message).encode()
+            connection.sendall(LEGACY_HEADER.pack(len(payload)) + payload)
+        time.sleep(0.5)
+
+
+@pytest.mark.parametrize('frame_version', [LEGACY_FRAMES, FRAME_V2])
+def test_handshake_announces_the_frame_version(frame_version):
+    parsed = parse_handshake(handshake(JSON, batched=True, frame_version=frame_version))
+    assert (parsed.send_type, parsed.batched, parsed.frame_version) == (JSON, True, frame_version)
+
+
+def test_legacy_handshake_is_the_bare_send_type():
+    # what the original senders write, which must still be read as a legacy stream
+    parsed = parse_handshake(JSON.to_bytes(4, 'little'))
+    assert parsed.frame_version == LEGACY_FRAMES and not parsed.batched
+
+
+def test_frames():
+    assert FrameWriter(LEGACY_FRAMES).frame(3, b'abc') == [LEGACY_HEADER.pack(3), b'abc']
+    writer = FrameWriter(FRAME_V2)
+    for sequence in (1, 2):
+        header, payload = writer.frame(3, b'abc', now=1.5)
+        header = parse_header(header)
+        assert (header.version, header.size, header.sequence, header.time) == (FRAME_V2, 3, sequence, 1.5)
+        assert payload == b'abc'
+    with pytest.raises(ValueError):
+        FrameWriter(1)
+
+
+@pytest.mark.parametrize('frame_version', [LEGACY_FRAMES, FRAME_V2])
+def test_receiver_adapts_to_the_sender(frame_version):
+    port = _free_port()
+    received = []
+    sender = TCPSendSocket(port, send_type=JSON, verbose=False, frame_version=frame_version, queue_size=10,
+                           queue_policy=BLOCK)
+    receiver = TCPReceiveSocket(port, verbose=False)
+    receiver.subscribe(received.append, execution=INLINE)
+    try:
+        sender.start()
+        receiver.start(blocking=True)
+        assert _wait_for(lambda: len(sender.connected_clients) == 1)
+        for i in range(5):
+            sender.send_data({'i': i})
+        assert _wait_for(lambda: len(received) == 5)
+        assert [message['i'] for message in received] == list(range(5))
+        assert receiver.frame_version == frame_version
+        assert receiver.missed_messages == 0
+        if frame_version == FRAME_V2:
+            assert receiver.last_header.sequence == 5
+        else:
+            assert receiver.last_header is None
+    finally:
+        receiver.stop()
+        sender.stop()
+
+
+def test_receiver_of_a_legacy_peer():
+    listener = socket.socket()
+    listener.bind(('localhost', 0))
+    listener.listen(1)
+    received = []
+    receiver = TCPReceiveSocket(listener.getsockname()[1], verbose=False)
+    receiver.subscribe(received.append, execution=INLINE)
+    try:
+        receiver.start()
+        _serve_legacy(listener, [{'i': 0}, {'i': 1}, [2]])
+        assert _wait_for(lambda: len(received) == 3)
+        assert received == [{'i': 0}, {'i': 1}, [2]]
+        assert receiver.frame_version == LEGACY_FRAMES and receiver.last_header is None
+    finally:
+        receiver.stop()
+        listener.close()
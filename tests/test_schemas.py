@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+from DataSocket.ArrayFormat import ALIGNMENT, SchemaEncoder, SchemaDecoder
+
+
+def _join(packed):
+    size, buffers = packed
+    message = b''.join(bytes(buffer) for buffer in buffers)
+    assert len(message) == size
+    return message
+
+
+def _tick(i):
+    return {'pos': np.array([i, i + 1.0, i + 2.0]), 'img': np.full((48, 64), i, dtype=np.uint8), 'ts': np.float64(i)}
+
+
+def test_schema_is_sent_once():
+    encoder, decoder = SchemaEncoder(), SchemaDecoder()
+    first_id, message, full = encoder.pack(_tick(0))
+    assert message is full
+    decoder.unpack(_join(message))
+    for i in range(1, 5):
+        schema_id, short, full = encoder.pack(_tick(i))
+        assert schema_id == first_id
+        assert short[0] < full[0]
+        result = decoder.unpack(_join(short))
+        np.testing.assert_array_equal(result['img'], _tick(i)['img'])
+        np.testing.assert_array_equal(result['pos'], _tick(i)['pos'])
+        assert result['ts'] == i
+
+
+def test_short_messages_keep_the_alignment():
+    encoder, decoder = SchemaEncoder(), SchemaDecoder()
+    decoder.unpack(_join(encoder.pack(_tick(0))[1]))
+    message = bytearray(_join(encoder.pack(_tick(1))[1]))
+    base = np.frombuffer(message, dtype=np.uint8).ctypes.data
+    for array in decoder.unpack(message).values():
+        assert (array.ctypes.data - base) % ALIGNMENT == 0
+
+
+def test_receiver_without_the_schema():
+    encoder = SchemaEncoder()
+    encoder.pack(_tick(0))
+    _, short, full = encoder.pack(_tick(1))
+    with pytest.raises(ValueError):
+        SchemaDecoder().unpack(_join(short))
+    # a late receiver gets the message including its schema instead
+    late = SchemaDecoder()
+    np.testing.assert_array_equal(late.unpack(_join(full))['img'], _tick(1)['img'])
+    np.testing.assert_array_equal(late.unpack(_join(encoder.pack(_tick(2))[1]))['img'], _tick(2)['img'])
+
+
+@pytest.mark.parametrize('changed', [{'pos': np.zeros(4)},
+                                     {'pos': np.zeros(3, dtype=np.float32)},
+                                     {'img': np.asfortranarray(np.zeros((48, 64), dtype=np.uint8))},
+                                     {'extra': np.zeros(1)}])
+def test_new_structure_gets_a_new_schema(changed):
+    encoder, decoder = SchemaEncoder(), SchemaDecoder()
+    first_id, message, _ = encoder.pack(_tick(0))
+    decoder.unpack(_join(message))
+    data = dict(_tick(1), **changed)
+    schema_id, message, full = encoder.pack(data)
+    assert schema_id != first_id and message is full
+    result = decoder.unpack(_join(message))
+    for key, array in data.items():
+        assert result[key].dtype == np.asarray(array).dtype
+        np.testing.assert_array_equal(result[key], array)
+
+
+def test_structured_dtypes_of_the_same_size_are_told_apart():
+    encoder, decoder = SchemaEncoder(), SchemaDecoder()
+    a = np.zeros(3, dtype=[('x', '<f8'), ('y', '<f8')])
+    b = np.zeros(3, dtype=[('t', '<i8'), ('v', '<f4'), ('w', '<f4')])
+    b['t'] = [1, 2, 3]
+    assert a.dtype.str == b.dtype.str
+    ids = set()
+    for array in (a, b, a, b):
+        schema_id, message, _ = encoder.pack(array)
+        ids.add(schema_id)
+        result = decoder.unpack(_join(message))
+        assert result.dtype == array.dtype
+        np.testing.assert_array_equal(result, array)
+    assert len(ids) == 2
+
+
+def test_single_array_and_extra():
+    encoder, decoder = SchemaEncoder(), SchemaDecoder()
+    for i in range(3):
+        result = decoder.unpack(_join(encoder.pack(np.arange(5) + i)[1]))
+        np.testing.assert_array_equal(result, np.arange(5) + i)
+    result = decoder.unpack(_join(encoder.pack(np.arange(5), extra={'_time': 1.5})[1]))
+    np.testing.assert_array_equal(result['data'], np.arange(5))
+    assert result['_time'] == 1.5
+
+
+def test_schemas_are_forgotten_beyond_max_schemas():
+    encoder, decoder = SchemaEncoder(max_schemas=2), SchemaDecoder(max_schemas=2)
+    for length in (1, 2, 3, 1, 2, 3):
+        schema_id, message, full = encoder.pack(np.zeros(length))
+        np.testing.assert_array_equal(decoder.unpack(_join(message)), np.zeros(length))
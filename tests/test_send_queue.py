@@ -0,0 +1,107 @@
+import time
+from queue import Empty
+from threading import Thread
+import pytest
+from DataSocket.SendQueue import SendQueue, BLOCK, DROP_OLDEST, DROP_NEWEST, LATEST
+
+
+def _drain(queue):
+    items = []
+    while True:
+        try:
+            items.append(queue.get(timeout=0))
+        except Empty:
+            return items
+        queue.task_done()
+
+
+def test_latest_keeps_only_the_newest():
+    queue = SendQueue(maxsize=10, policy=LATEST)
+    assert queue.maxsize == 1
+    for i in range(5):
+        assert queue.put(i)
+    assert _drain(queue) == [4]
+    assert queue.dropped == 4 and queue.total == 5
+
+
+def test_drop_oldest():
+    queue = SendQueue(maxsize=3, policy=DROP_OLDEST)
+    for i in range(6):
+        assert queue.put(i)
+    assert _drain(queue) == [3, 4, 5]
+    assert queue.dropped == 3 and queue.high_water == 3
+
+
+def test_drop_newest():
+    queue = SendQueue(maxsize=3, policy=DROP_NEWEST)
+    assert [queue.put(i) for i in range(5)] == [True, True, True, False, False]
+    assert _drain(queue) == [0, 1, 2]
+    assert queue.dropped == 2 and queue.total == 3
+
+
+def test_block_waits_for_room():
+    queue = SendQueue(maxsize=2, policy=BLOCK)
+    queue.put(0)
+    queue.put(1)
+    assert not queue.put(2, timeout=0.05)
+    assert queue.dropped == 1
+
+    def consume():
+        time.sleep(0.1)
+        queue.get()
+        queue.task_done()
+    consumer = Thread(target=consume)
+    consumer.start()
+    assert queue.put(2, timeout=5)
+    consumer.join()
+    assert _drain(queue) == [1, 2]
+    assert queue.dropped == 1 and queue.total == 3
+
+
+def test_join_waits_for_task_done():
+    queue = SendQueue(maxsize=4, policy=BLOCK)
+    for i in range(3):
+        queue.put(i)
+    assert not queue.join(timeout=0.05)
+    received = []
+
+    def consume():
+        for _ in range(3):
+            received.append(queue.get())
+            time.sleep(0.01)
+            queue.task_done()
+    consumer = Thread(target=consume)
+    consumer.start()
+    assert queue.join(timeout=5)
+    consumer.join()
+    assert received == [0, 1, 2]
+
+
+def test_dropped_items_do_not_hold_up_join():
+    queue = SendQueue(maxsize=2, policy=DROP_OLDEST)
+    for i in range(5):
+        queue.put(i)
+    _drain(queue)
+    assert queue.join(timeout=0)
+
+
+def test_close_wakes_up_producers_and_consumers():
+    queue = SendQueue(maxsize=1, policy=BLOCK)
+    queue.put(0)
+    results = []
+    producer = Thread(target=lambda: results.append(queue.put(1)))
+    producer.start()
+    time.sleep(0.05)
+    queue.close()
+    producer.join(timeout=5)
+    assert results == [False]
+    assert not queue.put(2)
+    assert queue.get() == 0
+    with pytest.raises(Empty):
+        queue.get()
+
+
+@pytest.mark.parametrize('arguments', [{'policy': 99}, {'maxsize': 0, 'policy': BLOCK}])
+def test_invalid_arguments(arguments):
+    with pytest.raises(ValueError):
+        SendQueue(**arguments)
@@ -0,0 +1,111 @@
+import socket
+import threading
+import time
+import numpy as np
+import pytest
+from DataSocket import UDPSendSocket, UDPReceiveSocket, NUMPY, JSON, RAW, ARRAY, BINARY, BLOCK
+from DataSocket.Serialization import encode, encode_batch, decode_batch
+
+MESSAGES = 200
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        probe.bind(('localhost', 0))
+        return probe.getsockname()[1]
+
+
+def _wait_for(condition, timeout=10.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def _join(packed):
+    size, payload = packed
+    message = b''.join(bytes(buffer) for buffer in payload) if isinstance(payload, list) else bytes(payload)
+    assert len(message) == size
+    return message
+
+
+@pytest.mark.parametrize('send_type', [JSON, NUMPY, ARRAY, BINARY])
+def test_batch_round_trip(send_type):
+    messages = [{'i': np.arange(i + 1)} for i in range(5)] if send_type != JSON else [{'i': i} for i in range(5)]
+    batch = _join(encode_batch(send_type, [encode(send_type, message) for message in messages]))
+    result = decode_batch(send_type, batch)
+    assert len(result) == 5
+    for message, decoded in zip(messages, result):
+        np.testing.assert_array_equal(decoded['i'], message['i'])
+
+
+def test_raw_messages_can_not_be_batched():
+    with pytest.raises(ValueError):
+        encode_batch(RAW, [(3, b'abc')])
+
+
+@pytest.fixture
+def connect():
+    started = []
+
+    def start(receiver_arguments, sender_arguments):
+        port = _free_port()
+        received = []
+        receiver = UDPReceiveSocket(port, received.append, send_type=JSON, verbose=False, **receiver_arguments)
+        sender = UDPSendSocket(port, send_type=JSON, verbose=False, max_datagram_size=1000, queue_size=MESSAGES,
+                               queue_policy=BLOCK, **sender_arguments)
+        started.extend((sender, receiver))
+        receiver.start()
+        assert _wait_for(lambda: receiver.is_connected)
+        sender.start()
+        return sender, receiver, received
+
+    yield start
+    for started_socket in started:
+        started_socket.stop()
+
+
+def test_small_messages_are_packed(connect):
+    sender, receiver, received = connect({'deliver_batches': True}, {'batch_interval': 0.01})
+    for i in range(MESSAGES):
+        sender.send_data({'i': i})
+    assert _wait_for(lambda: sum(len(batch) for batch in received) == MESSAGES)
+    assert all(isinstance(batch, list) for batch in received)
+    assert [message['i'] for batch in received for message in batch] == list(range(MESSAGES))
+    # every datagram carries up to 1000 bytes worth of the 10 byte messages
+    assert receiver.received_messages < MESSAGES / 10
+    assert receiver.stats()['messages'] == MESSAGES and receiver.missed_messages == 0
+
+
+def test_large_messages_are_sent_on_their_own(connect):
+    sender, receiver, received = connect({}, {'batch_interval': 0.01})
+    messages = [{'i': 0}, {'i': 1, 'text': 'x' * 3000}, {'i': 2}, {'i': 3}]
+    for message in messages:
+        sender.send_data(message)
+    assert _wait_for(lambda: len(received) == len(messages))
+    assert received == messages
+    assert receiver.received_messages == 3
+
+
+def test_messages_are_kept_while_the_handler_is_busy(connect):
+    busy, release = threading.Event(), threading.Event()
+    handled = []
+
+    def slow(batch):
+        busy.set()
+        release.wait(5)
+        handled.extend(batch)
+    sender, receiver, _ = connect({'deliver_batches': True, 'max_pending_messages': 50}, {'batch_interval': 0})
+    receiver.handler_function = slow
+    sender.send_data({'i': -1})
+    assert busy.wait(5)
+    for i in range(MESSAGES):
+        sender.send_data({'i': i})
+    assert _wait_for(lambda: receiver.stats()['messages'] == MESSAGES + 1)
+    release.set()
+    assert _wait_for(lambda: len(handled) == 51)
+    # the oldest messages waiting for the handler were dropped
+    assert [message['i'] for message in handled] == [-1] + list(range(MESSAGES - 50, MESSAGES))
+    assert receiver.stats()['dropped_messages'] == MESSAGES - 50